@@ -0,0 +1,187 @@
+import argparse
+import extract_helper_functions as ex
+import json
+import load_update_data as load
+import metadata_cache as mc
+import os
+import spotify_client as sc
+import transform_data as tf
+
+
+def iter_json_array(path, read_size=1 << 16):
+    '''
+    Streams the items of a file holding one top-level JSON array, decoding one item at a time from a bounded read buffer. Yields decoded items.
+
+    ARGUMENTS:
+        path: Path of JSON file.
+        read_size: Number of characters read from the file at a time.
+    '''
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as file:
+        buffer = file.read(read_size).lstrip()
+        if not buffer.startswith('['):
+            raise ValueError(f'{path} does not hold a JSON array')
+        buffer = buffer[1:]
+        eof = False
+        while True:
+            buffer = buffer.lstrip().lstrip(',').lstrip()
+            if buffer.startswith(']'):
+                return
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                # Item continues past the buffer, read more of the file
+                if eof:
+                    raise
+                chunk = file.read(read_size)
+                eof = not chunk
+                buffer += chunk
+                continue
+            yield item
+            buffer = buffer[end:]
+
+
+def iter_export_plays(export_paths, checkpoint):
+    '''
+    Streams track plays from Spotify extended streaming history exports (endsong_*.json, Streaming_History_Audio_*.json), skipping records already loaded according to checkpoint.
+    Records without a track URI (podcast episodes, and every record of the basic StreamingHistory*.json export, which carries no IDs) are skipped.
+    Yields tuples of (file name, record index, played_at, track ID).
+
+    ARGUMENTS:
+        export_paths: List of export file paths, processed in order.
+        checkpoint: Dictionary of records already loaded keyed by file name.
+    '''
+    for path in export_paths:
+        file_name = os.path.basename(path)
+        for index, record in enumerate(iter_json_array(path)):
+            if index < checkpoint.get(file_name, 0):
+                continue
+            track_uri = record.get('spotify_track_uri')
+            if not track_uri:
+                continue
+            yield file_name, index, record['ts'], track_uri.split(':')[-1]
+
+
+def read_checkpoint(checkpoint_path):
+    '''
+    Returns dictionary of records already loaded keyed by export file name. Returns empty dictionary if no backfill has run.
+
+    ARGUMENTS:
+        checkpoint_path: Path of JSON checkpoint file.
+    '''
+    if not os.path.exists(checkpoint_path):
+        return {}
+    with open(checkpoint_path) as file:
+        return json.load(file)
+
+
+def write_checkpoint(checkpoint_path, checkpoint):
+    '''
+    Atomically replaces the checkpoint file so an interrupted write never leaves a partial checkpoint.
+
+    ARGUMENTS:
+        checkpoint_path: Path of JSON checkpoint file.
+        checkpoint: Dictionary of records already loaded keyed by export file name.
+    '''
+    temp_path = checkpoint_path + '.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(checkpoint, file)
+    os.replace(temp_path, checkpoint_path)
+
+
+def load_chunk(plays, client, cache, hostname, database, username, pwd, port_id, key_cache=None, user_label=load.DEFAULT_USER_LABEL):
+    '''
+    Resolves one chunk of plays to full track objects, then runs them through create_dataframes and load_update_tables. Returns True if the chunk was committed.
+
+    ARGUMENTS:
+        plays: List of (file name, record index, played_at, track ID) tuples.
+        client: SpotifyApiClient used for Spotify Web API requests.
+        cache: Optional MetadataCache placed in front of the artist and album API requests.
+        hostname: Host name credential for connecting to PostgreSQL.
+        database: Name of database containing artist, album, track tables in PostgreSQL.
+        username: Username credential for connecting to desired database in PostgreSQL.
+        pwd: Password credential for connecting to desired database in PostgreSQL.
+        port_id: Port number for connecting to desired database in PostgreSQL.
+        key_cache: Optional SurrogateKeyCache reused across chunks.
+        user_label: Label of the user whose plays are loaded.
+    '''
+    track_info = ex.batch_track_info(client, [track_id for _, _, _, track_id in plays])
+    # Shaped like get_recent_played_tracks so the regular transform applies. Tracks no longer on Spotify are dropped.
+    recent_tracks = {
+        'items': [
+            {'played_at': played_at, 'track': track_info[track_id]}
+            for _, _, played_at, track_id in plays
+            if track_id in track_info
+        ]
+    }
+    if not recent_tracks['items']:
+        return True
+    play_log_fact_table, track_dim_table, artist_dim_table, album_dim_table = tf.create_dataframes(recent_tracks, cache=cache, client=client)
+    return load.load_update_tables(play_log_fact_table, track_dim_table, artist_dim_table, album_dim_table, hostname, database, username, pwd, port_id, key_cache=key_cache, user_label=user_label)
+
+
+def backfill_streaming_history(export_paths, client, hostname, database, username, pwd, port_id, checkpoint_path='backfill_checkpoint.json', chunk_size=1000, cache=None, user_label=load.DEFAULT_USER_LABEL):
+    '''
+    Backfills play history from Spotify extended streaming history exports. Files are streamed and loaded in chunks of chunk_size plays, so memory use does not grow with export size.
+    After every committed chunk the checkpoint file is updated, so an interrupted backfill resumes after the last committed chunk. Stops at the first chunk that fails to load.
+    Returns number of plays committed.
+
+    ARGUMENTS:
+        export_paths: List of export file paths, processed in order.
+        client: SpotifyApiClient used for Spotify Web API requests.
+        hostname: Host name credential for connecting to PostgreSQL.
+        database: Name of database containing artist, album, track tables in PostgreSQL.
+        username: Username credential for connecting to desired database in PostgreSQL.
+        pwd: Password credential for connecting to desired database in PostgreSQL.
+        port_id: Port number for connecting to desired database in PostgreSQL.
+        checkpoint_path: Path of JSON checkpoint file.
+        chunk_size: Number of plays per chunk.
+        cache: Optional MetadataCache placed in front of the artist and album API requests.
+        user_label: Label of the user whose plays are loaded.
+    '''
+    checkpoint = read_checkpoint(checkpoint_path)
+    key_cache = load.SurrogateKeyCache()
+    plays_loaded = 0
+    chunk = []
+
+    def commit_chunk():
+        if not load_chunk(chunk, client, cache, hostname, database, username, pwd, port_id, key_cache, user_label):
+            return False
+        # Records up to and including each file's last record in the chunk are done
+        for file_name, index, _, _ in chunk:
+            checkpoint[file_name] = max(checkpoint.get(file_name, 0), index + 1)
+        write_checkpoint(checkpoint_path, checkpoint)
+        return True
+
+    for play in iter_export_plays(export_paths, checkpoint):
+        chunk.append(play)
+        if len(chunk) == chunk_size:
+            if not commit_chunk():
+                return plays_loaded
+            plays_loaded += len(chunk)
+            chunk = []
+
+    if chunk and commit_chunk():
+        plays_loaded += len(chunk)
+    return plays_loaded
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backfill play history from Spotify extended streaming history exports into PostgreSQL, resuming from the checkpoint file.')
+    parser.add_argument('exports', nargs='+', help='Export files (endsong_*.json, Streaming_History_Audio_*.json), processed in the order given.')
+    parser.add_argument('--checkpoint-path', default='backfill_checkpoint.json', help='JSON checkpoint file of records already loaded.')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='Number of plays per committed chunk.')
+    parser.add_argument('--token-cache-path', default=None, help='Spotipy token cache file of the account. Defaults to spotipy\'s .cache file.')
+    parser.add_argument('--cache-path', default=None, help='Optional MetadataCache path placed in front of the artist and album API requests.')
+    parser.add_argument('--user-label', default=load.DEFAULT_USER_LABEL, help='Label of the user whose plays are loaded, their email or client_id in a database shared by several users.')
+    parser.add_argument('--base-url', default='https://api.spotify.com/v1', help='Spotify Web API root URL. Point at a local stub server for testing.')
+    parser.add_argument('--hostname', default='localhost')
+    parser.add_argument('--database', default='spotify_project')
+    parser.add_argument('--username', default='postgres')
+    parser.add_argument('--pwd', default='')
+    parser.add_argument('--port-id', default=5432)
+    args = parser.parse_args()
+
+    cache = mc.MetadataCache(args.cache_path) if args.cache_path is not None else None
+    with sc.SpotifyApiClient(sc.TokenHolder(cache_path=args.token_cache_path), base_url=args.base_url) as client:
+        print(backfill_streaming_history(args.exports, client, args.hostname, args.database, args.username, args.pwd, args.port_id, args.checkpoint_path, args.chunk_size, cache, args.user_label))
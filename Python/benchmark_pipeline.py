@@ -0,0 +1,146 @@
+import argparse
+import extract_helper_functions as ex
+import json
+import load_update_data as load
+import metadata_cache as mc
+import spotify_client as sc
+import spotipy
+import streaming_etl as st
+import subprocess
+import synthetic_spotify_data as synth
+import time
+import transform_data as tf
+from datetime import datetime
+from stub_spotify_server import StubSpotifyServer
+
+
+def current_commit():
+    '''
+    Returns git commit hash of the working tree, or None outside a git checkout.
+
+    ARGUMENTS:
+        None
+    '''
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(n_plays, latency=0.0, rate_limit_every=0, db_params=None, cache_path=None, seed=0, chunk_size=None):
+    '''
+    Times extract, transform (with enrichment), and load of n_plays synthetic plays against a local stub Spotify API and, if db_params is given, a local PostgreSQL database.
+    Returns dictionary of benchmark parameters and per-stage seconds, row counts, and HTTP request counts.
+
+    ARGUMENTS:
+        n_plays: Number of synthetic plays.
+        latency: Seconds of latency injected into every stub API response.
+        rate_limit_every: Stub answers every Nth request with 429. 0 disables rate limiting.
+        db_params: Optional dictionary of hostname, database, username, pwd, port_id for the load stage. Load is skipped without it.
+        cache_path: Optional MetadataCache path used during transform.
+        seed: Random seed of the synthetic data.
+        chunk_size: Optional chunk size. Runs the streaming pipeline (streaming_etl.run_streaming_etl) as one stage instead of separate extract, transform, and load stages. Raises ValueError without db_params.
+    '''
+    if chunk_size is not None and db_params is None:
+        raise ValueError('The streaming benchmark loads every chunk, chunk_size requires db_params')
+
+    results = {
+        'commit': current_commit(),
+        'timestamp': datetime.now().isoformat(),
+        'params': {'n_plays': n_plays, 'latency': latency, 'rate_limit_every': rate_limit_every, 'cache': cache_path is not None, 'seed': seed, 'chunk_size': chunk_size},
+        'stages': {}
+    }
+
+    start = time.perf_counter()
+    catalog, plays = synth.generate_dataset(n_plays, seed=seed)
+    results['stages']['generate'] = {'seconds': time.perf_counter() - start, 'tracks': len(catalog['tracks']), 'albums': len(catalog['albums']), 'artists': len(catalog['artists'])}
+
+    with StubSpotifyServer(catalog, plays, latency=latency, rate_limit_every=rate_limit_every) as stub:
+        # Extract: every play through recently played cursor pagination
+        sp = spotipy.Spotify(auth='benchmark-token')
+        sp.prefix = f'{stub.url}/v1/'
+
+        # Streaming: extract, transform, and load overlap chunk by chunk
+        if chunk_size is not None:
+            client = sc.SpotifyApiClient(sc.TokenHolder(token='benchmark-token'), base_url=f'{stub.url}/v1', backoff=0.01)
+            cache = mc.MetadataCache(cache_path) if cache_path is not None else None
+            requests_before = stub.request_count
+            start = time.perf_counter()
+            plays_loaded = st.run_streaming_etl(sp, client, **db_params, after=0, chunk_size=chunk_size, cache=cache)
+            results['stages']['stream'] = {
+                'seconds': time.perf_counter() - start,
+                'plays': plays_loaded,
+                'http_requests': stub.request_count - requests_before
+            }
+            if cache is not None:
+                cache.close()
+            client.close()
+            results['rate_limited_responses'] = stub.rate_limited_count
+            return results
+
+        requests_before = stub.request_count
+        start = time.perf_counter()
+        recent_tracks = ex.get_recent_played_tracks_since(sp, after=0, limit=50)
+        results['stages']['extract'] = {
+            'seconds': time.perf_counter() - start,
+            'plays': len(recent_tracks['items']),
+            'http_requests': stub.request_count - requests_before
+        }
+
+        # Transform, including batched artist and album enrichment
+        client = sc.SpotifyApiClient(sc.TokenHolder(token='benchmark-token'), base_url=f'{stub.url}/v1', backoff=0.01)
+        cache = mc.MetadataCache(cache_path) if cache_path is not None else None
+        requests_before = stub.request_count
+        start = time.perf_counter()
+        play_log_fact_table, track_dim_table, artist_dim_table, album_dim_table = tf.create_dataframes(recent_tracks, cache=cache, client=client)
+        results['stages']['transform'] = {
+            'seconds': time.perf_counter() - start,
+            'http_requests': stub.request_count - requests_before,
+            'rows': {
+                'play_log': len(play_log_fact_table),
+                'tracks': len(track_dim_table),
+                'artists': len(artist_dim_table),
+                'albums': len(album_dim_table)
+            }
+        }
+        if cache is not None:
+            results['stages']['transform']['cache'] = cache.stats()
+            cache.close()
+        client.close()
+        results['rate_limited_responses'] = stub.rate_limited_count
+
+    # Load into local PostgreSQL
+    if db_params is not None:
+        start = time.perf_counter()
+        loaded = load.load_update_tables(play_log_fact_table, track_dim_table, artist_dim_table, album_dim_table, **db_params)
+        results['stages']['load'] = {'seconds': time.perf_counter() - start, 'committed': loaded}
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Spotify ETL stages against a stub Spotify API and synthetic data.')
+    parser.add_argument('--plays', type=int, nargs='+', default=[50, 1000, 10000], help='Play counts to benchmark, one run each.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds of latency added to every stub response.')
+    parser.add_argument('--rate-limit-every', type=int, default=0, help='Answer every Nth stub request with 429.')
+    parser.add_argument('--cache-path', default=None, help='MetadataCache path used during transform.')
+    parser.add_argument('--hostname', default=None, help='PostgreSQL host for the load stage. Load is skipped without it.')
+    parser.add_argument('--database', default='spotify_project')
+    parser.add_argument('--username', default='postgres')
+    parser.add_argument('--pwd', default='')
+    parser.add_argument('--port-id', default=5432)
+    parser.add_argument('--chunk-size', type=int, default=None, help='Benchmark the streaming pipeline with this chunk size. Requires --hostname.')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file the results are written to.')
+    args = parser.parse_args()
+    if args.chunk_size is not None and args.hostname is None:
+        parser.error('--chunk-size requires --hostname, the streaming pipeline loads every chunk')
+
+    db_params = None
+    if args.hostname is not None:
+        db_params = {'hostname': args.hostname, 'database': args.database, 'username': args.username, 'pwd': args.pwd, 'port_id': args.port_id}
+
+    runs = [run_benchmark(n_plays, args.latency, args.rate_limit_every, db_params, args.cache_path, chunk_size=args.chunk_size) for n_plays in args.plays]
+    with open(args.output, 'w') as file:
+        json.dump(runs, file, indent=2)
+    for run in runs:
+        print(run['params']['n_plays'], {stage: round(metrics['seconds'], 3) for stage, metrics in run['stages'].items()})
@@ -1,53 +1,184 @@
 import datetime
+import multi_user_etl as multi
 import pandas as pd
+import pipeline_metrics as pm
 import psycopg2
 import smtplib
 import tabulate
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from smtplib import SMTP
+from string import Template
 
 
-def query_to_df(cur, sql_fxn, cols):
+# For weekly listening information in tabular form (pd DF)
+# Dictionary with function name and cols
+TABULAR_SECTIONS = {
+    'most_played_songs': ['Song Name', 'Times Played'],
+    'top_5_most_popular_songs': ['Song Name'],
+    'longest_songs': ['Song Name', 'Track Length (Minutes)'],
+    'songs_played_by_decade': ['Decade', 'Songs Played'],
+    'average_features_by_day': ['Day', 'Energy', 'Danceability', 'Valence', 'Tempo (BPM)'],
+    'most_popular_artists': ['Artist Name'],
+    'most_frequently_played_artist': ['Artist Name', 'Times Played'],
+    'artist_with_most_followers': ['Artist Name', 'Followers'],
+    'most_popular_albums': ['Album Name'],
+    'most_frequently_played_album': ['Album Name', 'Times Played']
+}
+
+# Email heading of each tabular section
+SECTION_HEADINGS = {
+    'most_played_songs': 'Your most played songs were:',
+    'top_5_most_popular_songs': 'The top 5 most popular songs you played were:',
+    'longest_songs': 'The longest songs you listened to were:',
+    'songs_played_by_decade': 'Your song release date distributed by decade looks like:',
+    'average_features_by_day': 'The average energy, danceability, valence and tempo of your songs by day were:',
+    'most_popular_artists': 'The most popular artists you listened to were:',
+    'most_frequently_played_artist': 'Your most played artists were:',
+    'artist_with_most_followers': 'The artist you listened to with the most followers was:',
+    'most_popular_albums': 'The most popular albums you listened to were:',
+    'most_frequently_played_album': 'Your most played album was:'
+}
+
+# Plain text body, compiled once and filled in per recipient
+TEXT_TEMPLATE = Template('''\
+    Here is your weekly Spotify activity recap for $week!
+
+    You spent a total of $weekly_total_time hours listening to Spotify.
+    You listened to the most songs on $day_most_played, with a total of $day_most_played_count songs played.
+
+    Below are tables of your weekly listening activities.
+    ''')
+
+# Plain text body for a week without plays, sent in place of the metrics and tables
+EMPTY_TEXT_TEMPLATE = Template('''\
+    Here is your weekly Spotify activity recap for $week!
+
+    You did not listen to Spotify this week, so there are no listening activities to show.
+    ''')
+
+# HTML body, one heading and table placeholder per tabular section
+HTML_TEMPLATE = Template('''\
+    <html>
+    <body>
+''' + ''.join(f'''\
+        <h4>
+        {heading}
+        </h4>
+        <p>
+        ${section}
+        </p>
+''' for section, heading in SECTION_HEADINGS.items()) + '''\
+    </body>
+    </html>
+    ''')
+
+
+def fetch_weekly_report(cur, period_start=None, period_end=None, user_label=None):
     '''
-    Automate execution of SQL function that returns a table and creates a Pandas DataFrame. 
+    Calls cached_report SQL function, which returns every metric of a user and period as one JSON object, served from the report_cache table or computed by weekly_report in one round trip.
+    Returns total hours played, row of (day, songs played) for the day with the most songs played, and dictionary of Pandas DataFrames keyed by TABULAR_SECTIONS name.
 
     ARGUMENTS:
         cur: Psycopg2 cursor
-        sql_fxns: Name of SQL function to execute.
-        cols: Name of columns for Pandas DataFrame creation of returned results.
+        period_start: Optional first play date of the period, inclusive. Defaults to the start of the last week.
+        period_end: Optional last play date of the period, exclusive. Defaults to tomorrow.
+        user_label: Optional label of the user whose plays are reported, as returned by multi_user_etl.user_label. Defaults to the user single-user loads store plays under.
     '''
-    data = []
-    cur.callproc(sql_fxn)
-    for row in cur.fetchall():
-        # Convert value to string to avoid SQL type constraints returned along with value
-        data.append([str(val) for val in row])
-    return pd.DataFrame(data, columns=cols)
+    # Arguments left out fall back to the SQL function defaults
+    period = {name: value for name, value in [('period_start', period_start), ('period_end', period_end), ('for_user', user_label)] if value is not None}
+    start = time.perf_counter()
+    cur.execute(f"SELECT cached_report({', '.join(f'{name} => %({name})s' for name in period)})", period)
+    report = cur.fetchone()[0]  # Psycopg2 decodes JSON to Python objects
+    pm.get_recorder().record_statement('weekly_report', time.perf_counter() - start)
+    dfs = {
+        section: pd.DataFrame(report[section] or [], columns=cols)  # Sections with no plays are null
+        for section, cols in TABULAR_SECTIONS.items()
+    }
+    return report['weekly_total_time_played'], report['most_songs_played_in_week'], dfs
 
 
-def generate_weekly_email(sender, recipient, email_username, email_pwd, hostname, database, username, pwd, port_id):
+def week_string(today=None):
     '''
-    Calls SQL functions in database to generate weekly summary statistics for Spotify listening activities. Sends email message with SMTP protocol via Gmail.
+    Returns the "MM-DD-YYYY - MM-DD-YYYY" string of the week ending today, used in the email subject and body.
+
+    ARGUMENTS:
+        today: Optional date the week ends on. Defaults to today.
+    '''
+    today = today or datetime.datetime.today().date()
+    return f'{(today - datetime.timedelta(days=6)).strftime("%m-%d-%Y")} - {today.strftime("%m-%d-%Y")}'
+
+
+def period_string(period_start, period_end=None):
+    '''
+    Returns the "MM-DD-YYYY - MM-DD-YYYY" string of the play dates in [period_start, period_end), used in place of week_string for other periods.
+
+    ARGUMENTS:
+        period_start: First play date of the period, inclusive.
+        period_end: Optional last play date of the period, exclusive. Defaults to tomorrow.
+    '''
+    period_end = period_end or datetime.datetime.today().date() + datetime.timedelta(days=1)
+    return f'{period_start.strftime("%m-%d-%Y")} - {(period_end - datetime.timedelta(days=1)).strftime("%m-%d-%Y")}'
+
+
+def render_weekly_email(sender, recipient, week, weekly_total_time, row, dfs):
+    '''
+    Fills the precompiled text and HTML templates with one user's weekly metrics. A week without plays gets the plain text empty-week message instead. Returns MIMEMultipart message.
 
     ARGUMENTS:
         sender: Email used for sending Spotify Weekly Recap statistics.
         recipient: Email for receiving Spotify Weekly Recap statistics.
-        email_username: Username for SMTP access to email.
-        email_pwd: Password for SMTP access to email.
+        week: Week string as returned by week_string.
+        weekly_total_time: Weekly total hours played, None for a week without plays.
+        row: Row of (day, songs played) for the day with the most songs played, None for a week without plays.
+        dfs: Dictionary of Pandas DataFrames keyed by TABULAR_SECTIONS name, as returned by fetch_weekly_report.
+    '''
+    # Email content
+    msg = MIMEMultipart()
+    msg['Subject'] = f'Your Spotify Weekly Recap ({week})'
+    msg['From'] = sender
+    msg['To'] = recipient
+
+    # Metrics are null and tables empty when nothing was played
+    if weekly_total_time is None or not row:
+        msg.attach(MIMEText(EMPTY_TEXT_TEMPLATE.substitute(week=week), 'plain'))
+        return msg
+
+    text = TEXT_TEMPLATE.substitute(
+        week=week,
+        weekly_total_time=float(weekly_total_time),
+        day_most_played=row[0],
+        day_most_played_count=row[1]
+    )
+    html = HTML_TEMPLATE.substitute({
+        section: tabulate.tabulate(dfs[section], headers='keys', tablefmt='html', showindex=False)
+        for section in TABULAR_SECTIONS
+    })
+
+    # Attaching message portions to message multipart object
+    msg.attach(MIMEText(text, 'plain'))
+    msg.attach(MIMEText(html, 'html'))
+    return msg
+
+
+def fetch_user_report(hostname, database, username, pwd, port_id, period_start=None, period_end=None, user_label=None):
+    '''
+    Connects to a user's database and fetches their report of a period, the last week by default. Returns total hours played, row of (day, songs played), and dictionary of Pandas DataFrames, as fetch_weekly_report.
+
+    ARGUMENTS:
         hostname: Host name credential for connecting to PostgreSQL.
         database: Name of database containing artist, album, track tables in PostgreSQL.
         username: Username credential for connecting to desired database in PostgreSQL.
         pwd: Password credential for connecting to desired database in PostgreSQL.
         port_id: Port number for connecting to desired database in PostgreSQL.
+        period_start: Optional first play date of the period, inclusive.
+        period_end: Optional last play date of the period, exclusive.
+        user_label: Optional label of the user whose plays are reported. Defaults to the user single-user loads store plays under.
     '''
-
-    # Connecting to postgreSQL database
-
-    # Instantiating connection as None to avoid errors with close if script executes incorrectly.
     conn = None
-
-    # Creating connection object, opens database connection
     try:
         with psycopg2.connect(
             host=hostname,
@@ -56,134 +187,179 @@ def generate_weekly_email(sender, recipient, email_username, email_pwd, hostname
             password=pwd,
             port=port_id
         ) as conn:
-            # cursor for storing return values
-            with conn.cursor() as cur:  # Cursor closes at end of with statement block
-                # Getting weekly metrics, tables
-
-                # Total weekly listening time
-                cur.callproc('weekly_total_time_played')
-                weekly_total_time = float(cur.fetchone()[0])
-
-                # Day with most songs played
-                cur.callproc('most_songs_played_in_week')
-                row = cur.fetchone()
-                day_most_played = row[0]
-                day_most_played_count = row[1]
-
-                # For weekly listening information in tabular form (pd DF)
-                # Dictionary with function name and cols
-                tabular_info = {
-                    'most_played_songs': ['Song Name', 'Times Played'],
-                    'top_5_most_popular_songs': ['Song Name'],
-                    'longest_songs': ['Song Name', 'Track Length (Minutes)'],
-                    'songs_played_by_decade': ['Decade', 'Songs Played'],
-                    'most_popular_artists': ['Artist Name'],
-                    'most_frequently_played_artist': ['Artist Name', 'Times Played'],
-                    'artist_with_most_followers': ['Artist Name', 'Followers'],
-                    'most_popular_albums': ['Album Name'],
-                    'most_frequently_played_album': ['Album Name', 'Times Played']
-                }
-                return_dfs = []
-                for function in tabular_info.keys():
-                    return_dfs.append(query_to_df(cur, function, tabular_info[function]))
-                most_played_songs_df, top_5_pop_songs_df, longest_songs_df, decade_dist_df, popular_artists_df, freq_played_artist_df, most_followed_artist_df, most_popular_albums_df, most_freq_played_album_df = return_dfs
+            with conn.cursor() as cur:
+                return fetch_weekly_report(cur, period_start, period_end, user_label)
 
-    except Exception as error:
-        print(error)
-    
-    # Establishing week string
-    week = f'{(datetime.datetime.today().date() - datetime.timedelta(days=6)).strftime("%m-%d-%Y")} - {datetime.datetime.today().date().strftime("%m-%d-%Y")}'
-    
-    # Email content
-    msg = MIMEMultipart()
-    msg['Subject'] = f'Your Spotify Weekly Recap ({week})'
-    msg['From'] = sender
+    finally:
+        if conn is not None:
+            conn.close()
 
 
+def open_smtp_session(smtp_host, smtp_port, email_username=None, email_pwd=None, starttls=True, timeout=30):
+    '''
+    Opens one SMTP connection (EHLO, optional STARTTLS, optional login) to be reused for many messages. Returns smtplib.SMTP object.
 
-    # Plain text body
-    text = f'''\
-    Here is your weekly Spotify activity recap for {week}!
+    ARGUMENTS:
+        smtp_host: SMTP server host.
+        smtp_port: SMTP server port.
+        email_username: Username for SMTP access to email. Login is skipped without it, e.g. for a local debugging server.
+        email_pwd: Password for SMTP access to email.
+        starttls: Whether to upgrade the connection with STARTTLS.
+        timeout: Seconds before a blocking SMTP operation times out.
+    '''
+    mail = SMTP(smtp_host, smtp_port, timeout=timeout)
+    mail.ehlo()
+    if starttls:
+        mail.starttls()
+        mail.ehlo()
+    if email_username:
+        mail.login(email_username, email_pwd)
+    return mail
 
-    You spent a total of {weekly_total_time} hours listening to Spotify.
-    You listened to the most songs on {day_most_played}, with a total of {day_most_played_count} songs played.
 
-    Below are tables of your weekly listening activities.
+def send_email_batch(messages, smtp_host='smtp.gmail.com', smtp_port=587, email_username=None, email_pwd=None, starttls=True, throttle=0.0, max_retries=3, backoff=1.0):
     '''
-    # HTML Body
-    html = f'''\
-    <html>
-    <body>
-        <h4>
-        Your most played songs were:
-        </h4>
-        <p>
-        {tabulate.tabulate(most_played_songs_df, headers='keys', tablefmt='html', showindex=False)}
-        </p>
-        <h4>
-        The top 5 most popular songs you played were:
-        </h4>
-        <p>
-        {tabulate.tabulate(top_5_pop_songs_df, headers='keys', tablefmt='html', showindex=False)}
-        </p>
-        <h4>
-        The longest songs you listened to were:
-        </h4>
-        <p>
-        {tabulate.tabulate(longest_songs_df, headers='keys', tablefmt='html', showindex=False)}
-        </p>
-        <h4>
-        Your song release date distributed by decade looks like:
-        </h4>
-        <p>
-        {tabulate.tabulate(decade_dist_df, headers='keys', tablefmt='html', showindex=False)}
-        </p>
-        <h4>
-        The most popular artists you listened to were:
-        </h4>
-        <p>
-        {tabulate.tabulate(popular_artists_df, headers='keys', tablefmt='html', showindex=False)}
-        </p>
-        <h4>
-        Your most played artists were:
-        </h4>
-        <p>
-        {tabulate.tabulate(freq_played_artist_df, headers='keys', tablefmt='html', showindex=False)}
-        </p>
-        <h4>
-        The artist you listened to with the most followers was:
-        </h4>
-        <p>
-        {tabulate.tabulate(most_followed_artist_df, headers='keys', tablefmt='html', showindex=False)}
-        </p>
-        <h4>
-        The most popular albums you listened to were:
-        </h4>
-        <p>
-        {tabulate.tabulate(most_popular_albums_df, headers='keys', tablefmt='html', showindex=False)}
-        </p>
-        <h4>
-        Your most played album was:
-        </h4>
-        <p>
-        {tabulate.tabulate(most_freq_played_album_df, headers='keys', tablefmt='html', showindex=False)}
-        </p>
-    </body>
-    </html>
+    Sends many messages over one authenticated SMTP session. Temporary failures (4xx replies, dropped connections) are retried per message with backoff, reconnecting if needed. Permanent failures are recorded and the batch carries on.
+    Returns list of error message, one per message in the same order, None for messages that were sent.
+
+    ARGUMENTS:
+        messages: List of MIMEMultipart messages with From and To headers, as returned by render_weekly_email.
+        smtp_host: SMTP server host.
+        smtp_port: SMTP server port.
+        email_username: Username for SMTP access to email. Login is skipped without it.
+        email_pwd: Password for SMTP access to email.
+        starttls: Whether to upgrade the connection with STARTTLS.
+        throttle: Minimum seconds between two sends, to stay under the provider's sending rate.
+        max_retries: Maximum number of retries per message for temporary failures.
+        backoff: Base seconds for exponential backoff between retries.
     '''
+    results = []
+    mail = None
+    last_sent = None
+    try:
+        for msg in messages:
+            recipient = msg['To']
+            attempt = 0
+            while True:
+                if throttle and last_sent is not None:
+                    time.sleep(max(0.0, last_sent + throttle - time.perf_counter()))
+                try:
+                    if mail is None:
+                        mail = open_smtp_session(smtp_host, smtp_port, email_username, email_pwd, starttls)
+                    start = time.perf_counter()
+                    mail.sendmail(msg['From'], recipient, msg.as_string())
+                    last_sent = time.perf_counter()
+                    pm.get_recorder().record_statement('smtp send', last_sent - start)
+                    results.append(None)
+                    break
+                except smtplib.SMTPRecipientsRefused as error:
+                    # Only 4xx replies are temporary
+                    temporary = all(400 <= code < 500 for code, _ in error.recipients.values())
+                    failure = str(error)
+                except smtplib.SMTPResponseException as error:
+                    temporary = 400 <= error.smtp_code < 500
+                    failure = str(error)
+                except (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError) as error:
+                    # Dropped connection, reconnect on retry
+                    mail = None
+                    temporary = True
+                    failure = str(error)
+                except smtplib.SMTPException as error:
+                    temporary = False
+                    failure = str(error)
+                if not temporary or attempt >= max_retries:
+                    results.append(failure)
+                    break
+                time.sleep(backoff * 2 ** attempt)
+                attempt += 1
 
-    # Defining multipart message portions
-    part1 = MIMEText(text, 'plain')
-    part2 = MIMEText(html, 'html')
+    finally:
+        if mail is not None:
+            try:
+                mail.quit()
+            except smtplib.SMTPException:
+                pass
 
-    # Attaching message portions to message multipart object
-    msg.attach(part1)
-    msg.attach(part2)
+    return results
 
-    # Email protocols and credentials
-    mail = smtplib.SMTP('smtp.gmail.com', 587)
-    mail.ehlo()
-    mail.starttls()
-    mail.login(email_username, email_pwd)
-    mail.sendmail(sender, recipient, msg.as_string())
-    mail.quit()
\ No newline at end of file
+
+def generate_weekly_emails(users, sender, email_username, email_pwd, smtp_host='smtp.gmail.com', smtp_port=587, starttls=True, max_workers=4, throttle=0.0, max_retries=3, period_start=None, period_end=None):
+    '''
+    Batch mode of generate_weekly_email. Fetches and renders every user's weekly recap in parallel workers, then sends the whole batch over one SMTP session.
+    Users sharing a database each get the report of their own plays. Returns list of (recipient, error message) tuples, one per user with an email in the order given, error message None for recaps that were sent.
+
+    ARGUMENTS:
+        users: List of credential dictionaries with email, hostname, database, username, pwd, port_id, as returned by multi_user_etl.read_user_credentials.
+        sender: Email used for sending Spotify Weekly Recap statistics.
+        email_username: Username for SMTP access to email.
+        email_pwd: Password for SMTP access to email.
+        smtp_host: SMTP server host. Point at a local debugging server for testing.
+        smtp_port: SMTP server port.
+        starttls: Whether to upgrade the connection with STARTTLS.
+        max_workers: Maximum number of reports fetched and rendered at once.
+        throttle: Minimum seconds between two sends.
+        max_retries: Maximum number of retries per message for temporary failures.
+        period_start: Optional first play date of the recap, inclusive, e.g. for a past week or a year in review. Defaults to the last week.
+        period_end: Optional last play date of the recap, exclusive.
+    '''
+    week = week_string() if period_start is None else period_string(period_start, period_end)
+
+    users = [user for user in users if user.get('email')]
+    results = [None] * len(users)
+    messages = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        reports = [
+            executor.submit(fetch_user_report, user['hostname'], user['database'], user['username'], user['pwd'], user['port_id'], period_start, period_end, multi.user_label(user))
+            for user in users
+        ]
+        renders = [
+            executor.submit(lambda user, report: render_weekly_email(sender, user['email'], week, *report.result()), user, report)
+            for user, report in zip(users, reports)
+        ]
+        # Positions of the rendered messages, users may share an email
+        sent = []
+        for position, future in enumerate(renders):
+            try:
+                messages.append(future.result())
+                sent.append(position)
+            except Exception as error:
+                results[position] = str(error)
+
+    for position, error in zip(sent, send_email_batch(messages, smtp_host, smtp_port, email_username, email_pwd, starttls, throttle, max_retries)):
+        results[position] = error
+    return [(user['email'], error) for user, error in zip(users, results)]
+    return results
+
+
+def generate_weekly_email(sender, recipient, email_username, email_pwd, hostname, database, username, pwd, port_id, smtp_host='smtp.gmail.com', smtp_port=587, starttls=True, period_start=None, period_end=None):
+    '''
+    Calls SQL functions in database to generate weekly summary statistics for Spotify listening activities. Sends email message with SMTP protocol via Gmail.
+
+    ARGUMENTS:
+        sender: Email used for sending Spotify Weekly Recap statistics.
+        recipient: Email for receiving Spotify Weekly Recap statistics.
+        email_username: Username for SMTP access to email.
+        email_pwd: Password for SMTP access to email.
+        hostname: Host name credential for connecting to PostgreSQL.
+        database: Name of database containing artist, album, track tables in PostgreSQL.
+        username: Username credential for connecting to desired database in PostgreSQL.
+        pwd: Password credential for connecting to desired database in PostgreSQL.
+        port_id: Port number for connecting to desired database in PostgreSQL.
+        smtp_host: SMTP server host.
+        smtp_port: SMTP server port.
+        starttls: Whether to upgrade the connection with STARTTLS.
+        period_start: Optional first play date of the recap, inclusive. Defaults to the last week.
+        period_end: Optional last play date of the recap, exclusive.
+    '''
+    try:
+        # Getting weekly metrics, tables in a single round trip, served from report_cache on re-sends
+        weekly_total_time, row, return_dfs = fetch_user_report(hostname, database, username, pwd, port_id, period_start, period_end)
+    except Exception as error:
+        print(error)
+        return
+
+    week = week_string() if period_start is None else period_string(period_start, period_end)
+    msg = render_weekly_email(sender, recipient, week, weekly_total_time, row, return_dfs)
+    error = send_email_batch([msg], smtp_host, smtp_port, email_username, email_pwd, starttls)[0]
+    if error is not None:
+        raise smtplib.SMTPException(error)
@@ -1,10 +1,12 @@
-import pandas as pd
-import requests
+import dateutil.parser as dp
+import pipeline_metrics as pm
 import spotipy
+import time
+from datetime import datetime, timedelta, timezone
 from spotipy.oauth2 import SpotifyOAuth
 
 # Create spotipy client object
-def create_spotipy_client(client_id, client_secret, redirect_uri, scope):
+def create_spotipy_client(client_id, client_secret, redirect_uri, scope, cache_path=None):
     '''
     Creates spotipy client object with authorization access to user's designated Spotipy application. Returns spotipy client object.
 
@@ -13,18 +15,40 @@ def create_spotipy_client(client_id, client_secret, redirect_uri, scope):
         client_secret: User's app client_secret as seen via Spotify dashboard.
         redirect_uri: Redirect URL used for acquiring authorization code.
         scope: Scope of accessibility for user's account.
+        cache_path: Optional path of spotipy token cache file. Each account needs its own when running several users. Defaults to spotipy's .cache file.
     '''
     sp = spotipy.Spotify(
         auth_manager=SpotifyOAuth(
             client_id=client_id,
             client_secret=client_secret,
             redirect_uri=redirect_uri,
-            scope=scope
+            scope=scope,
+            cache_path=cache_path
         )
     )
     return sp
 
 
+# Time a recently played request made through spotipy and record it with the direct API requests
+def timed_recently_played(request, *args, **kwargs):
+    '''
+    Calls a spotipy recently played request (current_user_recently_played or next) and records its latency and HTTP status in the pipeline metrics under /me/player/recently-played.
+    Spotipy raises SpotifyException for error responses, its http_status is recorded before the exception is re-raised. Returns the JSON page returned by the request.
+
+    ARGUMENTS:
+        request: Spotipy client method to call.
+        args, kwargs: Arguments passed through to request.
+    '''
+    start = time.perf_counter()
+    try:
+        page = request(*args, **kwargs)
+    except spotipy.SpotifyException as error:
+        pm.get_recorder().record_http('/me/player/recently-played', error.http_status, time.perf_counter() - start)
+        raise
+    pm.get_recorder().record_http('/me/player/recently-played', 200, time.perf_counter() - start)
+    return page
+
+
 # Request user's most recently played songs
 def get_recent_played_tracks(spotipy_client, limit):
     '''
@@ -34,54 +58,219 @@ def get_recent_played_tracks(spotipy_client, limit):
         spotipy_client: Spotipy client object.
         limit: The number of songs recently played that the user would like to return.
     '''
-    return spotipy_client.current_user_recently_played(limit=limit)
-    
+    return timed_recently_played(spotipy_client.current_user_recently_played, limit=limit)
+
+
+# Convert Spotify played_at timestamp to UNIX milliseconds, the unit of the recently played cursors
+def played_at_to_unix_ms(played_at):
+    '''
+    Converts Standard ISO 8601 played_at timestamp returned by Spotify to UNIX milliseconds. Returns integer.
+
+    ARGUMENTS:
+        played_at: ISO 8601 timestamp string (e.g. '2023-03-11T18:22:33.123Z').
+    '''
+    return (dp.isoparse(played_at) - datetime(1970, 1, 1, tzinfo=timezone.utc)) // timedelta(milliseconds=1)
+
+
+# Latest play in a recently played JSON object, used as the next run's watermark
+def latest_played_at(recent_tracks):
+    '''
+    Returns UNIX milliseconds of the latest play in recent_tracks, or None if there are no plays.
+
+    ARGUMENTS:
+        recent_tracks: JSON object returned by API request for user's recent songs played from Spotify.
+    '''
+    if not recent_tracks['items']:
+        return None
+    return max(played_at_to_unix_ms(item['played_at']) for item in recent_tracks['items'])
+
+
+# Request only plays newer than a watermark, following pagination
+def get_recent_played_tracks_since(spotipy_client, after=None, limit=50, landing_zone=None):
+    '''
+    Gets songs played after the given watermark from user's Spotify account, following the cursors / next pagination until no newer plays remain.
+    Returns JSON object shaped like get_recent_played_tracks with new items from every page, duplicates removed.
+
+    ARGUMENTS:
+        spotipy_client: Spotipy client object.
+        after: UNIX milliseconds of the latest play already loaded. None returns the most recent page only.
+        limit: The number of songs returned per page (maximum 50).
+        landing_zone: Optional LandingZone the raw items are appended to.
+    '''
+    page = timed_recently_played(spotipy_client.current_user_recently_played, limit=limit, after=after)
+    if after is None:
+        if landing_zone is not None:
+            landing_zone.write_recently_played(page['items'])
+        return page
+
+    items = []
+    seen = set()
+    while page is not None:
+        new_items = [item for item in page['items'] if played_at_to_unix_ms(item['played_at']) > after]
+        for item in new_items:
+            key = (item['played_at'], item['track']['id'])
+            if key not in seen:
+                seen.add(key)
+                items.append(item)
+        # Stop once a page reaches plays at or before the watermark
+        if not new_items or len(new_items) < len(page['items']) or page['next'] is None:
+            break
+        page = timed_recently_played(spotipy_client.next, page)
+
+    if landing_zone is not None:
+        landing_zone.write_recently_played(items)
+    return {'items': items, 'cursors': page['cursors'] if page is not None else None}
+
+
+# Stream plays page by page, following pagination
+def iter_recent_played_pages(spotipy_client, after=None, limit=50, landing_zone=None):
+    '''
+    Generator version of get_recent_played_tracks_since for the streaming pipeline. Yields the new items of each page as soon as the page arrives, so downstream stages can start before the extract finishes.
+    Without a watermark, pages are followed back in time until Spotify returns no more.
+
+    ARGUMENTS:
+        spotipy_client: Spotipy client object.
+        after: Optional UNIX milliseconds of the latest play already loaded.
+        limit: The number of songs returned per page (maximum 50).
+        landing_zone: Optional LandingZone the raw items of every page are appended to.
+    '''
+    page = timed_recently_played(spotipy_client.current_user_recently_played, limit=limit, after=after)
+    previous_keys = set()
+    while page is not None:
+        new_items = page['items'] if after is None else [item for item in page['items'] if played_at_to_unix_ms(item['played_at']) > after]
+        # Pages can overlap at their boundary
+        page_keys = {(item['played_at'], item['track']['id']) for item in new_items}
+        new_items = [item for item in new_items if (item['played_at'], item['track']['id']) not in previous_keys]
+        previous_keys = page_keys
+        if landing_zone is not None:
+            landing_zone.write_recently_played(new_items)
+        if new_items:
+            yield new_items
+        # Stop once a page reaches plays at or before the watermark
+        if (after is not None and len(page_keys) < len(page['items'])) or not page['items'] or page['next'] is None:
+            break
+        page = timed_recently_played(spotipy_client.next, page)
 
-# Directly acquire access token for direct Spotify Web API functionality. For this project, this is used for additional artist and album details such as popularity.
-def get_access_token():
+
+# Split a list of IDs into chunks no larger than the multi-ID endpoint limit
+def chunk_ids(ids, chunk_size):
     '''
-    Uses Spotipy customized cache handler to acquire access token directly. Returns access token.
+    Splits list of Spotify IDs into consecutive chunks of at most chunk_size IDs. Returns list of ID lists.
 
     ARGUMENTS:
-        None
+        ids: List of Spotify IDs.
+        chunk_size: Maximum number of IDs per chunk.
     '''
-    handler = spotipy.CacheFileHandler()
-    return handler.get_cached_token()['access_token']
+    return [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
 
 
-# Access additional details of specified track's artist and album
-def additional_info(token, artist_id, album_id):
+# Access additional details of many artists and albums with the multi-ID Spotify endpoints
+def batch_additional_info(client, artist_ids, album_ids, cache=None):
     '''
-    Interacts directly with Spotify Web API using access token associated with spotipy client object to acquire additional information for albums.
-    Returns artist followers, artist popularity, album popularity, album total tracks, and album release date.
+    Interacts directly with Spotify Web API through a shared SpotifyApiClient to acquire additional information for many artists and albums at once.
+    Distinct IDs are requested in chunks of 50 artists and 20 albums, the maximum allowed by the /v1/artists and /v1/albums endpoints. Chunk requests run concurrently.
+    Returns dictionary of artist details keyed by artist ID and dictionary of album details keyed by album ID.
 
     ARGUMENTS:
-        token: Access token required to access user's Spotify app.
-        album_id: Unique Spotify ID associated with album of most recent song played.
-        artist_id: Unique Spotify ID associated with artist of most recent song played.
-    '''
-    # Authentican headers
-    auth_headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {token}'
-    }
-
-    # Concatenate specific artist and album IDs to get request URL
-    get_artist_info_url = f'https://api.spotify.com/v1/artists/{artist_id}'
-    get_album_info_url = f'https://api.spotify.com/v1/albums/{album_id}'
-
-    # Returned JSON data on specified artist and album
-    artist_info = requests.get(get_artist_info_url, headers=auth_headers).json()
-    album_info = requests.get(get_album_info_url, headers=auth_headers).json()
-    
+        client: SpotifyApiClient used for Spotify Web API requests.
+        artist_ids: Iterable of Spotify artist IDs. Duplicates are requested once.
+        album_ids: Iterable of Spotify album IDs. Duplicates are requested once.
+        cache: Optional MetadataCache. Fresh cached IDs are not requested and fetched IDs are stored with their raw API objects. When client lands its responses in a landing zone, the raw objects of cache hits are landed too.
+    '''
+    # Distinct IDs, order preserved
+    artist_ids = list(dict.fromkeys(artist_ids))
+    album_ids = list(dict.fromkeys(album_ids))
+
+    # Serve fresh IDs from cache, only request the rest
+    cached_artist_info, cached_album_info = {}, {}
+    landing_zone = getattr(client, 'landing_zone', None)
+    if cache is not None:
+        # Every object has to be landed for the landing zone to be replayable, so hits without a raw object are requested again
+        cached_artist_info, artist_ids = cache.get_many('artist', artist_ids, require_payload=landing_zone is not None)
+        cached_album_info, album_ids = cache.get_many('album', album_ids, require_payload=landing_zone is not None)
+        if landing_zone is not None:
+            landing_zone.write_objects('artists', list(cache.get_payloads('artist', cached_artist_info).values()))
+            landing_zone.write_objects('albums', list(cache.get_payloads('album', cached_album_info).values()))
+
+    # Artist and album chunk requests sent together so they overlap
+    artist_requests = [('/artists', {'ids': ','.join(ids)}) for ids in chunk_ids(artist_ids, 50)]
+    album_requests = [('/albums', {'ids': ','.join(ids)}) for ids in chunk_ids(album_ids, 20)]
+    responses = client.get_many(artist_requests + album_requests)
+
     # Additional artist metrics
-    artist_followers = artist_info['followers']['total']
-    artist_popularity = artist_info['popularity']
+    artist_info, artist_objects = {}, {}
+    for response in responses[:len(artist_requests)]:
+        for artist in response['artists']:
+            if artist is None:  # Unknown IDs are returned as null
+                continue
+            artist_objects[artist['id']] = artist
+            artist_info[artist['id']] = {
+                'artist_followers': artist['followers']['total'],
+                'artist_popularity': artist['popularity']
+            }
 
     # Additional album metrics
-    album_popularity = album_info['popularity']
-    album_total_tracks = album_info['total_tracks']
-    album_release_date = album_info['release_date']
+    album_info, album_objects = {}, {}
+    for response in responses[len(artist_requests):]:
+        for album in response['albums']:
+            if album is None:  # Unknown IDs are returned as null
+                continue
+            album_objects[album['id']] = album
+            album_info[album['id']] = {
+                'album_popularity': album['popularity'],
+                'album_total_tracks': album['total_tracks'],
+                'album_release_date': album['release_date']
+            }
+
+    # Store newly fetched metadata
+    if cache is not None:
+        cache.put_many('artist', artist_info, payloads=artist_objects)
+        cache.put_many('album', album_info, payloads=album_objects)
 
     # Returned values
-    return artist_followers, artist_popularity, album_popularity, album_total_tracks, album_release_date
\ No newline at end of file
+    return {**cached_artist_info, **artist_info}, {**cached_album_info, **album_info}
+
+
+# Access full track objects for many tracks with the multi-ID Spotify endpoint
+def batch_track_info(client, track_ids):
+    '''
+    Interacts directly with Spotify Web API through a shared SpotifyApiClient to acquire full track objects (with album and artists) for many tracks at once.
+    Distinct IDs are requested concurrently in chunks of 50, the maximum allowed by the /v1/tracks endpoint.
+    Returns dictionary of track objects keyed by track ID, shaped like the track objects in get_recent_played_tracks items.
+
+    ARGUMENTS:
+        client: SpotifyApiClient used for Spotify Web API requests.
+        track_ids: Iterable of Spotify track IDs. Duplicates are requested once.
+    '''
+    track_ids = list(dict.fromkeys(track_ids))
+    responses = client.get_many([('/tracks', {'ids': ','.join(ids)}) for ids in chunk_ids(track_ids, 50)])
+
+    track_info = {}
+    for response in responses:
+        for track in response['tracks']:
+            if track is None:  # Unknown IDs are returned as null
+                continue
+            track_info[track['id']] = track
+    return track_info
+
+
+# Access audio features (tempo, energy, danceability, ...) of many tracks with the multi-ID Spotify endpoint
+def batch_audio_features(client, track_ids):
+    '''
+    Interacts directly with Spotify Web API through a shared SpotifyApiClient to acquire audio features for many tracks at once.
+    Distinct IDs are requested concurrently in chunks of 100, the maximum allowed by the /v1/audio-features endpoint.
+    Returns dictionary of audio features objects keyed by track ID. Tracks without audio features are mapped to None.
+
+    ARGUMENTS:
+        client: SpotifyApiClient used for Spotify Web API requests.
+        track_ids: Iterable of Spotify track IDs. Duplicates are requested once.
+    '''
+    track_ids = list(dict.fromkeys(track_ids))
+    responses = client.get_many([('/audio-features', {'ids': ','.join(ids)}) for ids in chunk_ids(track_ids, 100)])
+
+    # Results are in request order, null where Spotify has no features for a track
+    features = {}
+    for ids, response in zip(chunk_ids(track_ids, 100), responses):
+        for track_id, track_features in zip(ids, response['audio_features']):
+            features[track_id] = track_features
+    return features
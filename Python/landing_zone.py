@@ -0,0 +1,168 @@
+import glob
+import json
+import os
+import pandas as pd
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+
+class LandingZone:
+    '''
+    Append-only landing zone of raw Spotify API payloads, stored as zstd-compressed Parquet files partitioned by date.
+    Recently played items are partitioned by the UTC date they were played, artist / album / track objects by the UTC date they were fetched. Files are never rewritten, so a payload is kept exactly as the API returned it.
+
+    ARGUMENTS:
+        root: Directory of the landing zone. Created if it does not exist.
+    '''
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _write(self, dataset, date, df):
+        directory = os.path.join(self.root, dataset, f'date={date}')
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'part-{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}.parquet')
+        # Written under a temporary name first so readers never see a partial file
+        df.to_parquet(path + '.tmp', compression='zstd', index=False)
+        os.replace(path + '.tmp', path)
+
+    def _read(self, dataset, start=None, end=None):
+        frames = []
+        for directory in sorted(glob.glob(os.path.join(self.root, dataset, 'date=*'))):
+            date = directory.rsplit('date=', 1)[-1]
+            if (start is not None and date < str(start)) or (end is not None and date >= str(end)):
+                continue
+            frames += [pd.read_parquet(path) for path in sorted(glob.glob(os.path.join(directory, '*.parquet')))]
+        return pd.concat(frames, ignore_index=True) if frames else None
+
+    def partition_dates(self, dataset):
+        '''
+        Returns sorted list of partition date strings (YYYY-MM-DD) of a dataset.
+
+        ARGUMENTS:
+            dataset: 'recently_played', 'artists', 'albums', or 'tracks'.
+        '''
+        return sorted(directory.rsplit('date=', 1)[-1] for directory in glob.glob(os.path.join(self.root, dataset, 'date=*')))
+
+    def write_recently_played(self, items):
+        '''
+        Appends raw recently played items, one Parquet file per played date.
+
+        ARGUMENTS:
+            items: List of play history objects, as in the items of get_recent_played_tracks.
+        '''
+        if not items:
+            return
+        fetched_at = int(time.time() * 1000)
+        df = pd.DataFrame({
+            'played_at': [item['played_at'] for item in items],
+            'track_id': [item['track']['id'] for item in items],
+            'fetched_at': fetched_at,
+            'payload': [json.dumps(item) for item in items]
+        })
+        for date, partition in df.groupby(df['played_at'].str[:10]):
+            self._write('recently_played', date, partition)
+
+    def write_objects(self, kind, objects):
+        '''
+        Appends raw artist, album, or track objects to today's partition.
+
+        ARGUMENTS:
+            kind: Object kind as named by the API response key, e.g. 'artists'.
+            objects: List of objects. Nulls returned for unknown IDs are skipped.
+        '''
+        objects = [obj for obj in objects if obj is not None]
+        if not objects:
+            return
+        now = datetime.now(timezone.utc)
+        df = pd.DataFrame({
+            'id': [obj['id'] for obj in objects],
+            'fetched_at': int(now.timestamp() * 1000),
+            'payload': [json.dumps(obj) for obj in objects]
+        })
+        self._write(kind, now.date().isoformat(), df)
+
+    def write_responses(self, responses):
+        '''
+        Appends the objects of many multi-ID responses (e.g. {'artists': [...]}), one file per kind.
+
+        ARGUMENTS:
+            responses: List of JSON responses from the multi-ID endpoints.
+        '''
+        objects = {}
+        for response in responses:
+            for kind, values in response.items():
+                if isinstance(values, list):
+                    objects.setdefault(kind, []).extend(values)
+        for kind, values in objects.items():
+            self.write_objects(kind, values)
+
+    def read_recently_played(self, start=None, end=None):
+        '''
+        Reads raw recently played items played on dates in [start, end). Returns JSON object shaped like get_recent_played_tracks, newest play first, duplicates removed.
+
+        ARGUMENTS:
+            start: Optional first UTC date (date or 'YYYY-MM-DD'), inclusive.
+            end: Optional last UTC date (date or 'YYYY-MM-DD'), exclusive.
+        '''
+        df = self._read('recently_played', start, end)
+        if df is None:
+            return {'items': [], 'cursors': None}
+        df = df.drop_duplicates(['played_at', 'track_id'], keep='last').sort_values('played_at', ascending=False)
+        return {'items': [json.loads(payload) for payload in df['payload']], 'cursors': None}
+
+    def read_objects(self, kind):
+        '''
+        Reads the latest fetched raw object of every ID of one kind. Returns dictionary of objects keyed by ID.
+
+        ARGUMENTS:
+            kind: Object kind, e.g. 'artists'.
+        '''
+        df = self._read(kind)
+        if df is None:
+            return {}
+        df = df.sort_values('fetched_at').drop_duplicates('id', keep='last')
+        return {spotify_id: json.loads(payload) for spotify_id, payload in zip(df['id'], df['payload'])}
+
+
+class ReplayClient:
+    '''
+    Stand-in for SpotifyApiClient that answers multi-ID requests from a LandingZone instead of the network, so create_dataframes can run offline.
+    Each kind is read once on first use. IDs never landed are returned as null, like unknown IDs from the API.
+
+    ARGUMENTS:
+        landing_zone: LandingZone to read objects from.
+    '''
+    def __init__(self, landing_zone):
+        self.landing_zone = landing_zone
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def get(self, path, params=None):
+        '''
+        Answers a multi-ID request (e.g. '/artists' with an ids parameter) from the landing zone. Returns JSON response.
+
+        ARGUMENTS:
+            path: Endpoint path, e.g. '/artists' or '/audio-features'.
+            params: Dictionary with comma separated ids.
+        '''
+        # Objects are landed under the response key, e.g. 'audio_features' for '/audio-features'
+        kind = path.strip('/').replace('-', '_')
+        with self._lock:
+            if kind not in self._objects:
+                self._objects[kind] = self.landing_zone.read_objects(kind)
+        return {kind: [self._objects[kind].get(spotify_id) for spotify_id in params['ids'].split(',')]}
+
+    def get_many(self, requests_to_send):
+        '''
+        Answers many multi-ID requests. Returns list of JSON responses in request order.
+
+        ARGUMENTS:
+            requests_to_send: List of (path, params) tuples.
+        '''
+        return [self.get(path, params) for path, params in requests_to_send]
+
+    def close(self):
+        pass
@@ -1,11 +1,538 @@
+import io
 import pandas as pd
+import pipeline_metrics as pm
 import psycopg2
-from sqlalchemy import create_engine
+import threading
+import time
+from psycopg2.pool import ThreadedConnectionPool
 
 
-def load_update_tables(play_log_fact_table, track_dim_table, artist_dim_table, album_dim_table, hostname, database, username, pwd, port_id):
+# User whose plays single-user loads and reports use, existing history belongs to it after the 008_user_scope migration
+DEFAULT_USER_LABEL = 'default'
+
+# Wraps the play_log insert so only newly inserted plays are counted into the daily rollup tables and invalidate the cached reports of their periods
+ROLLUP_NEW_PLAYS_SQL = '''
+    WITH new_plays AS (
+        {insert_plays_sql}
+        RETURNING user_sk, track_sk, artist_sk, album_sk, (played_at AT TIME ZONE 'US/Pacific')::DATE play_date
+    ),
+    plays AS (
+        SELECT N.*, T.track_length_ms
+        FROM
+            new_plays N
+            JOIN tracks T ON
+                N.track_sk = T.track_sk
+    ),
+    track_rollup AS (
+        INSERT INTO daily_track_plays (user_sk, play_date, track_sk, artist_sk, play_count, total_ms)
+        SELECT user_sk, play_date, track_sk, MIN(artist_sk), COUNT(*), SUM(track_length_ms)
+        FROM plays
+        GROUP BY user_sk, play_date, track_sk
+        ON CONFLICT (user_sk, play_date, track_sk) DO UPDATE SET
+            play_count = daily_track_plays.play_count + EXCLUDED.play_count,
+            total_ms = daily_track_plays.total_ms + EXCLUDED.total_ms
+    ),
+    artist_rollup AS (
+        INSERT INTO daily_artist_plays (user_sk, play_date, artist_sk, play_count, total_ms)
+        SELECT user_sk, play_date, artist_sk, COUNT(*), SUM(track_length_ms)
+        FROM plays
+        GROUP BY user_sk, play_date, artist_sk
+        ON CONFLICT (user_sk, play_date, artist_sk) DO UPDATE SET
+            play_count = daily_artist_plays.play_count + EXCLUDED.play_count,
+            total_ms = daily_artist_plays.total_ms + EXCLUDED.total_ms
+    ),
+    album_rollup AS (
+        INSERT INTO daily_album_plays (user_sk, play_date, album_sk, play_count, total_ms)
+        SELECT user_sk, play_date, album_sk, COUNT(*), SUM(track_length_ms)
+        FROM plays
+        GROUP BY user_sk, play_date, album_sk
+        ON CONFLICT (user_sk, play_date, album_sk) DO UPDATE SET
+            play_count = daily_album_plays.play_count + EXCLUDED.play_count,
+            total_ms = daily_album_plays.total_ms + EXCLUDED.total_ms
+    ),
+    report_invalidation AS (
+        DELETE FROM report_cache R
+        USING (SELECT DISTINCT user_sk, play_date FROM new_plays) N
+        WHERE N.user_sk = R.user_sk AND N.play_date >= R.period_start AND N.play_date < R.period_end
+    )
+    SELECT COUNT(*) FROM new_plays
+'''
+
+
+# Staging and upsert settings of each dimension table, keyed by kind
+DIMENSION_TABLES = {
+    'artist': {
+        'data_table': 'artists',
+        'staging_table': 'tmp_artists',
+        'primary_key': 'artist_id',
+        'update_fields': ['artist_followers', 'artist_popularity']
+    },
+    'album': {
+        'data_table': 'albums',
+        'staging_table': 'tmp_albums',
+        'primary_key': 'album_id',
+        'update_fields': ['album_popularity', 'album_total_tracks']
+    },
+    'track': {
+        'data_table': 'tracks',
+        'staging_table': 'tmp_tracks',
+        'primary_key': 'track_id',
+        'update_fields': ['track_popularity']
+    }
+}
+
+class SurrogateKeyCache:
+    '''
+    In-process map of Spotify IDs and user labels to the integer surrogate keys of the tracks, artists, albums, and users tables of one database, so plays can be encoded without looking keys up on every load.
+    Keys are only added after the transaction that looked them up has committed. Surrogate keys never change once assigned, so entries do not expire.
+
+    ARGUMENTS:
+        None
+    '''
+    def __init__(self):
+        self._keys = {'track': {}, 'artist': {}, 'album': {}, 'user': {}}
+        self._lock = threading.Lock()
+
+    def get_many(self, kind, ids):
+        '''
+        Looks up surrogate keys for many IDs of one kind. Returns dictionary of known keys keyed by ID and list of unknown IDs.
+
+        ARGUMENTS:
+            kind: 'track', 'artist', 'album', or 'user'.
+            ids: Iterable of distinct Spotify IDs, or user labels.
+        '''
+        with self._lock:
+            keys = self._keys[kind]
+            found = {spotify_id: keys[spotify_id] for spotify_id in ids if spotify_id in keys}
+        return found, [spotify_id for spotify_id in ids if spotify_id not in found]
+
+    def put_many(self, kind, keys):
+        '''
+        Stores surrogate keys of one kind.
+
+        ARGUMENTS:
+            kind: 'track', 'artist', 'album', or 'user'.
+            keys: Dictionary of surrogate keys keyed by Spotify ID, or user label.
+        '''
+        with self._lock:
+            self._keys[kind].update(keys)
+
+    def clear(self):
+        '''
+        Forgets every key, e.g. after the dimension tables were rebuilt.
+
+        ARGUMENTS:
+            None
+        '''
+        with self._lock:
+            for keys in self._keys.values():
+                keys.clear()
+
+
+class BlockingConnectionPool(ThreadedConnectionPool):
+    '''
+    Thread-safe psycopg2 connection pool whose getconn waits for a free connection instead of raising once maxconn connections are checked out.
+    Holds the SurrogateKeyCache of its database, shared by every load through the pool.
+
+    ARGUMENTS:
+        minconn: Number of connections opened up front.
+        maxconn: Maximum number of connections open at once.
+        **kwargs: Psycopg2 connection arguments (host, dbname, user, password, port).
+    '''
+    def __init__(self, minconn, maxconn, **kwargs):
+        super().__init__(minconn, maxconn, **kwargs)
+        self._available = threading.BoundedSemaphore(maxconn)
+        self.key_cache = SurrogateKeyCache()
+
+    def getconn(self, key=None):
+        self._available.acquire()
+        try:
+            return super().getconn(key)
+        except Exception:
+            self._available.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        super().putconn(conn, key, close)
+        self._available.release()
+
+
+def played_at_watermark_key(user_label=DEFAULT_USER_LABEL):
+    '''
+    Returns the etl_state key of a user's played_at watermark.
+
+    ARGUMENTS:
+        user_label: Label of the user whose plays are loaded.
+    '''
+    return f'played_at_watermark:{user_label}'
+
+
+def read_played_at_watermark(cur, user_label=DEFAULT_USER_LABEL):
+    '''
+    Returns UNIX milliseconds of the latest play of a user loaded into play_log from the etl_state table on an open cursor. Returns None if nothing has been loaded yet.
+
+    ARGUMENTS:
+        cur: Psycopg2 cursor
+        user_label: Label of the user whose plays are loaded.
+    '''
+    cur.execute('SELECT state_value FROM etl_state WHERE state_key = %s', (played_at_watermark_key(user_label),))
+    row = cur.fetchone()
+    return row[0] if row is not None else None
+
+
+def write_played_at_watermark(cur, played_at_watermark, user_label=DEFAULT_USER_LABEL):
+    '''
+    Advances a user's played_at watermark in the etl_state table on an open cursor without committing. The watermark never moves back.
+
+    ARGUMENTS:
+        cur: Psycopg2 cursor
+        played_at_watermark: UNIX milliseconds of the latest play loaded.
+        user_label: Label of the user whose plays are loaded.
+    '''
+    execute_timed(cur, 'etl_state watermark',
+    '''
+        INSERT INTO
+            etl_state (state_key, state_value)
+        VALUES
+            (%s, %s)
+        ON CONFLICT (state_key) DO UPDATE SET
+            state_value = GREATEST(etl_state.state_value, EXCLUDED.state_value)
+        ''',
+        (played_at_watermark_key(user_label), played_at_watermark)
+    )
+
+
+def get_played_at_watermark(hostname, database, username, pwd, port_id, user_label=DEFAULT_USER_LABEL):
+    '''
+    Returns UNIX milliseconds of the latest play of a user loaded into play_log, as recorded in the etl_state table. Returns None if nothing has been loaded yet.
+
+    ARGUMENTS:
+        hostname: Host name credential for connecting to PostgreSQL.
+        database: Name of database containing artist, album, track tables in PostgreSQL.
+        username: Username credential for connecting to desired database in PostgreSQL.
+        pwd: Password credential for connecting to desired database in PostgreSQL.
+        port_id: Port number for connecting to desired database in PostgreSQL.
+        user_label: Label of the user whose plays are loaded.
+    '''
+    conn = None
+    watermark = None
+    try:
+        with psycopg2.connect(
+            host=hostname,
+            dbname=database,
+            user=username,
+            password=pwd,
+            port=port_id
+        ) as conn:
+            with conn.cursor() as cur:
+                watermark = read_played_at_watermark(cur, user_label)
+    except Exception as error:
+        print(error)
+
+    finally:
+        if conn is not None:
+            conn.close()
+    return watermark
+
+
+def execute_timed(cur, name, sql, params=None):
+    '''
+    Executes SQL statement and records its execution time with the active metrics recorder.
+
+    ARGUMENTS:
+        cur: Psycopg2 cursor
+        name: Statement name reported to metrics.
+        sql: SQL statement.
+        params: Optional statement parameters.
+    '''
+    start = time.perf_counter()
+    cur.execute(sql, params)
+    pm.get_recorder().record_statement(name, time.perf_counter() - start)
+
+
+def copy_dataframe(cur, dataframe, table_name):
+    '''
+    Streams DataFrame rows into a table with COPY ... FROM STDIN in CSV format. Missing values are loaded as NULL.
+
+    ARGUMENTS:
+        cur: Psycopg2 cursor
+        dataframe: Pandas DataFrame whose column names match columns of the table.
+        table_name: Name of table to copy rows into.
+    '''
+    buffer = io.StringIO()
+    dataframe.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    start = time.perf_counter()
+    cur.copy_expert(f'COPY {table_name} ({", ".join(dataframe.columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+    pm.get_recorder().record_statement(f'{table_name} copy', time.perf_counter() - start)
+
+
+def lookup_surrogate_keys(cur, kind, ids, key_cache=None):
+    '''
+    Looks up integer surrogate keys of many Spotify IDs of one kind. Keys missing from key_cache are looked up in one query.
+    Returns dictionary of keys keyed by ID and dictionary of newly looked up keys, to be added to key_cache once the transaction commits.
+
+    ARGUMENTS:
+        cur: Psycopg2 cursor
+        kind: 'track', 'artist', or 'album'.
+        ids: Iterable of Spotify IDs.
+        key_cache: Optional SurrogateKeyCache of the database.
+    '''
+    ids = list(dict.fromkeys(ids))
+    found, missing = key_cache.get_many(kind, ids) if key_cache is not None else ({}, ids)
+    new_keys = {}
+    if missing:
+        # Cast keeps the unique index on the CHAR(22) ID usable
+        execute_timed(cur, f'{kind}s key lookup', f'SELECT {kind}_id, {kind}_sk FROM {kind}s WHERE {kind}_id = ANY(%s::CHAR(22)[])', (missing,))
+        new_keys = dict(cur.fetchall())
+    return {**found, **new_keys}, new_keys
+
+
+def lookup_user_key(cur, user_label, key_cache=None):
+    '''
+    Looks up the integer surrogate key of a user, adding the user to the users table on their first load.
+    Returns the key and dictionary of the newly looked up key, to be added to key_cache once the transaction commits.
+
+    ARGUMENTS:
+        cur: Psycopg2 cursor
+        user_label: Label of the user whose plays are loaded.
+        key_cache: Optional SurrogateKeyCache of the database.
+    '''
+    found, _ = key_cache.get_many('user', [user_label]) if key_cache is not None else ({}, None)
+    if user_label in found:
+        return found[user_label], {}
+    # Insert only when missing, a conflicting insert would still use up an identity value
+    execute_timed(cur, 'users key lookup', 'SELECT user_sk FROM users WHERE user_label = %s', (user_label,))
+    row = cur.fetchone()
+    if row is None:
+        # A concurrent first load of the same user makes this insert wait for it and do nothing
+        execute_timed(cur, 'users insert', 'INSERT INTO users (user_label) VALUES (%s) ON CONFLICT (user_label) DO NOTHING', (user_label,))
+        execute_timed(cur, 'users key lookup', 'SELECT user_sk FROM users WHERE user_label = %s', (user_label,))
+        row = cur.fetchone()
+    return row[0], {user_label: row[0]}
+
+
+def encode_play_log(cur, play_log_fact_table, key_cache=None, user_label=DEFAULT_USER_LABEL):
+    '''
+    Replaces the Spotify IDs of the play log with the integer surrogate keys of the tracks, artists, and albums tables, and adds the surrogate key of the user. Keys missing from key_cache are looked up in one query per table.
+    Returns encoded play log DataFrame and dictionary of newly looked up keys per kind, to be added to key_cache once the transaction commits.
+
+    ARGUMENTS:
+        cur: Psycopg2 cursor
+        play_log_fact_table: Dataframe of recent tracks played data with track_id, artist_id, album_id, played_at columns.
+        key_cache: Optional SurrogateKeyCache of the database.
+        user_label: Label of the user whose plays are loaded.
+    '''
+    encoded = pd.DataFrame({'played_at': play_log_fact_table['played_at']})
+    new_keys = {}
+    user_sk, new_keys['user'] = lookup_user_key(cur, user_label, key_cache)
+    encoded['user_sk'] = user_sk
+    for kind in ['track', 'artist', 'album']:
+        keys, new_keys[kind] = lookup_surrogate_keys(cur, kind, play_log_fact_table[f'{kind}_id'], key_cache)
+        encoded[f'{kind}_sk'] = play_log_fact_table[f'{kind}_id'].map(keys)
+    return encoded, new_keys
+
+
+def create_play_log_partitions(cur, play_log_fact_table):
+    '''
+    Creates the monthly play_log partitions (UTC month bounds) of every month in the play log that has none yet, on an open cursor without committing. Existing partitions are skipped without locking.
+    Runs before anything else is written in the load transaction. Creating a partition locks the tables play_log references, which deadlocks against a concurrent load of another user waiting on rows this transaction already wrote.
+
+    ARGUMENTS:
+        cur: Psycopg2 cursor
+        play_log_fact_table: Dataframe of recent tracks played data with played_at column.
+    '''
+    months = sorted(play_log_fact_table['played_at'].dt.tz_convert('UTC').dt.strftime('%Y-%m-01').unique())
+    execute_timed(cur, 'play_log partitions', 'SELECT create_play_log_partition(M.month_start) FROM UNNEST(%s::DATE[]) M (month_start)', (months,))
+
+
+def lock_report_cache(cur):
+    '''
+    Takes the transaction-level lock that cached_report takes in shared mode before storing a report. Held until commit, so no report computed before this load commits can be cached after its invalidation ran.
+
+    ARGUMENTS:
+        cur: Psycopg2 cursor
+    '''
+    execute_timed(cur, 'report_cache lock', "SELECT pg_advisory_xact_lock(hashtext('report_cache'))")
+
+
+def upsert_table(cur, table):
+    '''
+    Streams a DataFrame with COPY into a session-local staging table and inserts new rows / updates non-static fields of its data table in one INSERT ... ON CONFLICT statement.
+    Plays are loaded into their monthly play_log partitions, created beforehand by create_play_log_partitions. Newly inserted plays are added to the daily rollups and invalidate cached reports of their periods. Returns number of rows inserted or updated.
+
+    ARGUMENTS:
+        cur: Psycopg2 cursor
+        table: Dictionary of dataframe, data_table, staging_table, primary_key, and update_fields, e.g. a DIMENSION_TABLES entry with its dataframe.
+    '''
+    is_play_log = table['data_table'] == 'play_log'
+
+    # Session-local staging table, dropped when the transaction commits. Surrogate keys are generated by the data tables only.
+    cur.execute(
+    f'''
+        CREATE TEMP TABLE {table['staging_table']}
+            (LIKE {table['data_table']} INCLUDING DEFAULTS INCLUDING IDENTITY)
+            ON COMMIT DROP
+        '''
+    )
+    copy_dataframe(cur, table['dataframe'], table['staging_table'])
+
+    if is_play_log:
+        lock_report_cache(cur)
+
+    # Insert new data and update non-static fields in one statement. Missing values keep the stored value.
+    columns = ', '.join(table['dataframe'].columns)
+    if table['update_fields']:
+        conflict_action = 'DO UPDATE SET ' + ', '.join(f"{field} = COALESCE(EXCLUDED.{field}, {table['data_table']}.{field})" for field in table['update_fields'])
+    else:
+        conflict_action = 'DO NOTHING'
+    upsert_sql = f'''
+        INSERT INTO
+            {table['data_table']} ({columns})
+        SELECT DISTINCT ON ({table['primary_key']})
+            {columns}
+        FROM
+            {table['staging_table']}
+        ON CONFLICT ({table['primary_key']}) {conflict_action}
+        '''
+    if is_play_log:
+        # Plays actually inserted are added to the daily rollups in the same statement
+        upsert_sql = ROLLUP_NEW_PLAYS_SQL.format(insert_plays_sql=upsert_sql)
+    execute_timed(cur, f"{table['data_table']} upsert", upsert_sql)
+    rows_out = cur.fetchone()[0] if is_play_log else cur.rowcount
+    pm.get_recorder().record_rows(table['data_table'], len(table['dataframe']), rows_out)
+    return rows_out
+
+
+def upsert_dimension_table(cur, kind, dataframe):
+    '''
+    Loads one dimension DataFrame on an open cursor without committing. New rows are appended and non-static fields (e.g. popularity fields) are updated. Returns number of rows inserted or updated.
+
+    ARGUMENTS:
+        cur: Psycopg2 cursor
+        kind: 'artist', 'album', or 'track'.
+        dataframe: DataFrame of the dimension, as returned by transform_data.create_dataframes.
+    '''
+    return upsert_table(cur, {'dataframe': dataframe, **DIMENSION_TABLES[kind]})
+
+
+def upsert_play_log(cur, play_log_fact_table, played_at_watermark=None, key_cache=None, user_label=DEFAULT_USER_LABEL):
+    '''
+    Loads the play log of a user on an open cursor without committing, once its tracks, artists, and albums are loaded. Plays already loaded are skipped, so a load can be repeated.
+    Returns dictionary of surrogate keys looked up per kind, for the caller to add to key_cache after committing.
+
+    ARGUMENTS:
+        cur: Psycopg2 cursor
+        play_log_fact_table: Dataframe of recent tracks played data.
+        played_at_watermark: Optional UNIX milliseconds of the latest play loaded. Stored in etl_state in the same transaction as the load.
+        key_cache: Optional SurrogateKeyCache of the database, used to encode the play log.
+        user_label: Label of the user whose plays are loaded.
+    '''
+    create_play_log_partitions(cur, play_log_fact_table)
+    encoded, new_keys = encode_play_log(cur, play_log_fact_table, key_cache, user_label)
+    upsert_table(cur, {
+        'dataframe': encoded,
+        'data_table': 'play_log',
+        'staging_table': 'tmp_play_log',
+        'primary_key': 'played_at, user_sk, track_sk',  # Natural key of a play, includes partition key
+        'update_fields': []  # Log table has no dynamic fields
+    })
+    # Advance watermark for the next incremental extract
+    if played_at_watermark is not None:
+        write_played_at_watermark(cur, played_at_watermark, user_label)
+    return new_keys
+
+
+def upsert_tables(cur, play_log_fact_table, track_dim_table, artist_dim_table, album_dim_table, played_at_watermark=None, key_cache=None, user_label=DEFAULT_USER_LABEL):
+    '''
+    Executes the statements of load_update_tables on an open cursor without committing, so callers control the connection and transaction.
+    Returns dictionary of surrogate keys looked up per kind, for the caller to add to key_cache after committing.
+
+    ARGUMENTS:
+        cur: Psycopg2 cursor
+        play_log_fact_table: Dataframe of recent tracks played data.
+        track_dim_table: DataFrame of track data from recent tracks played.
+        artist_dim_table: DataFrame of artist data from recent tracks played.
+        album_dim_table: DataFrame of album data from recent tracks played.
+        played_at_watermark: Optional UNIX milliseconds of the latest play loaded. Stored in etl_state in the same transaction as the load.
+        key_cache: Optional SurrogateKeyCache of the database, used to encode the play log.
+        user_label: Label of the user whose plays are loaded.
+    '''
+    # Partitions before any row is written, dimensions next, plays reference them by surrogate key
+    create_play_log_partitions(cur, play_log_fact_table)
+    for kind, dataframe in [('artist', artist_dim_table), ('album', album_dim_table), ('track', track_dim_table)]:
+        upsert_dimension_table(cur, kind, dataframe)
+    return upsert_play_log(cur, play_log_fact_table, played_at_watermark, key_cache, user_label)
+
+def read_tracks_without_features(cur, track_ids=None):
+    '''
+    Returns list of track IDs loaded into the tracks table that have no track_features row yet, on an open cursor.
+
+    ARGUMENTS:
+        cur: Psycopg2 cursor
+        track_ids: Optional iterable of Spotify track IDs to check, e.g. the tracks of the latest load. Defaults to every track.
+    '''
+    if track_ids is None:
+        execute_timed(cur, 'track_features missing', 'SELECT T.track_id FROM tracks T WHERE NOT EXISTS (SELECT 1 FROM track_features F WHERE F.track_sk = T.track_sk)')
+    else:
+        execute_timed(cur, 'track_features missing',
+        '''
+            SELECT T.track_id
+            FROM tracks T
+            WHERE
+                T.track_id = ANY(%s::CHAR(22)[])
+                AND NOT EXISTS (SELECT 1 FROM track_features F WHERE F.track_sk = T.track_sk)
+            ''',
+            (list(dict.fromkeys(track_ids)),)
+        )
+    return [row[0] for row in cur.fetchall()]
+
+
+def upsert_track_features(cur, track_features_table, key_cache=None):
+    '''
+    Loads track audio features on an open cursor without committing, through the same COPY and INSERT ... ON CONFLICT path as the tracks table. Features never change, so existing rows are kept.
+    Returns dictionary of track surrogate keys looked up, for the caller to add to key_cache after committing.
+
+    ARGUMENTS:
+        cur: Psycopg2 cursor
+        track_features_table: DataFrame of audio features with track_id column, as returned by transform_data.create_track_features_dataframe.
+        key_cache: Optional SurrogateKeyCache of the database, used to encode the track IDs.
+    '''
+    keys, new_keys = lookup_surrogate_keys(cur, 'track', track_features_table['track_id'], key_cache)
+    encoded = track_features_table.drop(columns='track_id')
+    encoded.insert(0, 'track_sk', track_features_table['track_id'].map(keys))
+    lock_report_cache(cur)
+    upsert_table(cur, {
+        'dataframe': encoded,
+        'data_table': 'track_features',
+        'staging_table': 'tmp_track_features',
+        'primary_key': 'track_sk',
+        'update_fields': []  # Audio features are static
+    })
+    # Cached reports of periods these tracks were played in lack their features
+    execute_timed(cur, 'report_cache invalidation',
+    '''
+        DELETE FROM report_cache R
+        WHERE EXISTS (
+            SELECT 1
+            FROM
+                daily_track_plays D
+                JOIN tmp_track_features F ON
+                    D.track_sk = F.track_sk
+            WHERE D.user_sk = R.user_sk AND D.play_date >= R.period_start AND D.play_date < R.period_end
+        )
+        '''
+    )
+    return {'track': new_keys}
+
+
+def load_update_tables(play_log_fact_table, track_dim_table, artist_dim_table, album_dim_table, hostname, database, username, pwd, port_id, played_at_watermark=None, key_cache=None, user_label=DEFAULT_USER_LABEL):
     '''
     Loads track, artist, and album DataFrames to specified PostgreSQL database. New data is appended to the respective tables and data is updated for non-static fields (e.g. popularity fields).
+    Each DataFrame is streamed with COPY into a session-local temp table and upserted with INSERT ... ON CONFLICT, all on one connection in a single transaction.
+    Plays reference tracks, artists, and albums by integer surrogate keys, resolved through key_cache where possible.
+    Newly inserted plays are added to the daily_track_plays, daily_artist_plays, and daily_album_plays rollup tables in the same transaction, and cached reports of the periods they fall into are deleted from report_cache.
+    Returns True if the transaction committed, False if it was rolled back.
 
     ARGUMENTS:
         play_log_fact_table: Dataframe of recent tracks played data.
@@ -17,14 +544,15 @@ def load_update_tables(play_log_fact_table, track_dim_table, artist_dim_table, a
         username: Username credential for connecting to desired database in PostgreSQL.
         pwd: Password credential for connecting to desired database in PostgreSQL.
         port_id: Port number for connecting to desired database in PostgreSQL.
+        played_at_watermark: Optional UNIX milliseconds of the latest play loaded. Stored in etl_state in the same transaction as the load.
+        key_cache: Optional SurrogateKeyCache of the database, reused across loads.
+        user_label: Label of the user whose plays are loaded. Plays, rollups, cached reports, and the watermark are kept per user.
     '''
     # Connecting to postgreSQL database
 
     # Instantiating connection as None to avoid errors with close if script executes incorrectly.
     conn = None
-
-    # Create SQLAlchemy Engine for insert into database tables
-    engine = create_engine(f'postgresql://{username}:{pwd}@{hostname}:{port_id}/{database}')
+    loaded = False
 
     # Creating connection object, opens database connection
     try:
@@ -34,83 +562,15 @@ def load_update_tables(play_log_fact_table, track_dim_table, artist_dim_table, a
             user=username,
             password=pwd,
             port=port_id
-        ) as conn:
+        ) as conn:  # Transaction commits at end of with statement block, rolls back on error
             # cursor for storing return values
             with conn.cursor() as cur:  # Cursor closes at end of with statement block
-                # SQL injection for each table
-                artist_sql =  {
-                    'dataframe': artist_dim_table,
-                    'data_table': 'artists',
-                    'staging_table': 'staging_artists', 
-                    'primary_key': 'artist_id',
-                    'sql_injection_updates': 'artist_followers = S.artist_followers, artist_popularity = S.artist_popularity' 
-                }
-                album_sql =  {
-                    'dataframe': album_dim_table,
-                    'data_table': 'albums',
-                    'staging_table': 'staging_albums', 
-                    'primary_key': 'album_id',
-                    'sql_injection_updates': 'album_popularity = S.album_popularity, album_total_tracks = S.album_total_tracks' 
-                }
-                track_sql = {
-                    'dataframe': track_dim_table,
-                    'data_table': 'tracks',
-                    'staging_table': 'staging_tracks',
-                    'primary_key': 'track_id',
-                    'sql_injection_updates': 'track_popularity = S.track_popularity'
-                }
-                log_sql = {
-                    'dataframe': play_log_fact_table,
-                    'data_table': 'play_log',
-                    'staging_table': 'play_log_staging',
-                    'primary_key': 'time_track_key',
-                }
-                # For each table, execute queries to update
-                for table in [artist_sql, album_sql, track_sql, log_sql]:
-                    # Append new data to staging table (to_sql creates table if not exists)
-                    table['dataframe'].to_sql(
-                        name=table['staging_table'],
-                        con=engine,
-                        if_exists='append',
-                        index=False
-                    )
-                    # Insert new data into main data table
-                    cur.execute(
-                    f'''
-                        INSERT INTO
-                            {table['data_table']}
-                        SELECT
-                            T.*
-                        FROM
-                            {table['staging_table']} T
-                            LEFT JOIN {table['data_table']} S ON
-                                T.{table['primary_key']} = S.{table['primary_key']}
-                        WHERE 
-                            S.{table['primary_key']} IS NULL
-                        '''
-                    )
-                    # Update non-static fields
-                    if table != log_sql:  # Log table has no dynamic fields
-                        cur.execute(
-                        f'''
-                            UPDATE
-                                {table['data_table']} M
-                            SET
-                                {table['sql_injection_updates']}
-                            FROM
-                                {table['staging_table']} S
-                            WHERE
-                                M.{table['primary_key']} = S.{table['primary_key']}
-                            '''
-                        )
-                    else:
-                        pass
-                    # Truncate staging tables
-                    cur.execute(
-                    f'''
-                        TRUNCATE TABLE {table['staging_table']}
-                        '''
-                    )                
+                new_keys = upsert_tables(cur, play_log_fact_table, track_dim_table, artist_dim_table, album_dim_table, played_at_watermark, key_cache, user_label)
+        loaded = True
+        # Keys of a rolled back transaction may not exist, so cache only after commit
+        if key_cache is not None:
+            for kind, keys in new_keys.items():
+                key_cache.put_many(kind, keys)
     except Exception as error:
         print(error)
 
@@ -119,4 +579,142 @@ def load_update_tables(play_log_fact_table, track_dim_table, artist_dim_table, a
         # Exit connection
             conn.close()
         else:
-            pass
\ No newline at end of file
+            pass
+
+    return loaded
+
+
+def load_pooled(pool, upsert):
+    '''
+    Runs one load in a single transaction on a connection borrowed from a shared connection pool. Surrogate keys the load looked up are added to the pool's SurrogateKeyCache once it commits.
+    Returns True if the transaction committed, False if it was rolled back.
+
+    ARGUMENTS:
+        pool: BlockingConnectionPool for the target database.
+        upsert: Function of (cursor, key_cache) running the load statements, returning dictionary of looked up keys per kind, e.g. upsert_tables.
+    '''
+    conn = pool.getconn()
+    loaded = False
+    try:
+        with conn:  # Transaction commits at end of with statement block, rolls back on error. Connection stays open.
+            with conn.cursor() as cur:
+                new_keys = upsert(cur, pool.key_cache)
+        loaded = True
+        for kind, keys in new_keys.items():
+            pool.key_cache.put_many(kind, keys)
+    except Exception as error:
+        print(error)
+
+    finally:
+        pool.putconn(conn)
+
+    return loaded
+
+
+def load_update_tables_pooled(pool, play_log_fact_table, track_dim_table, artist_dim_table, album_dim_table, played_at_watermark=None, user_label=DEFAULT_USER_LABEL):
+    '''
+    Same load as load_update_tables, on a connection borrowed from a shared connection pool instead of a new connection, with the pool's SurrogateKeyCache. Returns True if the transaction committed, False if it was rolled back.
+
+    ARGUMENTS:
+        pool: BlockingConnectionPool for the target database.
+        play_log_fact_table: Dataframe of recent tracks played data.
+        track_dim_table: DataFrame of track data from recent tracks played.
+        artist_dim_table: DataFrame of artist data from recent tracks played.
+        album_dim_table: DataFrame of album data from recent tracks played.
+        played_at_watermark: Optional UNIX milliseconds of the latest play loaded. Stored in etl_state in the same transaction as the load.
+        user_label: Label of the user whose plays are loaded.
+    '''
+    return load_pooled(pool, lambda cur, key_cache: upsert_tables(cur, play_log_fact_table, track_dim_table, artist_dim_table, album_dim_table, played_at_watermark, key_cache, user_label))
+
+
+def load_dimension_table_pooled(pool, kind, dataframe):
+    '''
+    Loads one dimension table in its own transaction on a pooled connection, so artists, albums, and tracks can load in parallel. Upserts, so a load can be repeated. Returns True if the transaction committed, False if it was rolled back.
+
+    ARGUMENTS:
+        pool: BlockingConnectionPool for the target database.
+        kind: 'artist', 'album', or 'track'.
+        dataframe: DataFrame of the dimension, as returned by transform_data.create_dataframes.
+    '''
+    def upsert(cur, key_cache):
+        upsert_dimension_table(cur, kind, dataframe)
+        return {}
+    return load_pooled(pool, upsert)
+
+
+def load_play_log_pooled(pool, play_log_fact_table, played_at_watermark=None, user_label=DEFAULT_USER_LABEL):
+    '''
+    Loads the play log in its own transaction on a pooled connection, once every dimension it references is loaded. Plays already loaded are skipped, so a load can be repeated. Returns True if the transaction committed, False if it was rolled back.
+
+    ARGUMENTS:
+        pool: BlockingConnectionPool for the target database.
+        play_log_fact_table: Dataframe of recent tracks played data.
+        played_at_watermark: Optional UNIX milliseconds of the latest play loaded. Stored in etl_state in the same transaction as the load.
+        user_label: Label of the user whose plays are loaded.
+    '''
+    return load_pooled(pool, lambda cur, key_cache: upsert_play_log(cur, play_log_fact_table, played_at_watermark, key_cache, user_label))
+
+
+def load_track_features_pooled(pool, track_features_table):
+    '''
+    Loads track audio features on a connection borrowed from a shared connection pool, in one transaction, with the pool's SurrogateKeyCache. Returns True if the transaction committed, False if it was rolled back.
+
+    ARGUMENTS:
+        pool: BlockingConnectionPool for the target database.
+        track_features_table: DataFrame of audio features with track_id column, as returned by transform_data.create_track_features_dataframe.
+    '''
+    return load_pooled(pool, lambda cur, key_cache: upsert_track_features(cur, track_features_table, key_cache))
+
+
+def load_update_tables_chunked(chunks, hostname, database, username, pwd, port_id, key_cache=None, user_label=DEFAULT_USER_LABEL):
+    '''
+    Streaming version of load_update_tables. Consumes (play log, track, artist, album) DataFrame chunks one at a time on a single connection and commits each chunk in its own transaction.
+    Chunks are not in played_at order (pages list their newest play first), so the played_at watermark is only advanced to the latest play once every chunk has committed. Stops at the first chunk that fails and leaves the watermark where it was, the next run extracts those plays again and skips the ones already loaded.
+    Returns number of plays in committed chunks.
+
+    ARGUMENTS:
+        chunks: Iterable of (play_log_fact_table, track_dim_table, artist_dim_table, album_dim_table) tuples, e.g. transform_data.iter_dataframes.
+        hostname: Host name credential for connecting to PostgreSQL.
+        database: Name of database containing artist, album, track tables in PostgreSQL.
+        username: Username credential for connecting to desired database in PostgreSQL.
+        pwd: Password credential for connecting to desired database in PostgreSQL.
+        port_id: Port number for connecting to desired database in PostgreSQL.
+        key_cache: Optional SurrogateKeyCache of the database. Defaults to a new cache for this run.
+        user_label: Label of the user whose plays are loaded.
+    '''
+    key_cache = key_cache if key_cache is not None else SurrogateKeyCache()
+    conn = None
+    plays_loaded = 0
+    try:
+        conn = psycopg2.connect(
+            host=hostname,
+            dbname=database,
+            user=username,
+            password=pwd,
+            port=port_id
+        )
+        played_at_watermark = None
+        for play_log_fact_table, track_dim_table, artist_dim_table, album_dim_table in chunks:
+            with conn:  # Transaction per chunk, commits at end of with statement block, rolls back on error
+                with conn.cursor() as cur:
+                    new_keys = upsert_tables(cur, play_log_fact_table, track_dim_table, artist_dim_table, album_dim_table, key_cache=key_cache, user_label=user_label)
+            for kind, keys in new_keys.items():
+                key_cache.put_many(kind, keys)
+            plays_loaded += len(play_log_fact_table)
+            # UNIX milliseconds of the latest play committed so far
+            if len(play_log_fact_table):
+                played_at_watermark = max(played_at_watermark or 0, play_log_fact_table['played_at'].max().value // 10 ** 6)
+
+        # Every chunk committed, advance watermark for the next incremental extract
+        if played_at_watermark is not None:
+            with conn:
+                with conn.cursor() as cur:
+                    write_played_at_watermark(cur, played_at_watermark, user_label)
+    except Exception as error:
+        print(error)
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+    return plays_loaded
@@ -0,0 +1,246 @@
+import json
+import pipeline_metrics as pm
+import psycopg2
+import sqlite3
+import threading
+import time
+
+
+# Fields returned by batch_additional_info
+CACHE_FIELDS = {
+    'artist': ['artist_followers', 'artist_popularity'],
+    'album': ['album_popularity', 'album_total_tracks', 'album_release_date']
+}
+
+
+class MetadataCache:
+    '''
+    On-disk SQLite cache for artist and album metadata returned by the Spotify Web API, optionally with the raw API objects so cache hits can be landed in a landing zone.
+    The /v1/artists and /v1/albums endpoints return popularity, followers, total tracks, and release date together, so an entry is fetched and expires as a whole after ttl seconds.
+    The least recently used entries are evicted once max_entries is exceeded.
+
+    ARGUMENTS:
+        path: File path of the SQLite database. Created if it does not exist.
+        ttl: Seconds before an entry expires. Popularity and follower counts change daily.
+        max_entries: Maximum number of artists and albums kept in the cache.
+    '''
+    def __init__(self, path='metadata_cache.sqlite', ttl=24 * 3600, max_entries=50000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # Caches written in an earlier layout are dropped, their entries are refetched
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(metadata_cache)')]
+        if columns and 'payload' not in columns:
+            self._conn.execute('DROP TABLE metadata_cache')
+        self._conn.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS metadata_cache (
+                kind TEXT,
+                id TEXT,
+                info TEXT,
+                payload TEXT,
+                fetched_at REAL,
+                last_access REAL,
+                PRIMARY KEY (kind, id)
+            )
+            '''
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS metadata_cache_last_access ON metadata_cache (last_access)')
+        self._conn.commit()
+
+    def get_many(self, kind, ids, require_payload=False):
+        '''
+        Looks up cached metadata for many IDs of one kind. Returns dictionary of fresh entries keyed by ID and list of IDs that missed or expired.
+
+        ARGUMENTS:
+            kind: Either 'artist' or 'album'.
+            ids: Iterable of Spotify IDs.
+            require_payload: Whether entries stored without their raw API object (e.g. by warm_from_database) count as misses.
+        '''
+        ids = list(dict.fromkeys(ids))
+        found = {}
+        now = time.time()
+        with self._lock:
+            # SQLite limits the number of bound parameters per statement
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                rows = self._conn.execute(
+                    f'''
+                    SELECT id, info
+                    FROM metadata_cache
+                    WHERE kind = ? AND id IN ({','.join('?' * len(chunk))}) AND fetched_at >= ?
+                        AND (payload IS NOT NULL OR NOT ?)
+                    ''',
+                    [kind] + chunk + [now - self.ttl, require_payload]
+                ).fetchall()
+                for spotify_id, info in rows:
+                    found[spotify_id] = json.loads(info)
+            # Refresh recency of hits for LRU eviction
+            self._conn.executemany(
+                'UPDATE metadata_cache SET last_access = ? WHERE kind = ? AND id = ?',
+                [(now, kind, spotify_id) for spotify_id in found]
+            )
+            self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(ids) - len(found)
+        pm.get_recorder().record_cache(kind, len(found), len(ids) - len(found))
+        return found, [spotify_id for spotify_id in ids if spotify_id not in found]
+
+    def put_many(self, kind, info, fetched_at=None, payloads=None, overwrite=True):
+        '''
+        Stores metadata for many IDs of one kind and evicts least recently used entries past max_entries.
+
+        ARGUMENTS:
+            kind: Either 'artist' or 'album'.
+            info: Dictionary of field dictionaries keyed by Spotify ID, as returned by batch_additional_info.
+            fetched_at: Optional dictionary of UNIX seconds each ID was fetched at, keyed by Spotify ID. Defaults to now.
+            payloads: Optional dictionary of raw API objects keyed by Spotify ID.
+            overwrite: Whether entries already cached are replaced. Otherwise only new IDs are stored.
+        '''
+        now = time.time()
+        fetched_at = fetched_at or {}
+        payloads = payloads or {}
+        rows = [
+            (
+                kind,
+                spotify_id,
+                json.dumps({field: values[field] for field in CACHE_FIELDS[kind]}),
+                json.dumps(payloads[spotify_id]) if spotify_id in payloads else None,
+                fetched_at.get(spotify_id, now),
+                now
+            )
+            for spotify_id, values in info.items()
+        ]
+        with self._lock:
+            self._conn.executemany(f"INSERT OR {'REPLACE' if overwrite else 'IGNORE'} INTO metadata_cache VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._conn.execute(
+                '''
+                DELETE FROM metadata_cache
+                WHERE rowid IN (
+                    SELECT rowid FROM metadata_cache
+                    ORDER BY last_access DESC
+                    LIMIT -1 OFFSET ?
+                )
+                ''',
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+    def get_payloads(self, kind, ids):
+        '''
+        Returns dictionary of the raw API objects stored for many IDs of one kind, keyed by ID. IDs stored without one are left out.
+
+        ARGUMENTS:
+            kind: Either 'artist' or 'album'.
+            ids: Iterable of Spotify IDs, e.g. the hits of get_many.
+        '''
+        ids = list(dict.fromkeys(ids))
+        payloads = {}
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                rows = self._conn.execute(
+                    f'''
+                    SELECT id, payload
+                    FROM metadata_cache
+                    WHERE kind = ? AND id IN ({','.join('?' * len(chunk))}) AND payload IS NOT NULL
+                    ''',
+                    [kind] + chunk
+                ).fetchall()
+                payloads.update((spotify_id, json.loads(payload)) for spotify_id, payload in rows)
+        return payloads
+
+    def warm_from_database(self, hostname, database, username, pwd, port_id):
+        '''
+        Fills the cache from the artists and albums tables maintained by load_update_tables, without raw API objects. Entries already cached are kept.
+        The tables do not record when values were fetched. Every load refreshes the artists and albums it plays, so the latest play of each is used as its fetch time, which is never later than the real one. Artists and albums without plays are left out.
+
+        ARGUMENTS:
+            hostname: Host name credential for connecting to PostgreSQL.
+            database: Name of database containing artist, album, track tables in PostgreSQL.
+            username: Username credential for connecting to desired database in PostgreSQL.
+            pwd: Password credential for connecting to desired database in PostgreSQL.
+            port_id: Port number for connecting to desired database in PostgreSQL.
+        '''
+        conn = None
+        try:
+            with psycopg2.connect(
+                host=hostname,
+                dbname=database,
+                user=username,
+                password=pwd,
+                port=port_id
+            ) as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                    '''
+                        SELECT A.artist_id, A.artist_followers, A.artist_popularity, EXTRACT(EPOCH FROM P.last_played_at)
+                        FROM 
+                            artists A
+                            JOIN (SELECT artist_sk, MAX(played_at) last_played_at FROM play_log GROUP BY artist_sk) P ON
+                                A.artist_sk = P.artist_sk
+                        '''
+                    )
+                    rows = cur.fetchall()
+                    self.put_many(
+                        'artist',
+                        {artist_id: {'artist_followers': followers, 'artist_popularity': popularity} for artist_id, followers, popularity, _ in rows},
+                        {artist_id: float(last_played_at) for artist_id, _, _, last_played_at in rows},
+                        overwrite=False
+                    )
+                    cur.execute(
+                    '''
+                        SELECT A.album_id, A.album_popularity, A.album_total_tracks, A.album_release_date, EXTRACT(EPOCH FROM P.last_played_at)
+                        FROM 
+                            albums A
+                            JOIN (SELECT album_sk, MAX(played_at) last_played_at FROM play_log GROUP BY album_sk) P ON
+                                A.album_sk = P.album_sk
+                        '''
+                    )
+                    rows = cur.fetchall()
+                    self.put_many(
+                        'album',
+                        {
+                            album_id: {
+                                'album_popularity': popularity,
+                                'album_total_tracks': total_tracks,
+                                'album_release_date': str(release_date) if release_date is not None else None
+                            }
+                            for album_id, popularity, total_tracks, release_date, _ in rows
+                        },
+                        {album_id: float(last_played_at) for album_id, _, _, _, last_played_at in rows},
+                        overwrite=False
+                    )
+        except Exception as error:
+            print(error)
+
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def stats(self):
+        '''
+        Returns dictionary of cache hits, misses, and hit rate since the cache was opened.
+
+        ARGUMENTS:
+            None
+        '''
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+    def close(self):
+        '''
+        Closes the SQLite connection.
+
+        ARGUMENTS:
+            None
+        '''
+        self._conn.close()
@@ -0,0 +1,209 @@
+import extract_helper_functions as ex
+import landing_zone as lz
+import load_update_data as load
+import os
+import pandas as pd
+import pipeline_metrics as pm
+import spotify_client as sc
+import threading
+import transform_data as tf
+from concurrent.futures import ThreadPoolExecutor
+
+
+def read_user_credentials(path):
+    '''
+    Reads every row of the logins spreadsheet. Returns list of credential dictionaries, one per user.
+    Expected columns are client_id, client_secret, hostname, database, username, pwd, port_id, plus optional cache_path (spotipy token cache file, required to tell several users apart), redirect_uri, and email.
+
+    ARGUMENTS:
+        path: Path of logins spreadsheet.
+    '''
+    credentials = pd.read_excel(path)
+    # Empty optional cells become None instead of NaN
+    return credentials.astype(object).where(credentials.notna(), None).to_dict('records')
+
+
+def user_label(user):
+    '''
+    Returns the name a user is reported and stored under, their email or else their client_id. Users sharing a database are told apart in it by this label.
+
+    ARGUMENTS:
+        user: Credential dictionary as returned by read_user_credentials.
+    '''
+    return user.get('email') or user['client_id']
+
+
+def create_user_spotipy_client(user):
+    '''
+    Creates a spotipy client object for one user, with read access to their recently played tracks. Returns spotipy client object.
+
+    ARGUMENTS:
+        user: Credential dictionary as returned by read_user_credentials.
+    '''
+    return ex.create_spotipy_client(
+        client_id=user['client_id'],
+        client_secret=user['client_secret'],
+        redirect_uri=user.get('redirect_uri') or 'http://localhost:7777/callback',
+        scope='user-read-recently-played',
+        cache_path=user.get('cache_path')
+    )
+
+
+def database_key(user):
+    '''
+    Returns the (hostname, database, username, port) tuple identifying a user's database.
+
+    ARGUMENTS:
+        user: Credential dictionary as returned by read_user_credentials.
+    '''
+    return (user['hostname'], user['database'], user['username'], str(user['port_id']))
+
+
+class ConnectionPools:
+    '''
+    Lazily created BlockingConnectionPool per distinct database, shared by every user loading into it.
+
+    ARGUMENTS:
+        max_connections: Maximum number of open connections per database.
+    '''
+    def __init__(self, max_connections=4):
+        self.max_connections = max_connections
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def get(self, user):
+        '''
+        Returns the connection pool for a user's database, creating it on first use.
+
+        ARGUMENTS:
+            user: Credential dictionary as returned by read_user_credentials.
+        '''
+        key = database_key(user)
+        with self._lock:
+            if key not in self._pools:
+                self._pools[key] = load.BlockingConnectionPool(
+                    0,
+                    self.max_connections,
+                    host=user['hostname'],
+                    dbname=user['database'],
+                    user=user['username'],
+                    password=user['pwd'],
+                    port=user['port_id']
+                )
+            return self._pools[key]
+
+    def close(self):
+        '''
+        Closes every connection of every pool.
+
+        ARGUMENTS:
+            None
+        '''
+        with self._lock:
+            for pool in self._pools.values():
+                pool.closeall()
+            self._pools = {}
+
+
+def enrich_track_features(pool, client, track_ids=None):
+    '''
+    Fetches and stores audio features of tracks that have none in the track_features table yet. Features never change, so each track is requested once in its lifetime. Returns number of tracks stored.
+
+    ARGUMENTS:
+        pool: BlockingConnectionPool for the target database.
+        client: SpotifyApiClient for audio features API requests.
+        track_ids: Optional iterable of Spotify track IDs already loaded into tracks, e.g. the tracks of the latest load. Defaults to every track, to backfill existing history.
+    '''
+    conn = pool.getconn()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                missing = load.read_tracks_without_features(cur, track_ids)
+    finally:
+        pool.putconn(conn)
+    if not missing:
+        return 0
+
+    track_features_table = tf.create_track_features_dataframe(missing, client)
+    if not load.load_track_features_pooled(pool, track_features_table):
+        raise RuntimeError('track features load rolled back')
+    return len(track_features_table)
+
+
+def run_user_etl(user, pools, cache=None, landing_zone_root=None):
+    '''
+    Runs incremental extract, transform, and load for one user, then stores audio features of tracks loaded for the first time.
+    Returns dictionary with user, status ('success', 'no new plays', or 'failed'), number of plays extracted, number of tracks whose features were stored, and error message.
+
+    ARGUMENTS:
+        user: Credential dictionary as returned by read_user_credentials.
+        pools: ConnectionPools shared by every user.
+        cache: Optional MetadataCache shared by every user.
+        landing_zone_root: Optional directory of raw payload landing zones, one LandingZone per user underneath.
+    '''
+    label = user_label(user)
+    result = {'user': label, 'status': 'failed', 'plays': 0, 'features': 0, 'error': None}
+    client = None
+    try:
+        pool = pools.get(user)
+        landing_zone = lz.LandingZone(os.path.join(landing_zone_root, label)) if landing_zone_root is not None else None
+
+        # Extract data process, only plays newer than the last loaded play
+        sp = create_user_spotipy_client(user)
+        conn = pool.getconn()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    watermark = load.read_played_at_watermark(cur, label)
+        finally:
+            pool.putconn(conn)
+        with pm.get_recorder().stage('extract'):
+            recent_tracks = ex.get_recent_played_tracks_since(sp, after=watermark, limit=50, landing_zone=landing_zone)
+        result['plays'] = len(recent_tracks['items'])
+        if not recent_tracks['items']:
+            result['status'] = 'no new plays'
+            return result
+
+        # Transform and load data process
+        client = sc.SpotifyApiClient(sc.TokenHolder(auth_manager=sp.auth_manager), landing_zone=landing_zone)
+        with pm.get_recorder().stage('transform'):
+            play_log_fact_table, track_dim_table, artist_dim_table, album_dim_table = tf.create_dataframes(recent_tracks, cache=cache, client=client)
+        with pm.get_recorder().stage('load'):
+            loaded = load.load_update_tables_pooled(pool, play_log_fact_table, track_dim_table, artist_dim_table, album_dim_table, played_at_watermark=ex.latest_played_at(recent_tracks), user_label=label)
+        if loaded:
+            result['status'] = 'success'
+            # Plays are committed either way, tracks whose features failed are retried the next time they are loaded
+            try:
+                result['features'] = enrich_track_features(pool, client, track_dim_table['track_id'])
+            except Exception as error:
+                result['error'] = f'audio features: {error}'
+        else:
+            result['error'] = 'load rolled back'
+    except Exception as error:
+        result['error'] = str(error)
+
+    finally:
+        if client is not None:
+            client.close()
+
+    return result
+
+
+def run_multi_user_etl(users, max_workers=4, max_connections=4, cache=None, landing_zone_root=None):
+    '''
+    Runs the ETL for many users in parallel on a thread pool. Extract and transform of different users overlap, and users sharing a database load through one connection pool, their plays kept apart by user label.
+    A failure for one user does not stop the others. Returns list of per-user result dictionaries, in the order of users.
+
+    ARGUMENTS:
+        users: List of credential dictionaries as returned by read_user_credentials.
+        max_workers: Maximum number of users processed at once.
+        max_connections: Maximum number of open connections per database.
+        cache: Optional MetadataCache shared by every user.
+        landing_zone_root: Optional directory of raw payload landing zones, one LandingZone per user underneath.
+    '''
+    pools = ConnectionPools(max_connections)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda user: run_user_etl(user, pools, cache, landing_zone_root), users))
+    finally:
+        pools.close()
@@ -0,0 +1,293 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Upper bounds (seconds) of the HTTP latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf')]
+
+
+class NullRecorder:
+    '''
+    Metrics recorder that records nothing. Installed by default, so instrumented code costs one no-op call per event when metrics are off.
+
+    ARGUMENTS:
+        None
+    '''
+    enabled = False
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def record_http(self, endpoint, status, seconds):
+        pass
+
+    def record_cache(self, kind, hits, misses):
+        pass
+
+    def record_rows(self, table, rows_in, rows_out):
+        pass
+
+    def record_statement(self, name, seconds):
+        pass
+
+    def flush(self):
+        pass
+
+
+class MetricsRecorder(NullRecorder):
+    '''
+    Collects per-stage wall time, HTTP call counts and latency histograms, cache hit rates, rows in and out per table, and database statement timings, then writes them to a sink on flush.
+    Thread-safe, so one recorder can be shared by concurrent users and HTTP worker threads.
+
+    ARGUMENTS:
+        sink: Object with a write(snapshot) method, e.g. PrometheusTextfileSink or JsonLogSink.
+    '''
+    enabled = True
+
+    def __init__(self, sink):
+        self.sink = sink
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''
+        Clears all recorded metrics.
+
+        ARGUMENTS:
+            None
+        '''
+        with self._lock:
+            self.stages = {}
+            self.http = {}
+            self.cache = {}
+            self.rows = {}
+            self.statements = {}
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Context manager timing one run of a pipeline stage. Repeated runs of a stage add up.
+
+        ARGUMENTS:
+            name: Stage name (e.g. 'extract', 'enrichment', 'transform', 'load', 'email').
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                stage = self.stages.setdefault(name, {'seconds': 0.0, 'count': 0})
+                stage['seconds'] += seconds
+                stage['count'] += 1
+
+    def record_http(self, endpoint, status, seconds):
+        '''
+        Records one HTTP call.
+
+        ARGUMENTS:
+            endpoint: Endpoint path (e.g. '/artists').
+            status: HTTP status code.
+            seconds: Request latency.
+        '''
+        with self._lock:
+            http = self.http.setdefault(endpoint, {'count': 0, 'seconds': 0.0, 'statuses': {}, 'buckets': [0] * len(LATENCY_BUCKETS)})
+            http['count'] += 1
+            http['seconds'] += seconds
+            http['statuses'][str(status)] = http['statuses'].get(str(status), 0) + 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    http['buckets'][i] += 1
+                    break
+
+    def record_cache(self, kind, hits, misses):
+        '''
+        Records cache lookups.
+
+        ARGUMENTS:
+            kind: Cached object kind (e.g. 'artist', 'album').
+            hits: Number of lookups served from cache.
+            misses: Number of lookups not in cache or expired.
+        '''
+        with self._lock:
+            cache = self.cache.setdefault(kind, {'hits': 0, 'misses': 0})
+            cache['hits'] += hits
+            cache['misses'] += misses
+
+    def record_rows(self, table, rows_in, rows_out):
+        '''
+        Records rows handed to and written by a table load.
+
+        ARGUMENTS:
+            table: Table name.
+            rows_in: Rows in the DataFrame being loaded.
+            rows_out: Rows inserted or updated in the table.
+        '''
+        with self._lock:
+            rows = self.rows.setdefault(table, {'in': 0, 'out': 0})
+            rows['in'] += rows_in
+            rows['out'] += rows_out
+
+    def record_statement(self, name, seconds):
+        '''
+        Records one database statement execution.
+
+        ARGUMENTS:
+            name: Statement name (e.g. 'artists copy').
+            seconds: Execution time.
+        '''
+        with self._lock:
+            statement = self.statements.setdefault(name, {'seconds': 0.0, 'count': 0})
+            statement['seconds'] += seconds
+            statement['count'] += 1
+
+    def snapshot(self):
+        '''
+        Returns dictionary of everything recorded so far, with cache hit rates and cumulative histogram buckets filled in.
+
+        ARGUMENTS:
+            None
+        '''
+        with self._lock:
+            snapshot = json.loads(json.dumps({
+                'stages': self.stages,
+                'http': self.http,
+                'cache': self.cache,
+                'rows': self.rows,
+                'statements': self.statements
+            }))
+        for cache in snapshot['cache'].values():
+            lookups = cache['hits'] + cache['misses']
+            cache['hit_rate'] = cache['hits'] / lookups if lookups else 0.0
+        for http in snapshot['http'].values():
+            cumulative = 0
+            for i, count in enumerate(http['buckets']):
+                cumulative += count
+                http['buckets'][i] = cumulative
+        return snapshot
+
+    def flush(self):
+        '''
+        Writes a snapshot of everything recorded so far to the sink.
+
+        ARGUMENTS:
+            None
+        '''
+        self.sink.write(self.snapshot())
+
+
+class JsonLogSink:
+    '''
+    Writes each snapshot as one structured JSON log line.
+
+    ARGUMENTS:
+        logger: Optional logging.Logger. Defaults to the 'spotify_etl.metrics' logger.
+    '''
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger('spotify_etl.metrics')
+
+    def write(self, snapshot):
+        self.logger.info(json.dumps({'event': 'spotify_etl_metrics', **snapshot}))
+
+
+class PrometheusTextfileSink:
+    '''
+    Writes each snapshot in Prometheus text exposition format, for the node_exporter textfile collector. The file is replaced atomically.
+
+    ARGUMENTS:
+        path: Path of .prom file.
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, snapshot):
+        lines = [
+            '# TYPE spotify_etl_stage_seconds counter',
+            *(f'spotify_etl_stage_seconds{{stage="{name}"}} {stage["seconds"]}' for name, stage in snapshot['stages'].items()),
+            '# TYPE spotify_etl_stage_runs_total counter',
+            *(f'spotify_etl_stage_runs_total{{stage="{name}"}} {stage["count"]}' for name, stage in snapshot['stages'].items()),
+            '# TYPE spotify_etl_http_requests_total counter',
+            *(
+                f'spotify_etl_http_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}'
+                for endpoint, http in snapshot['http'].items()
+                for status, count in http['statuses'].items()
+            ),
+            '# TYPE spotify_etl_http_request_seconds histogram'
+        ]
+        for endpoint, http in snapshot['http'].items():
+            for bound, count in zip(LATENCY_BUCKETS, http['buckets']):
+                le = '+Inf' if bound == float('inf') else bound
+                lines.append(f'spotify_etl_http_request_seconds_bucket{{endpoint="{endpoint}",le="{le}"}} {count}')
+            lines.append(f'spotify_etl_http_request_seconds_sum{{endpoint="{endpoint}"}} {http["seconds"]}')
+            lines.append(f'spotify_etl_http_request_seconds_count{{endpoint="{endpoint}"}} {http["count"]}')
+        lines += [
+            '# TYPE spotify_etl_cache_lookups_total counter',
+            *(
+                f'spotify_etl_cache_lookups_total{{kind="{kind}",result="{result}"}} {cache[result + "s"]}'
+                for kind, cache in snapshot['cache'].items()
+                for result in ('hit', 'miss')
+            ),
+            '# TYPE spotify_etl_rows_total counter',
+            *(
+                f'spotify_etl_rows_total{{table="{table}",direction="{direction}"}} {rows[direction]}'
+                for table, rows in snapshot['rows'].items()
+                for direction in ('in', 'out')
+            ),
+            '# TYPE spotify_etl_db_statement_seconds counter',
+            *(f'spotify_etl_db_statement_seconds{{statement="{name}"}} {statement["seconds"]}' for name, statement in snapshot['statements'].items()),
+            '# TYPE spotify_etl_db_statements_total counter',
+            *(f'spotify_etl_db_statements_total{{statement="{name}"}} {statement["count"]}' for name, statement in snapshot['statements'].items())
+        ]
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, self.path)
+
+
+# Recorder used by instrumented code, metrics off unless configured
+_recorder = NullRecorder()
+
+
+def get_recorder():
+    '''
+    Returns the active metrics recorder.
+
+    ARGUMENTS:
+        None
+    '''
+    return _recorder
+
+
+def set_recorder(recorder):
+    '''
+    Installs the metrics recorder used by instrumented code. Pass NullRecorder() to switch metrics off.
+
+    ARGUMENTS:
+        recorder: MetricsRecorder or NullRecorder.
+    '''
+    global _recorder
+    _recorder = recorder
+
+
+def configure_from_env(job='spotify_etl'):
+    '''
+    Installs a recorder according to environment variables and returns it. SPOTIFY_ETL_METRICS_SINK selects 'prometheus' or 'json'. Anything else switches metrics off.
+    Prometheus metrics are written to <job>.prom in the SPOTIFY_ETL_METRICS_DIR directory (node_exporter textfile directory), so each DAG keeps its own file.
+
+    ARGUMENTS:
+        job: Job name used for the .prom file name.
+    '''
+    sink = os.environ.get('SPOTIFY_ETL_METRICS_SINK', '').lower()
+    if sink == 'prometheus':
+        recorder = MetricsRecorder(PrometheusTextfileSink(os.path.join(os.environ.get('SPOTIFY_ETL_METRICS_DIR', '.'), f'{job}.prom')))
+    elif sink == 'json':
+        recorder = MetricsRecorder(JsonLogSink())
+    else:
+        recorder = NullRecorder()
+    set_recorder(recorder)
+    return recorder
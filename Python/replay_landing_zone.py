@@ -0,0 +1,61 @@
+import argparse
+import landing_zone as lz
+import load_update_data as load
+import transform_data as tf
+
+
+def replay_landing_zone(landing_zone, hostname, database, username, pwd, port_id, start=None, end=None, user_label=load.DEFAULT_USER_LABEL):
+    '''
+    Reprocesses raw payloads from a landing zone without network access. Plays are read one month of partitions at a time, enriched from the landed artist and album objects, and run through create_dataframes and load_update_tables.
+    Loads are idempotent upserts, so a replay can be repeated. The extract watermark is left untouched. Returns dictionary of plays replayed and months committed / failed.
+
+    ARGUMENTS:
+        landing_zone: LandingZone to replay.
+        hostname: Host name credential for connecting to PostgreSQL.
+        database: Name of database containing artist, album, track tables in PostgreSQL.
+        username: Username credential for connecting to desired database in PostgreSQL.
+        pwd: Password credential for connecting to desired database in PostgreSQL.
+        port_id: Port number for connecting to desired database in PostgreSQL.
+        start: Optional first UTC date ('YYYY-MM-DD') replayed, inclusive.
+        end: Optional last UTC date ('YYYY-MM-DD') replayed, exclusive.
+        user_label: Label of the user whose plays are replayed.
+    '''
+    client = lz.ReplayClient(landing_zone)
+    key_cache = load.SurrogateKeyCache()
+    months = sorted({
+        date[:7] for date in landing_zone.partition_dates('recently_played')
+        if (start is None or date >= start) and (end is None or date < end)
+    })
+
+    summary = {'plays': 0, 'committed': [], 'failed': []}
+    for month in months:
+        # Month bounds clipped to the requested range
+        year, month_number = int(month[:4]), int(month[5:])
+        next_month = f'{year + month_number // 12}-{month_number % 12 + 1:02d}'
+        recent_tracks = landing_zone.read_recently_played(max(f'{month}-01', start or ''), min(f'{next_month}-01', end or '9999'))
+        if not recent_tracks['items']:
+            continue
+        play_log_fact_table, track_dim_table, artist_dim_table, album_dim_table = tf.create_dataframes(recent_tracks, client=client)
+        if load.load_update_tables(play_log_fact_table, track_dim_table, artist_dim_table, album_dim_table, hostname, database, username, pwd, port_id, key_cache=key_cache, user_label=user_label):
+            summary['plays'] += len(recent_tracks['items'])
+            summary['committed'].append(month)
+        else:
+            summary['failed'].append(month)
+
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay raw Spotify payloads from a landing zone into PostgreSQL, without calling the Spotify API.')
+    parser.add_argument('root', help='Landing zone directory.')
+    parser.add_argument('--start', default=None, help='First UTC date (YYYY-MM-DD) replayed, inclusive.')
+    parser.add_argument('--end', default=None, help='Last UTC date (YYYY-MM-DD) replayed, exclusive.')
+    parser.add_argument('--user-label', default=load.DEFAULT_USER_LABEL, help='Label of the user whose plays are replayed, the name of their landing zone directory under a multi-user landing zone root.')
+    parser.add_argument('--hostname', default='localhost')
+    parser.add_argument('--database', default='spotify_project')
+    parser.add_argument('--username', default='postgres')
+    parser.add_argument('--pwd', default='')
+    parser.add_argument('--port-id', default=5432)
+    args = parser.parse_args()
+
+    print(replay_landing_zone(lz.LandingZone(args.root), args.hostname, args.database, args.username, args.pwd, args.port_id, args.start, args.end, args.user_label))
@@ -0,0 +1,152 @@
+import pipeline_metrics as pm
+import requests
+import spotipy
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+
+class TokenHolder:
+    '''
+    Keeps the Spotify access token in memory and only refreshes it once it is about to expire, instead of re-reading the spotipy cache file for every request.
+
+    ARGUMENTS:
+        auth_manager: Optional spotipy auth manager (e.g. spotipy_client.auth_manager). Used to refresh expired tokens.
+        cache_path: Optional spotipy cache file path, read when no auth manager is given. Defaults to spotipy's .cache file.
+        token: Optional fixed access token, e.g. for a local stub server. Never refreshed.
+        refresh_margin: Seconds before expiry at which the token is refreshed.
+    '''
+    def __init__(self, auth_manager=None, cache_path=None, token=None, refresh_margin=60):
+        self.auth_manager = auth_manager
+        self.cache_path = cache_path
+        self.refresh_margin = refresh_margin
+        self._token_info = {'access_token': token, 'expires_at': float('inf')} if token is not None else None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self.auth_manager is not None:
+            # validate_token refreshes and re-caches the token if it has expired
+            return self.auth_manager.validate_token(self.auth_manager.cache_handler.get_cached_token())
+        return spotipy.CacheFileHandler(cache_path=self.cache_path).get_cached_token()
+
+    def get(self):
+        '''
+        Returns access token, refreshing it first if it expires within refresh_margin seconds.
+
+        ARGUMENTS:
+            None
+        '''
+        with self._lock:
+            if self._token_info is None or self._token_info['expires_at'] - self.refresh_margin < time.time():
+                self._token_info = self._load()
+            return self._token_info['access_token']
+
+    def invalidate(self):
+        '''
+        Forgets the held token so the next get reloads it. Fixed tokens are kept.
+
+        ARGUMENTS:
+            None
+        '''
+        with self._lock:
+            if self._token_info is not None and self._token_info['expires_at'] != float('inf'):
+                self._token_info = None
+
+
+class SpotifyApiClient:
+    '''
+    Shared client for direct Spotify Web API requests. Reuses pooled connections through one requests.Session, honours 429 Retry-After with backoff, and runs batches of requests with bounded concurrency.
+
+    ARGUMENTS:
+        token_holder: TokenHolder supplying access tokens.
+        base_url: API root URL. Point at a local stub server for testing.
+        max_workers: Maximum number of requests in flight at once. Also sizes the connection pool.
+        max_retries: Maximum number of retries for rate limited (429) and server error (5xx) responses.
+        backoff: Base seconds for exponential backoff when no Retry-After header is given.
+        timeout: Seconds before a request times out.
+        landing_zone: Optional LandingZone the objects of every get_many batch are appended to.
+
+    Can be used as a context manager that closes the client on exit.
+    '''
+    def __init__(self, token_holder, base_url='https://api.spotify.com/v1', max_workers=8, max_retries=5, backoff=1.0, timeout=10, landing_zone=None):
+        self.token_holder = token_holder
+        self.base_url = base_url.rstrip('/')
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.landing_zone = landing_zone
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, path, params=None):
+        '''
+        Sends GET request to Spotify Web API, retrying rate limited and server error responses. Returns JSON response.
+
+        ARGUMENTS:
+            path: Endpoint path relative to base_url (e.g. '/artists').
+            params: Optional dictionary of query parameters.
+        '''
+        url = f'{self.base_url}/{path.lstrip("/")}'
+        refreshed = False
+        attempt = 0
+        while True:
+            # Authentican headers
+            auth_headers = {
+                'Content-Type': 'application/json',
+                'Authorization': f'Bearer {self.token_holder.get()}'
+            }
+            start = time.perf_counter()
+            response = self.session.get(url, headers=auth_headers, params=params, timeout=self.timeout)
+            pm.get_recorder().record_http(path, response.status_code, time.perf_counter() - start)
+
+            # Expired or revoked token, reload once
+            if response.status_code == 401 and not refreshed:
+                self.token_holder.invalidate()
+                refreshed = True
+                continue
+
+            # Rate limited or server error, wait and retry
+            if (response.status_code == 429 or response.status_code >= 500) and attempt < self.max_retries:
+                retry_after = response.headers.get('Retry-After')
+                time.sleep(float(retry_after) if retry_after is not None else self.backoff * 2 ** attempt)
+                attempt += 1
+                continue
+
+            response.raise_for_status()
+            return response.json()
+
+    def get_many(self, requests_to_send):
+        '''
+        Sends many GET requests concurrently, at most max_workers at once. Returns list of JSON responses in request order.
+
+        ARGUMENTS:
+            requests_to_send: List of (path, params) tuples.
+        '''
+        if len(requests_to_send) <= 1:
+            responses = [self.get(path, params) for path, params in requests_to_send]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(requests_to_send))) as executor:
+                responses = list(executor.map(lambda request: self.get(*request), requests_to_send))
+        # Keep raw payloads for offline replay
+        if self.landing_zone is not None:
+            self.landing_zone.write_responses(responses)
+        return responses
+
+    def close(self):
+        '''
+        Closes pooled connections.
+
+        ARGUMENTS:
+            None
+        '''
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,313 @@
+import extract_helper_functions as ex
+import json
+import landing_zone as lz
+import load_update_data as load
+import multi_user_etl as multi
+import os
+import pandas as pd
+import pipeline_metrics as pm
+import shutil
+import spotify_client as sc
+import time
+import transform_data as tf
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Fields of the enrichment handoff files, as returned by batch_additional_info
+ENRICHMENT_FIELDS = {
+    'artist': ['artist_followers', 'artist_popularity'],
+    'album': ['album_popularity', 'album_total_tracks', 'album_release_date']
+}
+
+# Stages in DAG order. The three dimension loads are independent of each other, play_log and track_features follow them.
+STAGES = ['extract', 'enrich', 'transform', 'load_artists', 'load_albums', 'load_tracks', 'load_play_log', 'track_features']
+
+
+def write_handoff(run_dir, user, name, dataframe):
+    '''
+    Writes a DataFrame handed to a later stage as a zstd-compressed Parquet file, run_dir/<user label>/<name>.parquet.
+    Written under a temporary name first and then replaced, so a retried stage overwrites its earlier output and readers never see a partial file.
+
+    ARGUMENTS:
+        run_dir: Handoff directory of one DAG run.
+        user: Credential dictionary as returned by multi_user_etl.read_user_credentials.
+        name: Name of the handoff file, e.g. 'play_log'.
+        dataframe: DataFrame to write. The index is not kept.
+    '''
+    directory = os.path.join(run_dir, multi.user_label(user))
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{name}.parquet')
+    dataframe.to_parquet(path + '.tmp', compression='zstd', index=False)
+    os.replace(path + '.tmp', path)
+
+
+def read_handoff(run_dir, user, name):
+    '''
+    Reads a DataFrame written by write_handoff. Returns DataFrame, or None if the file does not exist, e.g. for a user without new plays.
+
+    ARGUMENTS:
+        run_dir: Handoff directory of one DAG run.
+        user: Credential dictionary as returned by multi_user_etl.read_user_credentials.
+        name: Name of the handoff file, e.g. 'play_log'.
+    '''
+    path = os.path.join(run_dir, multi.user_label(user), f'{name}.parquet')
+    if not os.path.exists(path):
+        return None
+    return pd.read_parquet(path)
+
+
+def handoff_exists(run_dir, user, name):
+    '''
+    Returns True if a handoff file was written for a user, e.g. by an earlier try of the stage.
+
+    ARGUMENTS:
+        run_dir: Handoff directory of one DAG run.
+        user: Credential dictionary as returned by multi_user_etl.read_user_credentials.
+        name: Name of the handoff file, e.g. 'play_log'.
+    '''
+    return os.path.exists(os.path.join(run_dir, multi.user_label(user), f'{name}.parquet'))
+
+
+def read_recent_tracks(run_dir, user):
+    '''
+    Reads the plays written by extract_stage. Returns JSON object shaped like get_recent_played_tracks, or None if the user has no new plays.
+
+    ARGUMENTS:
+        run_dir: Handoff directory of one DAG run.
+        user: Credential dictionary as returned by multi_user_etl.read_user_credentials.
+    '''
+    recently_played = read_handoff(run_dir, user, 'recently_played')
+    if recently_played is None or recently_played.empty:
+        return None
+    return {'items': [json.loads(payload) for payload in recently_played['payload']], 'cursors': None}
+
+
+def for_each_user(users, task, max_workers=4):
+    '''
+    Runs task(user) for every user on a thread pool. A failure for one user does not stop the others.
+    Raises RuntimeError naming every failed user once all users ran, so the Airflow task fails and its retry repeats the stage.
+
+    ARGUMENTS:
+        users: List of credential dictionaries as returned by multi_user_etl.read_user_credentials.
+        task: Function of one user.
+        max_workers: Maximum number of users processed at once.
+    '''
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [(multi.user_label(user), executor.submit(task, user)) for user in users]
+    failed = {}
+    for label, future in futures:
+        try:
+            future.result()
+        except Exception as error:
+            failed[label] = str(error)
+    if failed:
+        raise RuntimeError(f'Stage failed for users: {failed}')
+
+
+def extract_stage(users, run_dir, pools, landing_zone_root=None, max_workers=4):
+    '''
+    Extracts every user's plays newer than their played_at watermark and writes them to the 'recently_played' handoff file.
+    Users whose handoff file was written by an earlier try are skipped, so a retry only calls the API for the users that failed. The watermark only moves when play_log is loaded, so a new run extracts the same plays again.
+
+    ARGUMENTS:
+        users: List of credential dictionaries as returned by multi_user_etl.read_user_credentials.
+        run_dir: Handoff directory of one DAG run.
+        pools: multi_user_etl.ConnectionPools shared by every user.
+        landing_zone_root: Optional directory of raw payload landing zones, one LandingZone per user underneath.
+        max_workers: Maximum number of users processed at once.
+    '''
+    def extract(user):
+        if handoff_exists(run_dir, user, 'recently_played'):
+            return
+        landing_zone = lz.LandingZone(os.path.join(landing_zone_root, multi.user_label(user))) if landing_zone_root is not None else None
+        pool = pools.get(user)
+        conn = pool.getconn()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    watermark = load.read_played_at_watermark(cur, multi.user_label(user))
+        finally:
+            pool.putconn(conn)
+        recent_tracks = ex.get_recent_played_tracks_since(multi.create_user_spotipy_client(user), after=watermark, limit=50, landing_zone=landing_zone)
+        write_handoff(run_dir, user, 'recently_played', pd.DataFrame({'payload': [json.dumps(item) for item in recent_tracks['items']]}, dtype=str))
+
+    for_each_user(users, extract, max_workers)
+
+
+def enrich_stage(users, run_dir, cache=None, landing_zone_root=None, max_workers=4):
+    '''
+    Requests additional artist and album details for every user's extracted plays and writes them to the 'artist_info' and 'album_info' handoff files.
+    Users whose handoff files were written by an earlier try are skipped. Transform and the loads send no API requests, track_features only requests audio features of tracks that have none stored yet.
+
+    ARGUMENTS:
+        users: List of credential dictionaries as returned by multi_user_etl.read_user_credentials.
+        run_dir: Handoff directory of one DAG run.
+        cache: Optional MetadataCache shared by every user.
+        landing_zone_root: Optional directory of raw payload landing zones, one LandingZone per user underneath.
+        max_workers: Maximum number of users processed at once.
+    '''
+    def enrich(user):
+        if handoff_exists(run_dir, user, 'artist_info') and handoff_exists(run_dir, user, 'album_info'):
+            return
+        recent_tracks = read_recent_tracks(run_dir, user)
+        if recent_tracks is None:
+            return
+        landing_zone = lz.LandingZone(os.path.join(landing_zone_root, multi.user_label(user))) if landing_zone_root is not None else None
+        albums = [item['track']['album'] for item in recent_tracks['items']]
+        client = sc.SpotifyApiClient(sc.TokenHolder(auth_manager=multi.create_user_spotipy_client(user).auth_manager), landing_zone=landing_zone)
+        try:
+            artist_info, album_info = ex.batch_additional_info(client, artist_ids=[album['artists'][0]['id'] for album in albums], album_ids=[album['id'] for album in albums], cache=cache)
+        finally:
+            client.close()
+        for kind, info in [('artist', artist_info), ('album', album_info)]:
+            write_handoff(run_dir, user, f'{kind}_info', pd.DataFrame(
+                [[spotify_id] + [values[field] for field in ENRICHMENT_FIELDS[kind]] for spotify_id, values in info.items()],
+                columns=[f'{kind}_id'] + ENRICHMENT_FIELDS[kind]
+            ))
+
+    for_each_user(users, enrich, max_workers)
+
+
+def transform_stage(users, run_dir, max_workers=4):
+    '''
+    Builds play log, track, artist, and album DataFrames from every user's extracted plays and enrichment files with create_dataframes, and writes them to the 'play_log', 'tracks', 'artists', and 'albums' handoff files.
+
+    ARGUMENTS:
+        users: List of credential dictionaries as returned by multi_user_etl.read_user_credentials.
+        run_dir: Handoff directory of one DAG run.
+        max_workers: Maximum number of users processed at once.
+    '''
+    def transform(user):
+        recent_tracks = read_recent_tracks(run_dir, user)
+        if recent_tracks is None:
+            return
+        enrichment = []
+        for kind in ['artist', 'album']:
+            info = read_handoff(run_dir, user, f'{kind}_info')
+            enrichment.append({values.pop(f'{kind}_id'): values for values in info.to_dict('records')})
+        dataframes = tf.create_dataframes(recent_tracks, enrichment=tuple(enrichment))
+        for name, dataframe in zip(['play_log', 'tracks', 'artists', 'albums'], dataframes):
+            write_handoff(run_dir, user, name, dataframe)
+
+    for_each_user(users, transform, max_workers)
+
+
+def load_dimension_stage(kind, users, run_dir, pools, max_workers=4):
+    '''
+    Upserts one dimension handoff file of every user into their database. Runs in parallel with the other dimension loads, and repeating it leaves the table unchanged.
+
+    ARGUMENTS:
+        kind: 'artist', 'album', or 'track'.
+        users: List of credential dictionaries as returned by multi_user_etl.read_user_credentials.
+        run_dir: Handoff directory of one DAG run.
+        pools: multi_user_etl.ConnectionPools shared by every user.
+        max_workers: Maximum number of users processed at once.
+    '''
+    def load_dimension(user):
+        dataframe = read_handoff(run_dir, user, f'{kind}s')
+        if dataframe is None:
+            return
+        if not load.load_dimension_table_pooled(pools.get(user), kind, dataframe):
+            raise RuntimeError(f'{kind}s load rolled back')
+
+    for_each_user(users, load_dimension, max_workers)
+
+
+def load_play_log_stage(users, run_dir, pools, max_workers=4):
+    '''
+    Loads every user's 'play_log' handoff file once the dimension loads are done, and advances their played_at watermark in the same transaction. Plays already loaded are skipped, so a retry loads nothing twice.
+
+    ARGUMENTS:
+        users: List of credential dictionaries as returned by multi_user_etl.read_user_credentials.
+        run_dir: Handoff directory of one DAG run.
+        pools: multi_user_etl.ConnectionPools shared by every user.
+        max_workers: Maximum number of users processed at once.
+    '''
+    def load_play_log(user):
+        play_log_fact_table = read_handoff(run_dir, user, 'play_log')
+        if play_log_fact_table is None:
+            return
+        # UNIX milliseconds of the latest play
+        played_at_watermark = play_log_fact_table['played_at'].max().value // 10 ** 6
+        if not load.load_play_log_pooled(pools.get(user), play_log_fact_table, played_at_watermark, multi.user_label(user)):
+            raise RuntimeError('play_log load rolled back')
+
+    for_each_user(users, load_play_log, max_workers)
+
+
+def track_features_stage(users, run_dir, pools, landing_zone_root=None, max_workers=4):
+    '''
+    Requests and stores audio features of every user's loaded tracks that have none yet, with multi_user_etl.enrich_track_features. Runs once the tracks are loaded, in parallel with the play_log load.
+
+    ARGUMENTS:
+        users: List of credential dictionaries as returned by multi_user_etl.read_user_credentials.
+        run_dir: Handoff directory of one DAG run.
+        pools: multi_user_etl.ConnectionPools shared by every user.
+        landing_zone_root: Optional directory of raw payload landing zones, one LandingZone per user underneath.
+        max_workers: Maximum number of users processed at once.
+    '''
+    def track_features(user):
+        track_dim_table = read_handoff(run_dir, user, 'tracks')
+        if track_dim_table is None:
+            return
+        landing_zone = lz.LandingZone(os.path.join(landing_zone_root, multi.user_label(user))) if landing_zone_root is not None else None
+        client = sc.SpotifyApiClient(sc.TokenHolder(auth_manager=multi.create_user_spotipy_client(user).auth_manager), landing_zone=landing_zone)
+        try:
+            multi.enrich_track_features(pools.get(user), client, track_dim_table['track_id'])
+        finally:
+            client.close()
+
+    for_each_user(users, track_features, max_workers)
+
+
+def run_stage(stage, users, run_dir, cache=None, landing_zone_root=None, max_workers=4, max_connections=4):
+    '''
+    Runs one stage of the ETL for every user, timed as a stage of the active metrics recorder. Each stage reads the handoff files of the stages before it and writes its own, so a failed stage is retried alone.
+
+    ARGUMENTS:
+        stage: Stage name, one of STAGES.
+        users: List of credential dictionaries as returned by multi_user_etl.read_user_credentials.
+        run_dir: Handoff directory of one DAG run.
+        cache: Optional MetadataCache for the enrich stage.
+        landing_zone_root: Optional directory of raw payload landing zones, one LandingZone per user underneath.
+        max_workers: Maximum number of users processed at once.
+        max_connections: Maximum number of open connections per database.
+    '''
+    pools = multi.ConnectionPools(max_connections)
+    try:
+        with pm.get_recorder().stage(stage):
+            if stage == 'extract':
+                extract_stage(users, run_dir, pools, landing_zone_root, max_workers)
+            elif stage == 'enrich':
+                enrich_stage(users, run_dir, cache, landing_zone_root, max_workers)
+            elif stage == 'transform':
+                transform_stage(users, run_dir, max_workers)
+            elif stage in ['load_artists', 'load_albums', 'load_tracks']:
+                load_dimension_stage(stage[len('load_'):-1], users, run_dir, pools, max_workers)
+            elif stage == 'load_play_log':
+                load_play_log_stage(users, run_dir, pools, max_workers)
+            elif stage == 'track_features':
+                track_features_stage(users, run_dir, pools, landing_zone_root, max_workers)
+            else:
+                raise ValueError(f'Unknown stage {stage}, expected one of {STAGES}')
+    finally:
+        pools.close()
+
+
+def remove_handoff(handoff_root, run_dir=None, keep_days=7):
+    '''
+    Deletes the handoff directory of a finished run, and those of runs older than keep_days that never finished.
+
+    ARGUMENTS:
+        handoff_root: Directory holding one handoff directory per DAG run.
+        run_dir: Optional handoff directory of the run that just finished.
+        keep_days: Days a handoff directory is kept for retries.
+    '''
+    if run_dir is not None:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    if not os.path.isdir(handoff_root):
+        return
+    for name in os.listdir(handoff_root):
+        path = os.path.join(handoff_root, name)
+        if os.path.isdir(path) and os.path.getmtime(path) < time.time() - keep_days * 24 * 3600:
+            shutil.rmtree(path, ignore_errors=True)
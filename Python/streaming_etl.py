@@ -0,0 +1,76 @@
+import extract_helper_functions as ex
+import load_update_data as load
+import queue
+import threading
+import transform_data as tf
+
+
+def prefetch(iterable, max_pending=2):
+    '''
+    Runs an iterable on a background thread and yields its items through a bounded queue. The producer blocks once max_pending items wait unconsumed, so a slow consumer holds back extract and transform instead of letting chunks pile up in memory.
+    Exceptions raised by the producer are re-raised in the consumer. Stopping early stops the producer at its next item.
+
+    ARGUMENTS:
+        iterable: Iterable producing items, e.g. transform_data.iter_dataframes.
+        max_pending: Maximum number of produced items waiting for the consumer.
+    '''
+    pending = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+
+    def put(entry):
+        # Give up once the consumer has stopped reading
+        while not stop.is_set():
+            try:
+                pending.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(('item', item)):
+                    return
+            put(('done', None))
+        except Exception as error:
+            put(('error', error))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, value = pending.get()
+            if kind == 'done':
+                return
+            if kind == 'error':
+                raise value
+            yield value
+    finally:
+        stop.set()
+
+
+def run_streaming_etl(spotipy_client, client, hostname, database, username, pwd, port_id, after=None, chunk_size=1000, cache=None, key_cache=None, landing_zone=None, max_pending=2, user_label=load.DEFAULT_USER_LABEL):
+    '''
+    Runs extract, transform, and load as one stream with bounded memory. Extract yields pages of plays, transform regroups them into chunks of chunk_size plays, and the loader commits chunk by chunk while the next chunks are being extracted and transformed.
+    Peak memory is bounded by chunk_size and max_pending rather than by the number of plays, and the first chunk is committed before the extract has finished. The played_at watermark is only advanced once every chunk has committed. Returns number of plays committed.
+
+    ARGUMENTS:
+        spotipy_client: Spotipy client object.
+        client: SpotifyApiClient for artist and album API requests.
+        hostname: Host name credential for connecting to PostgreSQL.
+        database: Name of database containing artist, album, track tables in PostgreSQL.
+        username: Username credential for connecting to desired database in PostgreSQL.
+        pwd: Password credential for connecting to desired database in PostgreSQL.
+        port_id: Port number for connecting to desired database in PostgreSQL.
+        after: Optional UNIX milliseconds of the latest play already loaded.
+        chunk_size: Number of plays per committed chunk.
+        cache: Optional MetadataCache placed in front of the artist and album API requests.
+        key_cache: Optional SurrogateKeyCache of the database.
+        landing_zone: Optional LandingZone the raw play items are appended to.
+        max_pending: Maximum number of transformed chunks waiting for the loader.
+        user_label: Label of the user whose plays are loaded.
+    '''
+    pages = ex.iter_recent_played_pages(spotipy_client, after=after, limit=50, landing_zone=landing_zone)
+    chunks = tf.iter_dataframes(pages, chunk_size=chunk_size, cache=cache, client=client)
+    return load.load_update_tables_chunked(prefetch(chunks, max_pending), hostname, database, username, pwd, port_id, key_cache=key_cache, user_label=user_label)
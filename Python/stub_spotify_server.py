@@ -0,0 +1,147 @@
+import bisect
+import extract_helper_functions as ex
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+
+class StubSpotifyServer:
+    '''
+    Local HTTP server standing in for api.spotify.com, serving a synthetic catalog and listening history. Supports /v1/artists, /v1/albums, /v1/tracks, /v1/audio-features (multi-ID), and /v1/me/player/recently-played with after / before cursors.
+    Latency and 429 rate limiting can be injected. Any bearer token is accepted.
+
+    ARGUMENTS:
+        catalog: Catalog as returned by synthetic_spotify_data.generate_catalog.
+        plays: Plays as returned by synthetic_spotify_data.generate_plays, oldest first.
+        latency: Seconds added to every response.
+        rate_limit_every: Answer every Nth request with 429. 0 disables rate limiting.
+        retry_after: Retry-After seconds sent with 429 responses.
+    '''
+    def __init__(self, catalog, plays, latency=0.0, rate_limit_every=0, retry_after=0):
+        self.objects = {
+            'artists': {artist['id']: artist for artist in catalog['artists']},
+            'albums': {album['id']: album for album in catalog['albums']},
+            'tracks': {track['id']: track for track in catalog['tracks']},
+            'audio_features': {features['id']: features for features in catalog.get('audio_features', [])}
+        }
+        self.plays = plays
+        self.play_times = [ex.played_at_to_unix_ms(play['played_at']) for play in plays]
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.request_count = 0
+        self.rate_limited_count = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        '''
+        Base URL of the stub, e.g. http://127.0.0.1:PORT. Spotify Web API paths live under /v1.
+        '''
+        return f'http://127.0.0.1:{self._server.server_port}'
+
+    def start(self):
+        '''
+        Starts serving on a background thread. Returns self.
+
+        ARGUMENTS:
+            None
+        '''
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Stops serving and closes the socket.
+
+        ARGUMENTS:
+            None
+        '''
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def recently_played(self, query):
+        '''
+        Returns recently played page for the given query parameters, mirroring Spotify's cursor pagination. Newest play first.
+
+        ARGUMENTS:
+            query: Dictionary of query parameter lists as returned by parse_qs.
+        '''
+        limit = int(query.get('limit', ['20'])[0])
+        if 'after' in query:
+            # Oldest plays after the cursor, next page moves forward in time
+            start = bisect.bisect_right(self.play_times, int(query['after'][0]))
+            end = min(start + limit, len(self.plays))
+            more = end < len(self.plays)
+        else:
+            # Newest plays before the cursor, next page moves back in time
+            end = bisect.bisect_left(self.play_times, int(query['before'][0])) if 'before' in query else len(self.plays)
+            start = max(end - limit, 0)
+            more = start > 0
+        items = self.plays[start:end][::-1]
+
+        cursors = None
+        next_url = None
+        if items:
+            cursors = {'after': str(self.play_times[end - 1]), 'before': str(self.play_times[start])}
+            if more:
+                cursor = {'after': cursors['after']} if 'after' in query else {'before': cursors['before']}
+                next_url = f'{self.url}/v1/me/player/recently-played?' + urlencode({'limit': limit, **cursor})
+        return {'items': items, 'next': next_url, 'cursors': cursors, 'limit': limit}
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status, body, headers=None):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                with stub._lock:
+                    stub.request_count += 1
+                    rate_limited = stub.rate_limit_every and stub.request_count % stub.rate_limit_every == 0
+                    if rate_limited:
+                        stub.rate_limited_count += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if rate_limited:
+                    self.send_json(429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}}, {'Retry-After': str(stub.retry_after)})
+                    return
+
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                path = url.path.rstrip('/')
+                if path == '/v1/me/player/recently-played':
+                    self.send_json(200, stub.recently_played(query))
+                    return
+                # Response key, e.g. 'audio_features' for /v1/audio-features
+                kind = path.rsplit('/', 1)[-1].replace('-', '_')
+                if kind in stub.objects and 'ids' in query:
+                    ids = query['ids'][0].split(',')
+                    self.send_json(200, {kind: [stub.objects[kind].get(spotify_id) for spotify_id in ids]})
+                    return
+                self.send_json(404, {'error': {'status': 404, 'message': 'Not found'}})
+
+        return Handler
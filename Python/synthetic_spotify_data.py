@@ -0,0 +1,139 @@
+import random
+import string
+from datetime import datetime, timedelta, timezone
+
+
+def spotify_id(rng):
+    '''
+    Returns random 22 character base62 ID shaped like a Spotify ID.
+
+    ARGUMENTS:
+        rng: random.Random instance.
+    '''
+    return ''.join(rng.choices(string.ascii_letters + string.digits, k=22))
+
+
+def generate_catalog(n_artists, n_albums, n_tracks, seed=0):
+    '''
+    Generates a synthetic Spotify catalog. Every album belongs to one artist and every track to one album.
+    Returns dictionary of 'artists', 'albums', 'tracks', and 'audio_features' lists holding full API objects as returned by /v1/artists, /v1/albums, /v1/tracks, and /v1/audio-features.
+
+    ARGUMENTS:
+        n_artists: Number of artists.
+        n_albums: Number of albums.
+        n_tracks: Number of tracks.
+        seed: Random seed, the same seed always generates the same catalog.
+    '''
+    rng = random.Random(seed)
+
+    artists = []
+    for i in range(n_artists):
+        artist_id = spotify_id(rng)
+        artists.append({
+            'id': artist_id,
+            'name': f'Artist {i}',
+            'type': 'artist',
+            'external_urls': {'spotify': f'https://open.spotify.com/artist/{artist_id}'},
+            'followers': {'href': None, 'total': rng.randint(100, 50_000_000)},
+            'popularity': rng.randint(0, 100)
+        })
+
+    albums = []
+    for i in range(n_albums):
+        album_id = spotify_id(rng)
+        artist = artists[i % n_artists] if i < n_artists else rng.choice(artists)
+        albums.append({
+            'id': album_id,
+            'name': f'Album {i}',
+            'type': 'album',
+            'external_urls': {'spotify': f'https://open.spotify.com/album/{album_id}'},
+            'artists': [{key: artist[key] for key in ('id', 'name', 'type', 'external_urls')}],
+            'popularity': rng.randint(0, 100),
+            'total_tracks': rng.randint(1, 30),
+            'release_date': f'{rng.randint(1950, 2023)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}'
+        })
+
+    tracks = []
+    for i in range(n_tracks):
+        track_id = spotify_id(rng)
+        album = albums[i % n_albums] if i < n_albums else rng.choice(albums)
+        tracks.append({
+            'id': track_id,
+            'name': f'Track {i}',
+            'type': 'track',
+            'external_urls': {'spotify': f'https://open.spotify.com/track/{track_id}'},
+            'duration_ms': rng.randint(90_000, 420_000),
+            'popularity': rng.randint(0, 100),
+            'artists': album['artists'],
+            'album': {key: album[key] for key in ('id', 'name', 'type', 'external_urls', 'artists', 'release_date', 'total_tracks')}
+        })
+
+    # Audio features drawn after the catalog, so the same seed keeps generating the same artists, albums, and tracks
+    audio_features = []
+    for track in tracks:
+        audio_features.append({
+            'id': track['id'],
+            'type': 'audio_features',
+            'danceability': round(rng.random(), 3),
+            'energy': round(rng.random(), 3),
+            'key': rng.randint(-1, 11),
+            'loudness': round(rng.uniform(-30, 0), 3),
+            'mode': rng.randint(0, 1),
+            'speechiness': round(rng.random(), 4),
+            'acousticness': round(rng.random(), 4),
+            'instrumentalness': round(rng.random(), 4),
+            'liveness': round(rng.random(), 4),
+            'valence': round(rng.random(), 3),
+            'tempo': round(rng.uniform(60, 200), 3),
+            'duration_ms': track['duration_ms'],
+            'time_signature': rng.randint(3, 7)
+        })
+
+    return {'artists': artists, 'albums': albums, 'tracks': tracks, 'audio_features': audio_features}
+
+
+def generate_plays(catalog, n_plays, start=datetime(2023, 1, 1, tzinfo=timezone.utc), skew=1.1, seed=0):
+    '''
+    Generates synthetic listening history over the catalog. Tracks are drawn from a Zipf-like distribution, so a few tracks (and their artists and albums) repeat often, as in real listening.
+    Returns list of recently played items, oldest first, shaped like current_user_recently_played items.
+
+    ARGUMENTS:
+        catalog: Catalog as returned by generate_catalog.
+        n_plays: Number of plays.
+        start: Timezone-aware datetime of the first play.
+        skew: Zipf exponent of track popularity. Higher repeats the top tracks more.
+        seed: Random seed, the same seed always generates the same plays.
+    '''
+    rng = random.Random(seed)
+    tracks = catalog['tracks']
+    weights = [1 / (rank + 1) ** skew for rank in range(len(tracks))]
+    chosen = rng.choices(tracks, weights=weights, k=n_plays)
+
+    plays = []
+    played_at = start
+    for track in chosen:
+        # Next play starts after the current track, with occasional gaps between sessions
+        played_at += timedelta(milliseconds=track['duration_ms'] + rng.choice([0, 0, 0, rng.randint(1, 36_000_000)]) + rng.randint(0, 999))
+        plays.append({
+            'played_at': played_at.strftime('%Y-%m-%dT%H:%M:%S.') + f'{played_at.microsecond // 1000:03d}Z',
+            'track': track
+        })
+    return plays
+
+
+def generate_dataset(n_plays, seed=0):
+    '''
+    Generates catalog and plays sized for n_plays with realistic repetition (about 20 plays per track, 80 per album, 200 per artist).
+    Returns tuple of (catalog, plays).
+
+    ARGUMENTS:
+        n_plays: Number of plays.
+        seed: Random seed.
+    '''
+    catalog = generate_catalog(
+        n_artists=max(5, n_plays // 200),
+        n_albums=max(10, n_plays // 80),
+        n_tracks=max(30, n_plays // 20),
+        seed=seed
+    )
+    return catalog, generate_plays(catalog, n_plays, seed=seed)
@@ -1,117 +1,163 @@
-import dateutil.parser as dp
 import extract_helper_functions as ex
 import pandas as pd
-import pytz
-from datetime import datetime
+import pipeline_metrics as pm
+import spotify_client as sc
 
 
-def create_dataframes(recent_tracks):
+def drop_seen(table, kind, seen_ids):
+    '''
+    Removes dimension rows whose IDs were emitted by earlier chunks and records the remaining IDs as seen. Returns DataFrame.
+
+    ARGUMENTS:
+        table: Track, artist, or album DataFrame.
+        kind: 'track', 'artist', or 'album'.
+        seen_ids: Dictionary of ID sets, or None to keep every row.
+    '''
+    if seen_ids is None:
+        return table
+    table = table.drop(table.index[table[f'{kind}_id'].isin(seen_ids[kind])])
+    seen_ids[kind].update(table[f'{kind}_id'])
+    return table
+
+
+def create_dataframes(recent_tracks, cache=None, client=None, seen_ids=None, enrichment=None):
     '''
     Returns play log, artist, album, and track Pandas DataFrames.
-    Takes JSON object of recent tracks as returned by Spotify API request and extracts track attributes from JSON object.
-    Cleans data (dates in particular) and deletes duplicates in tracks, artists, and albums tables.
+    Takes JSON object of recent tracks as returned by Spotify API request and extracts track attributes from JSON object in a single pass into column arrays.
+    Cleans data (dates in particular) with vectorized operations and deletes duplicates in tracks, artists, and albums tables.
 
     ARGUMENTS:
         recent_tracks: JSON object returned by API request for user's recent songs played from Spotify.
+        cache: Optional MetadataCache placed in front of the artist and album API requests.
+        client: Optional SpotifyApiClient for artist and album API requests. Defaults to a client reading the spotipy cache file token, closed once the requests are done.
+        seen_ids: Optional dictionary of track, artist, and album ID sets already emitted by earlier chunks. Their dimension rows are left out and not enriched again, and new IDs are added to the sets.
+        enrichment: Optional (artist info, album info) dictionaries as returned by extract_helper_functions.batch_additional_info, e.g. from an earlier enrichment task. No API requests are sent.
     '''
-    # Instantiate list for list of lists data collection
-    # Collect datetime today
-    play_log_fact_data = []
-    track_dim_data = []
-    artist_dim_data = []
-    album_dim_data = []
-    curr_date = datetime.today().date()
-
-    # Traversing tracks and storing data in PySpark DataFrames
-    # Performing transformations on timezones, date formats during data collection
-    for i in range(len(recent_tracks['items'])):
-        # Fact table data
-        track_id = recent_tracks['items'][i]['track']['id']
-        artist_id = recent_tracks['items'][i]['track']['album']['artists'][0]['id']
-        album_id = recent_tracks['items'][i]['track']['album']['id']
-        track_name = recent_tracks['items'][i]['track']['name']
-        track_url = recent_tracks['items'][i]['track']['external_urls']['spotify']
-        track_length_ms = recent_tracks['items'][i]['track']['duration_ms']
-        track_popularity = recent_tracks['items'][i]['track']['popularity']
-        played_at = pytz.utc.localize(datetime.strptime(recent_tracks['items'][i]['played_at'], '%Y-%m-%dT%H:%M:%S.%fZ')).astimezone(pytz.timezone('US/Pacific')).date()
-        played_at_unix = str(dp.parse(recent_tracks['items'][i]['played_at']).timestamp()).replace('.', '')  # Conversion from Standard ISO 8610 datetime to UNIX seconds
-        unique_id = played_at_unix + track_id
-
-        # Artist data
-        artist_name = recent_tracks['items'][i]['track']['album']['artists'][0]['name']
-        artist_url = recent_tracks['items'][i]['track']['album']['artists'][0]['external_urls']['spotify']
-        
-        # Album data
-        album_name = recent_tracks['items'][i]['track']['album']['name']
-        album_url = recent_tracks['items'][i]['track']['album']['external_urls']['spotify']
-        
-        # Additional artist and album data
-        token = ex.get_access_token()
-        artist_followers, artist_popularity, album_popularity, album_total_tracks, album_release_date = ex.additional_info(token, artist_id=artist_id, album_id=album_id)
-
-        # Play log fact table row
-        play_log_fact_data.append(
-            {
-                'time_track_key': unique_id, 
-                'track_id': track_id,
-                'artist_id': artist_id,
-                'album_id': album_id,
-                'played_at': played_at, 
-                'date_appended': curr_date
-            }
-        )
-
-        # Track dim table row
-        track_dim_data.append(
-            {
-                'track_id': track_id, 
-                'track_name': track_name, 
-                'track_url': track_url, 
-                'track_length_ms': track_length_ms, 
-                'track_popularity': track_popularity, 
-            }
-        )
-        
-        # Artist dim table row
-        artist_dim_data.append(
-            {
-                'artist_id': artist_id,
-                'artist_name': artist_name,
-                'artist_url': artist_url,
-                'artist_followers': artist_followers,
-                'artist_popularity': artist_popularity
-            }
-        )
-
-        # Album dum table row
-        album_dim_data.append(
-            {
-                'album_id': album_id,
-                'album_name': album_name,
-                'album_url': album_url,
-                'album_popularity': album_popularity,
-                'album_total_tracks': album_total_tracks,
-                'album_release_date': album_release_date
-            }
-        )
-
-    # Creating DataFrames
-
-    # Play log fact table 
-    play_log_fact_table = pd.DataFrame(play_log_fact_data)
-
-    # Track dim  table
-    track_dim_table = pd.DataFrame(track_dim_data)
-
-    # Artist dim table
-    artist_dim_table = pd.DataFrame(artist_dim_data)
+    # Flattening nested JSON objects into columns
+    items = recent_tracks['items']
+    tracks = [item['track'] for item in items]
+    albums = [track['album'] for track in tracks]
+    artists = [album['artists'][0] for album in albums]
+
+    track_ids = [track['id'] for track in tracks]
+    artist_ids = [artist['id'] for artist in artists]
+    album_ids = [album['id'] for album in albums]
+
+    # Additional artist and album data, requested once per distinct artist / album
+    if enrichment is not None:
+        artist_info, album_info = enrichment
+    else:
+        enrich_artist_ids, enrich_album_ids = artist_ids, album_ids
+        if seen_ids is not None:
+            enrich_artist_ids = [artist_id for artist_id in artist_ids if artist_id not in seen_ids['artist']]
+            enrich_album_ids = [album_id for album_id in album_ids if album_id not in seen_ids['album']]
+        with pm.get_recorder().stage('enrichment'):
+            if client is None:
+                with sc.SpotifyApiClient(sc.TokenHolder()) as default_client:
+                    artist_info, album_info = ex.batch_additional_info(default_client, artist_ids=enrich_artist_ids, album_ids=enrich_album_ids, cache=cache)
+            else:
+                artist_info, album_info = ex.batch_additional_info(client, artist_ids=enrich_artist_ids, album_ids=enrich_album_ids, cache=cache)
+
+    # Timezone and date format transformations
+    played_at_utc = pd.to_datetime(pd.Series([item['played_at'] for item in items], dtype=object), utc=True, format='ISO8601')
+    played_at = played_at_utc.dt.tz_convert('US/Pacific')
+
+    # Play log fact table, a play is identified by (played_at, track). IDs are replaced with surrogate keys at load.
+    play_log_fact_table = pd.DataFrame({
+        'played_at': played_at,
+        'track_id': track_ids,
+        'artist_id': artist_ids,
+        'album_id': album_ids
+    })
+
+    # Track dim table
+    track_dim_table = drop_seen(pd.DataFrame({
+        'track_id': track_ids,
+        'track_name': [track['name'] for track in tracks],
+        'track_url': [track['external_urls']['spotify'] for track in tracks],
+        'track_length_ms': [track['duration_ms'] for track in tracks],
+        'track_popularity': [track['popularity'] for track in tracks]
+    }), 'track', seen_ids)
+
+    # Artist dim table, rows from earlier chunks left out before enrichment is joined
+    artist_dim_table = drop_seen(pd.DataFrame({
+        'artist_id': artist_ids,
+        'artist_name': [artist['name'] for artist in artists],
+        'artist_url': [artist['external_urls']['spotify'] for artist in artists]
+    }), 'artist', seen_ids).join(
+        pd.DataFrame(list(artist_info.values()), index=pd.Index(list(artist_info), dtype=str), columns=['artist_followers', 'artist_popularity']),
+        on='artist_id'
+    )
 
     # Album dim table
-    album_dim_table = pd.DataFrame(album_dim_data)
+    album_dim_table = drop_seen(pd.DataFrame({
+        'album_id': album_ids,
+        'album_name': [album['name'] for album in albums],
+        'album_url': [album['external_urls']['spotify'] for album in albums]
+    }), 'album', seen_ids).join(
+        pd.DataFrame(list(album_info.values()), index=pd.Index(list(album_info), dtype=str), columns=['album_popularity', 'album_total_tracks', 'album_release_date']),
+        on='album_id'
+    )
     album_dim_table['album_release_date'] = album_dim_table['album_release_date'].astype('datetime64[ns]')
+    # Nullable integers, so details missing for an ID (e.g. not landed when replaying) are loaded as NULL instead of failing on 5.0
+    artist_dim_table[['artist_followers', 'artist_popularity']] = artist_dim_table[['artist_followers', 'artist_popularity']].astype('Int64')
+    album_dim_table[['album_popularity', 'album_total_tracks']] = album_dim_table[['album_popularity', 'album_total_tracks']].astype('Int64')
 
-    # Delete duplicate artists and albums from most recent 50 artists / albums
+    # Delete duplicate tracks, artists and albums
     for table in [track_dim_table, artist_dim_table, album_dim_table]:
         table.drop_duplicates(inplace=True)
 
     return play_log_fact_table, track_dim_table, artist_dim_table, album_dim_table
+
+
+# Audio features stored per track, as named by the /v1/audio-features response
+TRACK_FEATURE_FIELDS = ['danceability', 'energy', 'key', 'loudness', 'mode', 'speechiness', 'acousticness', 'instrumentalness', 'liveness', 'valence', 'tempo', 'time_signature']
+
+
+def create_track_features_dataframe(track_ids, client):
+    '''
+    Returns track features Pandas DataFrame with track_id and TRACK_FEATURE_FIELDS columns, one row per distinct track ID.
+    Audio features are requested in batches of 100 tracks. Tracks Spotify has no features for keep a row of missing values, so they are not requested again.
+
+    ARGUMENTS:
+        track_ids: Iterable of Spotify track IDs, e.g. track IDs not yet in the track_features table.
+        client: SpotifyApiClient for audio features API requests.
+    '''
+    with pm.get_recorder().stage('audio_features'):
+        features = ex.batch_audio_features(client, track_ids)
+    track_features_table = pd.DataFrame(
+        [[(values or {}).get(field) for field in TRACK_FEATURE_FIELDS] for values in features.values()],
+        columns=TRACK_FEATURE_FIELDS
+    ).astype(float)
+    # Nullable integers, so missing values are loaded as NULL instead of failing on 5.0
+    track_features_table[['key', 'mode', 'time_signature']] = track_features_table[['key', 'mode', 'time_signature']].astype('Int16')
+    track_features_table.insert(0, 'track_id', pd.Series(list(features), dtype=str))
+    return track_features_table
+
+
+def iter_dataframes(item_pages, chunk_size=1000, cache=None, client=None):
+    '''
+    Streaming version of create_dataframes. Regroups pages of play items into chunks of chunk_size plays and yields play log, track, artist, and album DataFrames per chunk.
+    Dimension rows are deduplicated across chunks through running sets of seen IDs, so each track, artist, and album is emitted and enriched once per run.
+
+    ARGUMENTS:
+        item_pages: Iterable of lists of play items, e.g. extract_helper_functions.iter_recent_played_pages.
+        chunk_size: Number of plays per chunk.
+        cache: Optional MetadataCache placed in front of the artist and album API requests.
+        client: Optional SpotifyApiClient for artist and album API requests. Defaults to one client reading the spotipy cache file token for the whole run, closed when the run ends.
+    '''
+    default_client = sc.SpotifyApiClient(sc.TokenHolder()) if client is None else None
+    client = client or default_client
+    seen_ids = {'track': set(), 'artist': set(), 'album': set()}
+    buffer = []
+    try:
+        for items in item_pages:
+            buffer.extend(items)
+            while len(buffer) >= chunk_size:
+                chunk, buffer = buffer[:chunk_size], buffer[chunk_size:]
+                yield create_dataframes({'items': chunk}, cache=cache, client=client, seen_ids=seen_ids)
+        if buffer:
+            yield create_dataframes({'items': buffer}, cache=cache, client=client, seen_ids=seen_ids)
+    finally:
+        if default_client is not None:
+            default_client.close()
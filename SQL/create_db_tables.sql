@@ -6,9 +6,10 @@ CREATE DATABASE spotify_project
 	WITH
 	CONNECTION LIMIT = 1;
 
--- Create table for artists
+-- Create table for artists. Integer surrogate key referenced by plays and rollups, Spotify ID kept unique for upserts.
 CREATE TABLE IF NOT EXISTS artists (
-	artist_id CHAR(22) PRIMARY KEY,
+	artist_sk INT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+	artist_id CHAR(22) NOT NULL UNIQUE,
 	artist_name TEXT,
 	artist_url TEXT, 
 	artist_followers INT,
@@ -17,7 +18,8 @@ CREATE TABLE IF NOT EXISTS artists (
 
 -- Create table for albums
 CREATE TABLE IF NOT EXISTS albums (
-	album_id CHAR(22) PRIMARY KEY,
+	album_sk INT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+	album_id CHAR(22) NOT NULL UNIQUE,
 	album_name TEXT,
 	album_url TEXT,  
 	album_popularity SMALLINT,
@@ -26,19 +28,124 @@ CREATE TABLE IF NOT EXISTS albums (
 );
 
 CREATE TABLE IF NOT EXISTS tracks (
-	track_id CHAR(22) PRIMARY KEY,
+	track_sk INT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+	track_id CHAR(22) NOT NULL UNIQUE,
 	track_name TEXT,
 	track_url TEXT,
 	track_length_ms INT,
 	track_popularity SMALLINT
 );
 
--- Create table for tracks
+-- Create table for audio features of tracks. Features never change, so each track is fetched and stored once. Feature columns are NULL for tracks Spotify has no features for.
+CREATE TABLE IF NOT EXISTS track_features (
+	track_sk INT PRIMARY KEY REFERENCES tracks (track_sk),
+	danceability REAL,
+	energy REAL,
+	key SMALLINT,
+	loudness REAL,
+	mode SMALLINT,
+	speechiness REAL,
+	acousticness REAL,
+	instrumentalness REAL,
+	liveness REAL,
+	valence REAL,
+	tempo REAL,
+	time_signature SMALLINT
+);
+
+-- Create table for users whose plays are loaded, so several users can share the database. Plays, rollups, cached reports, and watermarks are kept per user.
+-- user_label is the user's email or client_id, 'default' for single-user loads.
+CREATE TABLE IF NOT EXISTS users (
+	user_sk INT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+	user_label TEXT NOT NULL UNIQUE
+);
+
+-- Create table for plays, range partitioned by month of played_at. Users and dimensions are referenced by integer surrogate keys.
+-- A play is identified by its natural key (played_at, user_sk, track_sk), which also includes the partition key.
 CREATE TABLE IF NOT EXISTS play_log (
-	time_track_key TEXT PRIMARY KEY,
-	track_id CHAR(22) REFERENCES tracks (track_id),
-	artist_id CHAR(22) REFERENCES artists (artist_id),
-	album_id CHAR(22) REFERENCES albums (album_id),
-	played_at DATE,
-	date_appended DATE
+	played_at TIMESTAMPTZ NOT NULL,
+	user_sk INT NOT NULL REFERENCES users (user_sk),
+	track_sk INT NOT NULL REFERENCES tracks (track_sk),
+	artist_sk INT REFERENCES artists (artist_sk),
+	album_sk INT REFERENCES albums (album_sk),
+	PRIMARY KEY (played_at, user_sk, track_sk)
+) PARTITION BY RANGE (played_at);
+
+-- Create monthly play_log partition (UTC month bounds) if it does not exist. Called by the loader for every month it loads.
+CREATE OR REPLACE FUNCTION create_play_log_partition(month_start DATE)
+RETURNS VOID
+AS
+$$
+DECLARE
+	partition_start DATE := DATE_TRUNC('month', month_start);
+	partition_name TEXT := 'play_log_' || TO_CHAR(partition_start, 'YYYY_MM');
+BEGIN
+	-- Skip existing partitions without locking play_log
+	IF TO_REGCLASS(partition_name) IS NULL THEN
+		-- The partition's foreign keys lock the tables play_log references. Locked up front in the order loads write them, so no load holding one of them waits on this transaction.
+		LOCK TABLE artists, albums, tracks, users IN SHARE ROW EXCLUSIVE MODE;
+		BEGIN
+			EXECUTE FORMAT(
+				'CREATE TABLE %I PARTITION OF play_log FOR VALUES FROM (%L) TO (%L)',
+				partition_name,
+				partition_start::TIMESTAMP AT TIME ZONE 'UTC',
+				(partition_start + INTERVAL '1 month')::TIMESTAMP AT TIME ZONE 'UTC'
+			);
+		EXCEPTION
+			-- A concurrent transaction created the partition after the check
+			WHEN duplicate_table THEN
+				NULL;
+		END;
+	END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Indexes on play_log, created on every partition. The primary key already serves played_at range scans.
+CREATE INDEX IF NOT EXISTS play_log_track_sk_idx ON play_log (track_sk);
+CREATE INDEX IF NOT EXISTS play_log_artist_sk_idx ON play_log (artist_sk);
+CREATE INDEX IF NOT EXISTS play_log_album_sk_idx ON play_log (album_sk);
+
+-- Create table for pipeline state such as the incremental extract watermark of each user ('played_at_watermark:<user_label>')
+CREATE TABLE IF NOT EXISTS etl_state (
+	state_key TEXT PRIMARY KEY,
+	state_value BIGINT
+);
+
+-- Create daily rollup tables of plays per user, kept up to date by the loader in the same transaction as each play_log load. play_date is the US/Pacific date.
+CREATE TABLE IF NOT EXISTS daily_track_plays (
+	user_sk INT REFERENCES users (user_sk),
+	play_date DATE,
+	track_sk INT REFERENCES tracks (track_sk),
+	artist_sk INT REFERENCES artists (artist_sk),
+	play_count INT,
+	total_ms BIGINT,
+	PRIMARY KEY (user_sk, play_date, track_sk)
+);
+
+CREATE TABLE IF NOT EXISTS daily_artist_plays (
+	user_sk INT REFERENCES users (user_sk),
+	play_date DATE,
+	artist_sk INT REFERENCES artists (artist_sk),
+	play_count INT,
+	total_ms BIGINT,
+	PRIMARY KEY (user_sk, play_date, artist_sk)
+);
+
+CREATE TABLE IF NOT EXISTS daily_album_plays (
+	user_sk INT REFERENCES users (user_sk),
+	play_date DATE,
+	album_sk INT REFERENCES albums (album_sk),
+	play_count INT,
+	total_ms BIGINT,
+	PRIMARY KEY (user_sk, play_date, album_sk)
+);
+
+-- Create table of cached weekly_report results keyed by user and period of play dates [period_start, period_end). Filled by cached_report, entries are deleted by the loader when new plays of the user fall into their period.
+CREATE TABLE IF NOT EXISTS report_cache (
+	user_sk INT REFERENCES users (user_sk),
+	period_start DATE,
+	period_end DATE,
+	report JSON,
+	computed_at TIMESTAMPTZ DEFAULT NOW(),
+	PRIMARY KEY (user_sk, period_start, period_end)
 );
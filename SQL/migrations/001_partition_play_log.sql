@@ -0,0 +1,65 @@
+-- Migrate play_log from an unpartitioned table with a DATE played_at to a monthly range partitioned table with a TIMESTAMPTZ played_at.
+-- Existing rows only stored the US/Pacific play date, so they are migrated as midnight US/Pacific of that date.
+BEGIN;
+
+-- Keep old table aside. Its primary key index is renamed to free the play_log_pkey name.
+ALTER TABLE play_log RENAME TO play_log_unpartitioned;
+ALTER INDEX play_log_pkey RENAME TO play_log_unpartitioned_pkey;
+
+CREATE TABLE play_log (
+	time_track_key TEXT,
+	track_id CHAR(22) REFERENCES tracks (track_id),
+	artist_id CHAR(22) REFERENCES artists (artist_id),
+	album_id CHAR(22) REFERENCES albums (album_id),
+	played_at TIMESTAMPTZ NOT NULL,
+	date_appended DATE,
+	PRIMARY KEY (time_track_key, played_at)
+) PARTITION BY RANGE (played_at);
+
+CREATE OR REPLACE FUNCTION create_play_log_partition(month_start DATE)
+RETURNS VOID
+AS
+$$
+DECLARE
+	partition_start DATE := DATE_TRUNC('month', month_start);
+	partition_name TEXT := 'play_log_' || TO_CHAR(partition_start, 'YYYY_MM');
+BEGIN
+	-- Skip existing partitions without locking play_log
+	IF TO_REGCLASS(partition_name) IS NULL THEN
+		EXECUTE FORMAT(
+			'CREATE TABLE %I PARTITION OF play_log FOR VALUES FROM (%L) TO (%L)',
+			partition_name,
+			partition_start::TIMESTAMP AT TIME ZONE 'UTC',
+			(partition_start + INTERVAL '1 month')::TIMESTAMP AT TIME ZONE 'UTC'
+		);
+	END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Partitions for every month of existing history
+SELECT create_play_log_partition(M.month_start)
+FROM (
+	SELECT DISTINCT DATE_TRUNC('month', (played_at::TIMESTAMP AT TIME ZONE 'US/Pacific') AT TIME ZONE 'UTC')::DATE month_start
+	FROM play_log_unpartitioned
+) M;
+
+INSERT INTO play_log
+SELECT
+	time_track_key,
+	track_id,
+	artist_id,
+	album_id,
+	played_at::TIMESTAMP AT TIME ZONE 'US/Pacific',
+	date_appended
+FROM
+	play_log_unpartitioned;
+
+DROP TABLE play_log_unpartitioned;
+
+-- Indexes on play_log, created on every partition. BRIN suits the append-ordered played_at column.
+CREATE INDEX IF NOT EXISTS play_log_played_at_brin ON play_log USING BRIN (played_at);
+CREATE INDEX IF NOT EXISTS play_log_track_id_idx ON play_log (track_id);
+CREATE INDEX IF NOT EXISTS play_log_artist_id_idx ON play_log (artist_id);
+CREATE INDEX IF NOT EXISTS play_log_album_id_idx ON play_log (album_id);
+
+COMMIT;
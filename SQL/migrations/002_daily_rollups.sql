@@ -0,0 +1,58 @@
+-- Create daily rollup tables of plays and backfill them from existing play_log history.
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS daily_track_plays (
+	play_date DATE,
+	track_id CHAR(22) REFERENCES tracks (track_id),
+	artist_id CHAR(22) REFERENCES artists (artist_id),
+	play_count INT,
+	total_ms BIGINT,
+	PRIMARY KEY (play_date, track_id)
+);
+
+CREATE TABLE IF NOT EXISTS daily_artist_plays (
+	play_date DATE,
+	artist_id CHAR(22) REFERENCES artists (artist_id),
+	play_count INT,
+	total_ms BIGINT,
+	PRIMARY KEY (play_date, artist_id)
+);
+
+CREATE TABLE IF NOT EXISTS daily_album_plays (
+	play_date DATE,
+	album_id CHAR(22) REFERENCES albums (album_id),
+	play_count INT,
+	total_ms BIGINT,
+	PRIMARY KEY (play_date, album_id)
+);
+
+TRUNCATE daily_track_plays, daily_artist_plays, daily_album_plays;
+
+INSERT INTO daily_track_plays
+SELECT (P.played_at AT TIME ZONE 'US/Pacific')::DATE, P.track_id, MIN(P.artist_id), COUNT(*), SUM(T.track_length_ms)
+FROM 
+	play_log P
+	JOIN tracks T ON
+		P.track_id = T.track_id
+GROUP BY 
+	(P.played_at AT TIME ZONE 'US/Pacific')::DATE, P.track_id;
+
+INSERT INTO daily_artist_plays
+SELECT (P.played_at AT TIME ZONE 'US/Pacific')::DATE, P.artist_id, COUNT(*), SUM(T.track_length_ms)
+FROM 
+	play_log P
+	JOIN tracks T ON
+		P.track_id = T.track_id
+GROUP BY 
+	(P.played_at AT TIME ZONE 'US/Pacific')::DATE, P.artist_id;
+
+INSERT INTO daily_album_plays
+SELECT (P.played_at AT TIME ZONE 'US/Pacific')::DATE, P.album_id, COUNT(*), SUM(T.track_length_ms)
+FROM 
+	play_log P
+	JOIN tracks T ON
+		P.track_id = T.track_id
+GROUP BY 
+	(P.played_at AT TIME ZONE 'US/Pacific')::DATE, P.album_id;
+
+COMMIT;
@@ -0,0 +1,122 @@
+-- Migrate tracks, artists, albums to integer surrogate primary keys and re-encode play_log and the daily rollups with them.
+-- play_log drops time_track_key and date_appended, a play is identified by (played_at, track_sk).
+-- Re-run weekly_metric_functions.sql afterwards, the metric functions read the surrogate key columns.
+BEGIN;
+
+-- Plays encoded with the new keys, kept aside while the old tables are dropped
+ALTER TABLE tracks ADD COLUMN track_sk INT GENERATED ALWAYS AS IDENTITY;
+ALTER TABLE artists ADD COLUMN artist_sk INT GENERATED ALWAYS AS IDENTITY;
+ALTER TABLE albums ADD COLUMN album_sk INT GENERATED ALWAYS AS IDENTITY;
+
+CREATE TEMP TABLE encoded_plays ON COMMIT DROP AS
+SELECT
+	P.played_at,
+	T.track_sk,
+	A.artist_sk,
+	AL.album_sk
+FROM
+	play_log P
+	JOIN tracks T ON
+		P.track_id = T.track_id
+	LEFT JOIN artists A ON
+		P.artist_id = A.artist_id
+	LEFT JOIN albums AL ON
+		P.album_id = AL.album_id;
+
+DROP TABLE play_log, daily_track_plays, daily_artist_plays, daily_album_plays;
+
+-- Surrogate keys become primary keys, Spotify IDs stay unique for upserts
+ALTER TABLE tracks DROP CONSTRAINT tracks_pkey;
+ALTER TABLE tracks ADD PRIMARY KEY (track_sk);
+ALTER TABLE tracks ADD UNIQUE (track_id);
+ALTER TABLE tracks ALTER COLUMN track_id SET NOT NULL;
+
+ALTER TABLE artists DROP CONSTRAINT artists_pkey;
+ALTER TABLE artists ADD PRIMARY KEY (artist_sk);
+ALTER TABLE artists ADD UNIQUE (artist_id);
+ALTER TABLE artists ALTER COLUMN artist_id SET NOT NULL;
+
+ALTER TABLE albums DROP CONSTRAINT albums_pkey;
+ALTER TABLE albums ADD PRIMARY KEY (album_sk);
+ALTER TABLE albums ADD UNIQUE (album_id);
+ALTER TABLE albums ALTER COLUMN album_id SET NOT NULL;
+
+CREATE TABLE play_log (
+	played_at TIMESTAMPTZ NOT NULL,
+	track_sk INT NOT NULL REFERENCES tracks (track_sk),
+	artist_sk INT REFERENCES artists (artist_sk),
+	album_sk INT REFERENCES albums (album_sk),
+	PRIMARY KEY (played_at, track_sk)
+) PARTITION BY RANGE (played_at);
+
+-- Partitions for every month of existing history
+SELECT create_play_log_partition(M.month_start)
+FROM (
+	SELECT DISTINCT DATE_TRUNC('month', played_at AT TIME ZONE 'UTC')::DATE month_start
+	FROM encoded_plays
+) M;
+
+INSERT INTO play_log
+SELECT played_at, track_sk, artist_sk, album_sk
+FROM encoded_plays
+ON CONFLICT (played_at, track_sk) DO NOTHING;
+
+-- Indexes on play_log, created on every partition. The primary key already serves played_at range scans.
+CREATE INDEX IF NOT EXISTS play_log_track_sk_idx ON play_log (track_sk);
+CREATE INDEX IF NOT EXISTS play_log_artist_sk_idx ON play_log (artist_sk);
+CREATE INDEX IF NOT EXISTS play_log_album_sk_idx ON play_log (album_sk);
+
+-- Daily rollups keyed by surrogate keys, rebuilt from play_log
+CREATE TABLE daily_track_plays (
+	play_date DATE,
+	track_sk INT REFERENCES tracks (track_sk),
+	artist_sk INT REFERENCES artists (artist_sk),
+	play_count INT,
+	total_ms BIGINT,
+	PRIMARY KEY (play_date, track_sk)
+);
+
+CREATE TABLE daily_artist_plays (
+	play_date DATE,
+	artist_sk INT REFERENCES artists (artist_sk),
+	play_count INT,
+	total_ms BIGINT,
+	PRIMARY KEY (play_date, artist_sk)
+);
+
+CREATE TABLE daily_album_plays (
+	play_date DATE,
+	album_sk INT REFERENCES albums (album_sk),
+	play_count INT,
+	total_ms BIGINT,
+	PRIMARY KEY (play_date, album_sk)
+);
+
+INSERT INTO daily_track_plays
+SELECT (P.played_at AT TIME ZONE 'US/Pacific')::DATE, P.track_sk, MIN(P.artist_sk), COUNT(*), SUM(T.track_length_ms)
+FROM
+	play_log P
+	JOIN tracks T ON
+		P.track_sk = T.track_sk
+GROUP BY
+	(P.played_at AT TIME ZONE 'US/Pacific')::DATE, P.track_sk;
+
+INSERT INTO daily_artist_plays
+SELECT (P.played_at AT TIME ZONE 'US/Pacific')::DATE, P.artist_sk, COUNT(*), SUM(T.track_length_ms)
+FROM
+	play_log P
+	JOIN tracks T ON
+		P.track_sk = T.track_sk
+GROUP BY
+	(P.played_at AT TIME ZONE 'US/Pacific')::DATE, P.artist_sk;
+
+INSERT INTO daily_album_plays
+SELECT (P.played_at AT TIME ZONE 'US/Pacific')::DATE, P.album_sk, COUNT(*), SUM(T.track_length_ms)
+FROM
+	play_log P
+	JOIN tracks T ON
+		P.track_sk = T.track_sk
+GROUP BY
+	(P.played_at AT TIME ZONE 'US/Pacific')::DATE, P.album_sk;
+
+COMMIT;
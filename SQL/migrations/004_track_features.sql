@@ -0,0 +1,21 @@
+-- Create table for audio features of tracks. Existing tracks have no features yet and are fetched by the next ETL run that plays them.
+-- Re-run weekly_metric_functions.sql afterwards, weekly_report reads the new table.
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS track_features (
+	track_sk INT PRIMARY KEY REFERENCES tracks (track_sk),
+	danceability REAL,
+	energy REAL,
+	key SMALLINT,
+	loudness REAL,
+	mode SMALLINT,
+	speechiness REAL,
+	acousticness REAL,
+	instrumentalness REAL,
+	liveness REAL,
+	valence REAL,
+	tempo REAL,
+	time_signature SMALLINT
+);
+
+COMMIT;
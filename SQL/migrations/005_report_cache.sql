@@ -0,0 +1,27 @@
+-- Create report_cache and drop the metric functions without period arguments. Their replacements take (period_start, period_end) with defaults, and would be ambiguous next to them.
+-- Re-run weekly_metric_functions.sql afterwards to create the period functions and cached_report.
+BEGIN;
+
+DROP FUNCTION IF EXISTS weekly_total_time_played();
+DROP FUNCTION IF EXISTS top_5_most_popular_songs();
+DROP FUNCTION IF EXISTS most_popular_artists();
+DROP FUNCTION IF EXISTS most_popular_albums();
+DROP FUNCTION IF EXISTS most_played_songs();
+DROP FUNCTION IF EXISTS most_frequently_played_artist();
+DROP FUNCTION IF EXISTS most_frequently_played_album();
+DROP FUNCTION IF EXISTS artist_with_most_followers();
+DROP FUNCTION IF EXISTS most_songs_played_in_week();
+DROP FUNCTION IF EXISTS longest_songs();
+DROP FUNCTION IF EXISTS songs_played_by_decade();
+DROP FUNCTION IF EXISTS average_features_by_day();
+DROP FUNCTION IF EXISTS weekly_report();
+
+CREATE TABLE IF NOT EXISTS report_cache (
+	period_start DATE,
+	period_end DATE,
+	report JSON,
+	computed_at TIMESTAMPTZ DEFAULT NOW(),
+	PRIMARY KEY (period_start, period_end)
+);
+
+COMMIT;
@@ -0,0 +1,30 @@
+-- Recreate create_play_log_partition so that loads creating the same monthly partition at once no longer fail the second load.
+BEGIN;
+
+CREATE OR REPLACE FUNCTION create_play_log_partition(month_start DATE)
+RETURNS VOID
+AS
+$$
+DECLARE
+	partition_start DATE := DATE_TRUNC('month', month_start);
+	partition_name TEXT := 'play_log_' || TO_CHAR(partition_start, 'YYYY_MM');
+BEGIN
+	-- Skip existing partitions without locking play_log
+	IF TO_REGCLASS(partition_name) IS NULL THEN
+		BEGIN
+			EXECUTE FORMAT(
+				'CREATE TABLE %I PARTITION OF play_log FOR VALUES FROM (%L) TO (%L)',
+				partition_name,
+				partition_start::TIMESTAMP AT TIME ZONE 'UTC',
+				(partition_start + INTERVAL '1 month')::TIMESTAMP AT TIME ZONE 'UTC'
+			);
+		EXCEPTION
+			-- A concurrent transaction created the partition after the check
+			WHEN duplicate_table THEN
+				NULL;
+		END;
+	END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+COMMIT;
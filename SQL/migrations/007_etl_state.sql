@@ -0,0 +1,10 @@
+-- Create table for pipeline state such as the incremental extract watermark, for databases created before create_db_tables.sql added it.
+-- Loads write the played_at watermark in their transaction, so they roll back until this table exists.
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS etl_state (
+	state_key TEXT PRIMARY KEY,
+	state_value BIGINT
+);
+
+COMMIT;
@@ -0,0 +1,96 @@
+-- Scope plays, daily rollups, cached reports, and the played_at watermark by user, so several users can load into one database.
+-- Existing history belongs to the 'default' user, the user single-user loads and reports use.
+-- Re-run weekly_metric_functions.sql afterwards, the metric functions take the user to report on. The functions without it are dropped, they would be ambiguous next to them.
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS users (
+	user_sk INT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+	user_label TEXT NOT NULL UNIQUE
+);
+
+INSERT INTO users (user_label)
+VALUES ('default')
+ON CONFLICT (user_label) DO NOTHING;
+
+-- Existing rows get the default user's key without rewriting the tables, the default is dropped once set
+DO
+$$
+DECLARE
+	default_user_sk INT := (SELECT user_sk FROM users WHERE user_label = 'default');
+	table_name TEXT;
+BEGIN
+	FOREACH table_name IN ARRAY ARRAY['play_log', 'daily_track_plays', 'daily_artist_plays', 'daily_album_plays'] LOOP
+		EXECUTE FORMAT('ALTER TABLE %I ADD COLUMN user_sk INT NOT NULL DEFAULT %s REFERENCES users (user_sk)', table_name, default_user_sk);
+		EXECUTE FORMAT('ALTER TABLE %I ALTER COLUMN user_sk DROP DEFAULT', table_name);
+	END LOOP;
+END;
+$$;
+
+-- Natural key of a play, includes partition key
+ALTER TABLE play_log DROP CONSTRAINT play_log_pkey;
+ALTER TABLE play_log ADD PRIMARY KEY (played_at, user_sk, track_sk);
+
+ALTER TABLE daily_track_plays DROP CONSTRAINT daily_track_plays_pkey;
+ALTER TABLE daily_track_plays ADD PRIMARY KEY (user_sk, play_date, track_sk);
+
+ALTER TABLE daily_artist_plays DROP CONSTRAINT daily_artist_plays_pkey;
+ALTER TABLE daily_artist_plays ADD PRIMARY KEY (user_sk, play_date, artist_sk);
+
+ALTER TABLE daily_album_plays DROP CONSTRAINT daily_album_plays_pkey;
+ALTER TABLE daily_album_plays ADD PRIMARY KEY (user_sk, play_date, album_sk);
+
+-- Cached reports are recomputed per user on the next request
+DELETE FROM report_cache;
+ALTER TABLE report_cache ADD COLUMN user_sk INT REFERENCES users (user_sk);
+ALTER TABLE report_cache DROP CONSTRAINT report_cache_pkey;
+ALTER TABLE report_cache ADD PRIMARY KEY (user_sk, period_start, period_end);
+
+-- Partition creation locks the tables play_log references, users included, in the order loads write them, so users loading into one database at once do not deadlock
+CREATE OR REPLACE FUNCTION create_play_log_partition(month_start DATE)
+RETURNS VOID
+AS
+$$
+DECLARE
+	partition_start DATE := DATE_TRUNC('month', month_start);
+	partition_name TEXT := 'play_log_' || TO_CHAR(partition_start, 'YYYY_MM');
+BEGIN
+	-- Skip existing partitions without locking play_log
+	IF TO_REGCLASS(partition_name) IS NULL THEN
+		-- The partition's foreign keys lock the tables play_log references. Locked up front in the order loads write them, so no load holding one of them waits on this transaction.
+		LOCK TABLE artists, albums, tracks, users IN SHARE ROW EXCLUSIVE MODE;
+		BEGIN
+			EXECUTE FORMAT(
+				'CREATE TABLE %I PARTITION OF play_log FOR VALUES FROM (%L) TO (%L)',
+				partition_name,
+				partition_start::TIMESTAMP AT TIME ZONE 'UTC',
+				(partition_start + INTERVAL '1 month')::TIMESTAMP AT TIME ZONE 'UTC'
+			);
+		EXCEPTION
+			-- A concurrent transaction created the partition after the check
+			WHEN duplicate_table THEN
+				NULL;
+		END;
+	END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+UPDATE etl_state
+SET state_key = 'played_at_watermark:default'
+WHERE state_key = 'played_at_watermark';
+
+DROP FUNCTION IF EXISTS weekly_total_time_played(DATE, DATE);
+DROP FUNCTION IF EXISTS top_5_most_popular_songs(DATE, DATE);
+DROP FUNCTION IF EXISTS most_popular_artists(DATE, DATE);
+DROP FUNCTION IF EXISTS most_popular_albums(DATE, DATE);
+DROP FUNCTION IF EXISTS most_played_songs(DATE, DATE);
+DROP FUNCTION IF EXISTS most_frequently_played_artist(DATE, DATE);
+DROP FUNCTION IF EXISTS most_frequently_played_album(DATE, DATE);
+DROP FUNCTION IF EXISTS artist_with_most_followers(DATE, DATE);
+DROP FUNCTION IF EXISTS most_songs_played_in_week(DATE, DATE);
+DROP FUNCTION IF EXISTS longest_songs(DATE, DATE);
+DROP FUNCTION IF EXISTS songs_played_by_decade(DATE, DATE);
+DROP FUNCTION IF EXISTS average_features_by_day(DATE, DATE);
+DROP FUNCTION IF EXISTS weekly_report(DATE, DATE);
+DROP FUNCTION IF EXISTS cached_report(DATE, DATE);
+
+COMMIT;
@@ -1,203 +1,216 @@
+-- Weekly metrics read the daily rollup tables (daily_track_plays, daily_artist_plays, daily_album_plays) instead of scanning raw play_log.
+-- Every metric covers play dates in [period_start, period_end). The defaults are the last week, any other period (a past week, a year in review) can be passed instead.
+-- Every metric covers the plays of for_user, the user_label of the users table. The default is the user single-user loads store their plays under.
+
 -- Total time listening to Spotify
-CREATE OR REPLACE FUNCTION weekly_total_time_played()
+CREATE OR REPLACE FUNCTION weekly_total_time_played(period_start DATE DEFAULT CURRENT_DATE - 7, period_end DATE DEFAULT CURRENT_DATE + 1, for_user TEXT DEFAULT 'default')
 RETURNS TABLE (hours_played DECIMAL)
 AS 
 $$
 	SELECT 
-		ROUND(SUM(CAST(T.track_length_ms AS DECIMAL) / 3600000), 2)
+		ROUND(SUM(CAST(D.total_ms AS DECIMAL) / 3600000), 2)
 	FROM 
-		play_log P
-		JOIN tracks T ON
-			P.track_id = T.track_id
+		daily_track_plays D
 	WHERE 
-		P.played_at >= CURRENT_DATE - 7;
+		D.user_sk = (SELECT U.user_sk FROM users U WHERE U.user_label = for_user)
+		AND D.play_date >= period_start AND D.play_date < period_end;
 $$ LANGUAGE SQL;
 
 
 
 -- Most popular songs played by track popularity
-CREATE FUNCTION top_5_most_popular_songs()
+CREATE OR REPLACE FUNCTION top_5_most_popular_songs(period_start DATE DEFAULT CURRENT_DATE - 7, period_end DATE DEFAULT CURRENT_DATE + 1, for_user TEXT DEFAULT 'default')
 RETURNS TABLE(song_artist_names TEXT)
 AS 
 $$
 	SELECT CONCAT(T.track_name, ' by ', A.artist_name)
 	FROM 
-		play_log P
+		daily_track_plays D
+		-- One row per play, as when read from play_log, so a track played more than once is listed more than once
+		CROSS JOIN GENERATE_SERIES(1, D.play_count) G
 		JOIN tracks T
-			ON P.track_id = T.track_id
+			ON D.track_sk = T.track_sk
 		JOIN artists A
-			ON P.artist_id = A.artist_id
+			ON D.artist_sk = A.artist_sk
 	WHERE 
-		P.played_at >= CURRENT_DATE - 7
+		D.user_sk = (SELECT U.user_sk FROM users U WHERE U.user_label = for_user)
+		AND D.play_date >= period_start AND D.play_date < period_end
 	ORDER BY track_popularity DESC
 	LIMIT 5;
 $$ LANGUAGE SQL;
 
 -- Most popular artists by popularity
-CREATE OR REPLACE FUNCTION most_popular_artists()
+CREATE OR REPLACE FUNCTION most_popular_artists(period_start DATE DEFAULT CURRENT_DATE - 7, period_end DATE DEFAULT CURRENT_DATE + 1, for_user TEXT DEFAULT 'default')
 RETURNS TABLE (artist_names TEXT)
 AS 
 $$
 	SELECT A.artist_name
 	FROM 
 		(SELECT DISTINCT 
-		 	artist_id 
-		 FROM play_log
+		 	artist_sk 
+		 FROM daily_artist_plays
 		 WHERE 
-			played_at >= CURRENT_DATE - 7) P
+			user_sk = (SELECT U.user_sk FROM users U WHERE U.user_label = for_user)
+			AND play_date >= period_start AND play_date < period_end) D
 		JOIN artists A ON
-			P.artist_id = A.artist_id
+			D.artist_sk = A.artist_sk
 	ORDER BY A.artist_popularity DESC
 	LIMIT 5;
 $$ LANGUAGE SQL;
 
 -- Most popular albums by popularity
-CREATE OR REPLACE FUNCTION most_popular_albums()
+CREATE OR REPLACE FUNCTION most_popular_albums(period_start DATE DEFAULT CURRENT_DATE - 7, period_end DATE DEFAULT CURRENT_DATE + 1, for_user TEXT DEFAULT 'default')
 RETURNS TABLE (album_names TEXT)
 AS
 $$
 	SELECT
 		A.album_name
 	FROM
-	   (SELECT DISTINCT album_id
+	   (SELECT DISTINCT album_sk
 		FROM 
-			play_log
+			daily_album_plays
 		WHERE
-			played_at >= CURRENT_DATE - 7) P
+			user_sk = (SELECT U.user_sk FROM users U WHERE U.user_label = for_user)
+			AND play_date >= period_start AND play_date < period_end) D
 	JOIN albums A ON
-		P.album_id = A.album_id
+		D.album_sk = A.album_sk
 	ORDER BY A.album_popularity DESC
 	LIMIT 5
 ;
 $$ LANGUAGE SQL;
 
 -- Most frequently played songs
-CREATE OR REPLACE FUNCTION most_played_songs()
+CREATE OR REPLACE FUNCTION most_played_songs(period_start DATE DEFAULT CURRENT_DATE - 7, period_end DATE DEFAULT CURRENT_DATE + 1, for_user TEXT DEFAULT 'default')
 RETURNS TABLE(song_name TEXT, times_played SMALLINT)
 AS
 $$
 	WITH cte AS (
-		SELECT track_id, COUNT(*) times_played
+		SELECT track_sk, SUM(play_count) times_played
 		FROM
-			play_log
+			daily_track_plays
 		WHERE 
-			played_at >= CURRENT_DATE - 7 
+			user_sk = (SELECT U.user_sk FROM users U WHERE U.user_label = for_user)
+			AND play_date >= period_start AND play_date < period_end
 		GROUP BY 
-			track_id
+			track_sk
 	)
 	SELECT T.track_name, times_played
 	FROM 
 		cte C
 		JOIN tracks T ON
-		C.track_id = T.track_id
+		C.track_sk = T.track_sk
 	ORDER BY C.times_played DESC, T.track_popularity DESC
 	LIMIT 5
 ;
 $$ LANGUAGE SQL;
 
-SELECT * FROM most_played_songs()
-
 -- Most frequently played artist
-CREATE OR REPLACE FUNCTION most_frequently_played_artist()
+CREATE OR REPLACE FUNCTION most_frequently_played_artist(period_start DATE DEFAULT CURRENT_DATE - 7, period_end DATE DEFAULT CURRENT_DATE + 1, for_user TEXT DEFAULT 'default')
 RETURNS TABLE (artist_name TEXT, times_played SMALLINT)
 AS
 $$
 	WITH cte AS (
-		SELECT artist_id, COUNT(*) times_played
+		SELECT artist_sk, SUM(play_count) times_played
 		FROM 
-			play_log 
+			daily_artist_plays
 		WHERE 
-			played_at >= CURRENT_DATE - 7
+			user_sk = (SELECT U.user_sk FROM users U WHERE U.user_label = for_user)
+			AND play_date >= period_start AND play_date < period_end
 		GROUP BY 
-			artist_id
+			artist_sk
 	)
 	SELECT A.artist_name, cte.times_played
 	FROM 
 		artists A
 		JOIN cte ON
-		A.artist_id = cte.artist_id
+		A.artist_sk = cte.artist_sk
 	ORDER BY cte.times_played DESC
 	LIMIT 1
 ;
 $$ LANGUAGE SQL;
 
 -- Most frequently played album
-CREATE OR REPLACE FUNCTION most_frequently_played_album()
+CREATE OR REPLACE FUNCTION most_frequently_played_album(period_start DATE DEFAULT CURRENT_DATE - 7, period_end DATE DEFAULT CURRENT_DATE + 1, for_user TEXT DEFAULT 'default')
 RETURNS TABLE (album_name TEXT, times_played SMALLINT)
 AS 
 $$
 	WITH cte AS (
-		SELECT album_id, COUNT(*) times_played
+		SELECT album_sk, SUM(play_count) times_played
 		FROM 
-			play_log
+			daily_album_plays
 		WHERE 
-			played_at >= CURRENT_DATE - 7
+			user_sk = (SELECT U.user_sk FROM users U WHERE U.user_label = for_user)
+			AND play_date >= period_start AND play_date < period_end
 		GROUP BY 
-			album_id
+			album_sk
 	)
 	SELECT A.album_name, cte.times_played
 	FROM 
 		cte 
 		JOIN albums A ON
-		cte.album_id = A.album_id
+		cte.album_sk = A.album_sk
 	ORDER BY cte.times_played DESC
 	LIMIT 1
 ;
 $$ LANGUAGE SQL;
 
 -- Artist played with the most followers
-CREATE OR REPLACE FUNCTION artist_with_most_followers()
+CREATE OR REPLACE FUNCTION artist_with_most_followers(period_start DATE DEFAULT CURRENT_DATE - 7, period_end DATE DEFAULT CURRENT_DATE + 1, for_user TEXT DEFAULT 'default')
 RETURNS TABLE (artist TEXT, artist_followers TEXT)
 AS 
 $$
 	SELECT A.artist_name, TO_CHAR(A.artist_followers, 'FM9,999,999,999')
 	FROM 
-		play_log P
+		daily_artist_plays D
 		JOIN artists A ON 
-			P.artist_id = A.artist_id
+			D.artist_sk = A.artist_sk
 	WHERE 
-		P.played_at >= CURRENT_DATE - 7
+		D.user_sk = (SELECT U.user_sk FROM users U WHERE U.user_label = for_user)
+		AND D.play_date >= period_start AND D.play_date < period_end
 	ORDER BY A.artist_followers DESC
 	LIMIT 1
 ;
 $$ LANGUAGE SQL;
 
 -- Day of the week with most songs played or just number of songs played by day
-CREATE OR REPLACE FUNCTION most_songs_played_in_week()
+CREATE OR REPLACE FUNCTION most_songs_played_in_week(period_start DATE DEFAULT CURRENT_DATE - 7, period_end DATE DEFAULT CURRENT_DATE + 1, for_user TEXT DEFAULT 'default')
 RETURNS TABLE (played_at DATE, songs_played SMALLINT)
 AS
 $$
-	SELECT played_at, COUNT(*) times_played
+	SELECT play_date, SUM(play_count) times_played
 	FROM 
-		play_log
-	WHERE played_at >= CURRENT_DATE - 7
+		daily_track_plays
+	WHERE 
+		user_sk = (SELECT U.user_sk FROM users U WHERE U.user_label = for_user)
+		AND play_date >= period_start AND play_date < period_end
 	GROUP BY 
-		played_at
-	ORDER BY COUNT(*) DESC
+		play_date
+	ORDER BY SUM(play_count) DESC
 	LIMIT 1
 ;
 $$ LANGUAGE SQL;
 
 -- Top 5 weekly songs by duration time
-CREATE OR REPLACE FUNCTION longest_songs()
+CREATE OR REPLACE FUNCTION longest_songs(period_start DATE DEFAULT CURRENT_DATE - 7, period_end DATE DEFAULT CURRENT_DATE + 1, for_user TEXT DEFAULT 'default')
 RETURNS TABLE (song_name TEXT, track_length_min DECIMAL)
 AS 
 $$
 	SELECT 
 		DISTINCT T.track_name, ROUND(CAST(T.track_length_ms AS DECIMAL) / 60000, 2)
 	FROM 
-		play_log P
+		daily_track_plays D
 		JOIN tracks T ON
-		P.track_id = T.track_id
+		D.track_sk = T.track_sk
 	WHERE 
-		P.played_at >= CURRENT_DATE - 7
+		D.user_sk = (SELECT U.user_sk FROM users U WHERE U.user_label = for_user)
+		AND D.play_date >= period_start AND D.play_date < period_end
 	ORDER BY ROUND(CAST(T.track_length_ms AS DECIMAL) / 60000, 2) DESC
 	LIMIT 5
 ;
 $$ LANGUAGE SQL;
 
 -- Number of songs played by decade of release date
-CREATE OR REPLACE FUNCTION songs_played_by_decade()
+CREATE OR REPLACE FUNCTION songs_played_by_decade(period_start DATE DEFAULT CURRENT_DATE - 7, period_end DATE DEFAULT CURRENT_DATE + 1, for_user TEXT DEFAULT 'default')
 RETURNS TABLE (decade TEXT, songs_played SMALLINT)
 AS
 $$
@@ -213,13 +226,14 @@ $$
 			WHEN DATE_PART('Year', A.album_release_date) >= 1950 THEN '1950s'
 			ELSE '1940s or older'
 		END album_decade
-		, COUNT(*) songs_played
+		, SUM(D.play_count) songs_played
 	FROM 
-		play_log P
+		daily_album_plays D
 		JOIN albums A ON
-			P.album_id = A.album_id
+			D.album_sk = A.album_sk
 	WHERE 	
-		P.played_at >= CURRENT_DATE - 7
+		D.user_sk = (SELECT U.user_sk FROM users U WHERE U.user_label = for_user)
+		AND D.play_date >= period_start AND D.play_date < period_end
 	GROUP BY
 		CASE
 			WHEN DATE_PART('Year', A.album_release_date) >= 2020 THEN '2020s'
@@ -234,3 +248,122 @@ $$
 		END
 ;
 $$ LANGUAGE SQL;
+
+-- Average audio features of songs played by day, weighted by times played. Tracks without features are left out.
+CREATE OR REPLACE FUNCTION average_features_by_day(period_start DATE DEFAULT CURRENT_DATE - 7, period_end DATE DEFAULT CURRENT_DATE + 1, for_user TEXT DEFAULT 'default')
+RETURNS TABLE (played_at DATE, energy DECIMAL, danceability DECIMAL, valence DECIMAL, tempo DECIMAL)
+AS
+$$
+	SELECT 
+		D.play_date
+		, ROUND(CAST(SUM(F.energy * D.play_count) / SUM(D.play_count) AS DECIMAL), 2)
+		, ROUND(CAST(SUM(F.danceability * D.play_count) / SUM(D.play_count) AS DECIMAL), 2)
+		, ROUND(CAST(SUM(F.valence * D.play_count) / SUM(D.play_count) AS DECIMAL), 2)
+		, ROUND(CAST(SUM(F.tempo * D.play_count) / SUM(D.play_count) AS DECIMAL), 2)
+	FROM 
+		daily_track_plays D
+		JOIN track_features F ON
+			D.track_sk = F.track_sk
+	WHERE 
+		D.user_sk = (SELECT U.user_sk FROM users U WHERE U.user_label = for_user)
+		AND D.play_date >= period_start AND D.play_date < period_end
+		AND F.energy IS NOT NULL
+	GROUP BY 
+		D.play_date
+	ORDER BY D.play_date
+;
+$$ LANGUAGE SQL;
+
+-- Every metric in one round trip. Calls each metric function above for the user and period and returns a JSON object keyed by metric function name.
+-- Tabular sections are arrays of row arrays, in the column order and row order returned by the function.
+CREATE OR REPLACE FUNCTION weekly_report(period_start DATE DEFAULT CURRENT_DATE - 7, period_end DATE DEFAULT CURRENT_DATE + 1, for_user TEXT DEFAULT 'default')
+RETURNS JSON
+AS
+$$
+	SELECT JSON_BUILD_OBJECT(
+		'weekly_total_time_played', (
+			SELECT M.hours_played
+			FROM weekly_total_time_played(period_start, period_end, for_user) M
+		),
+		'most_songs_played_in_week', (
+			SELECT JSON_BUILD_ARRAY(M.played_at, M.songs_played)
+			FROM most_songs_played_in_week(period_start, period_end, for_user) M
+		),
+		'most_played_songs', (
+			SELECT JSON_AGG(JSON_BUILD_ARRAY(M.song_name, M.times_played) ORDER BY M.ordinality)
+			FROM most_played_songs(period_start, period_end, for_user) WITH ORDINALITY M
+		),
+		'top_5_most_popular_songs', (
+			SELECT JSON_AGG(JSON_BUILD_ARRAY(M.song_artist_names) ORDER BY M.ordinality)
+			FROM top_5_most_popular_songs(period_start, period_end, for_user) WITH ORDINALITY M
+		),
+		'longest_songs', (
+			SELECT JSON_AGG(JSON_BUILD_ARRAY(M.song_name, M.track_length_min) ORDER BY M.ordinality)
+			FROM longest_songs(period_start, period_end, for_user) WITH ORDINALITY M
+		),
+		'songs_played_by_decade', (
+			SELECT JSON_AGG(JSON_BUILD_ARRAY(M.decade, M.songs_played) ORDER BY M.decade DESC)
+			FROM songs_played_by_decade(period_start, period_end, for_user) M
+		),
+		'average_features_by_day', (
+			SELECT JSON_AGG(JSON_BUILD_ARRAY(M.played_at, M.energy, M.danceability, M.valence, M.tempo) ORDER BY M.ordinality)
+			FROM average_features_by_day(period_start, period_end, for_user) WITH ORDINALITY M
+		),
+		'most_popular_artists', (
+			SELECT JSON_AGG(JSON_BUILD_ARRAY(M.artist_names) ORDER BY M.ordinality)
+			FROM most_popular_artists(period_start, period_end, for_user) WITH ORDINALITY M
+		),
+		'most_frequently_played_artist', (
+			SELECT JSON_AGG(JSON_BUILD_ARRAY(M.artist_name, M.times_played))
+			FROM most_frequently_played_artist(period_start, period_end, for_user) M
+		),
+		'artist_with_most_followers', (
+			SELECT JSON_AGG(JSON_BUILD_ARRAY(M.artist, M.artist_followers))
+			FROM artist_with_most_followers(period_start, period_end, for_user) M
+		),
+		'most_popular_albums', (
+			SELECT JSON_AGG(JSON_BUILD_ARRAY(M.album_names) ORDER BY M.ordinality)
+			FROM most_popular_albums(period_start, period_end, for_user) WITH ORDINALITY M
+		),
+		'most_frequently_played_album', (
+			SELECT JSON_AGG(JSON_BUILD_ARRAY(M.album_name, M.times_played))
+			FROM most_frequently_played_album(period_start, period_end, for_user) M
+		)
+	);
+$$ LANGUAGE SQL;
+
+-- weekly_report of a user and period, served from report_cache and computed and stored on a miss. Reports of users without plays are not stored.
+-- The loader deletes cached periods that newly inserted plays of the user or track features fall into, so a cached report only goes stale in popularity and follower values.
+CREATE OR REPLACE FUNCTION cached_report(period_start DATE DEFAULT CURRENT_DATE - 7, period_end DATE DEFAULT CURRENT_DATE + 1, for_user TEXT DEFAULT 'default')
+RETURNS JSON
+AS
+$$
+#variable_conflict use_column
+DECLARE
+	cached JSON;
+	cached_user_sk INT := (SELECT U.user_sk FROM users U WHERE U.user_label = for_user);
+BEGIN
+	SELECT R.report INTO cached
+	FROM report_cache R
+	WHERE 
+		R.user_sk = cached_user_sk
+		AND R.period_start = cached_report.period_start 
+		AND R.period_end = cached_report.period_end;
+	IF FOUND THEN
+		RETURN cached;
+	END IF;
+
+	-- Waits for loads in progress, so the report sees their plays and is not stored after their invalidation ran
+	PERFORM pg_advisory_xact_lock_shared(hashtext('report_cache'));
+	cached := weekly_report(cached_report.period_start, cached_report.period_end, for_user);
+	IF cached_user_sk IS NOT NULL THEN
+		INSERT INTO report_cache (user_sk, period_start, period_end, report)
+		VALUES (cached_user_sk, cached_report.period_start, cached_report.period_end, cached)
+		ON CONFLICT (user_sk, period_start, period_end) DO NOTHING;
+	END IF;
+	RETURN cached;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Cached reports were computed by the previous definitions of the functions above
+DELETE FROM report_cache;